@@ -1,54 +1,385 @@
-from flask import Flask, request, jsonify
+import asyncio
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing
+from aiohttp import web
+import metrics
+from chat.cancellation import CancellationToken
 from main import Chatbot
 
-app = Flask(__name__)
+SESSION_ID_PATTERN = re.compile(r'^[A-Za-z0-9_\-]{1,64}$')
 
-chatbot = Chatbot(use_audio=False, stream=False, preload_audio=False)
-
-@app.route('/chat', methods=['POST'])
-def chat_endpoint():
+class SessionStore:
     """
-    Endpoint per interagire con il chatbot
-    Riceve un messaggio e restituisce la risposta del chatbot
+    Associa ogni sessione HTTP a una chat di ChatHistoryManager.
+    Ogni sessione ha il proprio lock, così due richieste sulla stessa chat non si sovrappongono.
     """
-    data = request.json
-    user_message = data.get('message', '')
-    
-    for token, full_response in chatbot.generate_response(user_message):
-        pass
-    
-    try:
-        # Chiama il metodo di generazione risposta del tuo chatbot
-        bot_response = full_response
-        
-        return jsonify({
-            'response': bot_response,
-            'status': 'success'\
-        }), 200
-    
-    except Exception as e:
-        return jsonify({
-            'error': str(e),
-            'status': 'error'
-        }), 500
 
-@app.route('/reset', methods=['POST'])
-def reset_conversation():
-    """
-    Endpoint per resettare la conversazione del chatbot
-    """
-    try:
-        # chatbot.reset_conversation()
-        return jsonify({
-            'message': 'Conversazione resettata',
+    def __init__(self, history_manager):
+        self.history_manager = history_manager
+        self.histories = {}
+        self.locks = {}
+
+    def get_lock(self, session_id: str) -> asyncio.Lock:
+        if session_id not in self.locks:
+            self.locks[session_id] = asyncio.Lock()
+        return self.locks[session_id]
+
+    def get_history(self, session_id: str):
+        history = self.histories.get(session_id)
+        if history is None:
+            try:
+                history = self.history_manager.load_history(session_id)
+            except ValueError:
+                history = self.history_manager.create_history(session_id)
+            self.histories[session_id] = history
+        return history
+
+    def reset(self, session_id: str):
+        self.get_history(session_id).clear()
+
+class ChatServer:
+    # Ogni quanto controllare se il client è ancora connesso mentre si attende la risposta
+    DISCONNECT_POLL_SECONDS = 0.25
+    # Richieste in corso per posto del batch, se non indicato: le eccedenti attendono nello scheduler
+    REQUESTS_PER_BATCH_SLOT = 4
+
+    def __init__(self, chatbot: Chatbot, max_concurrent_requests: int = None):
+        self.chatbot = chatbot
+        self.sessions = SessionStore(chatbot.history_manager)
+        # Con batch_size > 1 le sessioni concorrenti vengono decodificate insieme dallo scheduler.
+        # I worker sono più dei posti del batch: le richieste in attesa devono arrivare alla coda
+        # dello scheduler, dove valgono equità tra sessioni, priorità e aging, e non restare
+        # in ordine di arrivo nella coda dell'executor. Ogni worker resta bloccato su una richiesta.
+        # Senza scheduler un solo worker: il modello Llama non è thread-safe, le richieste
+        # vengono serializzate senza mai bloccare l'event loop
+        if chatbot.batch_size > 1:
+            workers = max_concurrent_requests or self.REQUESTS_PER_BATCH_SLOT * chatbot.batch_size
+        else:
+            workers = 1
+        self.model_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='llm')
+
+    async def chat_endpoint(self, request: web.Request):
+        """
+        Endpoint per interagire con il chatbot
+        Riceve un messaggio e restituisce la risposta del chatbot, in streaming (SSE) se richiesto
+        """
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return self._error("Richiesta non valida: è atteso un JSON", 400)
+        if not isinstance(data, dict):
+            return self._error("Richiesta non valida: è atteso un oggetto JSON", 400)
+
+        user_message = data.get('message', '')
+        session_id = self._get_session_id(data)
+        if session_id is None:
+            return self._error("session_id non valido", 400)
+        if not isinstance(user_message, str) or not user_message.strip():
+            return self._error("Il messaggio non può essere vuoto", 400)
+        # Modello per questa richiesta; senza, quello associato alla sessione o il predefinito
+        model = data.get('model')
+        if model is not None and model not in self.chatbot.models.models:
+            return self._error(f"Modello non valido. Deve essere uno tra: {', '.join(self.chatbot.models.models)}", 400)
+
+        if not self.chatbot.is_model_ready():
+            return web.json_response({
+                'error': 'Modello in caricamento',
+                'loading': self.chatbot.get_loading_status(),
+                'status': 'loading'
+            }, status=503, headers={'Retry-After': '5'})
+
+        stream = data.get('stream', False) or 'text/event-stream' in request.headers.get('Accept', '')
+
+        async with self.sessions.get_lock(session_id):
+            history = await asyncio.get_running_loop().run_in_executor(
+                None, self.sessions.get_history, session_id
+            )
+            if stream:
+                return await self._stream_response(request, user_message, session_id, history, model)
+
+            try:
+                full_response = ""
+                async with aclosing(self._generate(request, user_message, session_id, history, False, model)) as items:
+                    async for _, full_response in items:
+                        pass
+                return web.json_response({
+                    'response': full_response,
+                    'session_id': session_id,
+                    'status': 'success'
+                }, status=200)
+
+            except Exception as e:
+                return self._error(str(e), 500)
+
+    async def reset_conversation(self, request: web.Request):
+        """
+        Endpoint per resettare la conversazione di una sessione
+        """
+        try:
+            data = await request.json() if request.can_read_body else {}
+        except json.JSONDecodeError:
+            return self._error("Richiesta non valida: è atteso un JSON", 400)
+        if not isinstance(data, dict):
+            return self._error("Richiesta non valida: è atteso un oggetto JSON", 400)
+
+        session_id = self._get_session_id(data)
+        if session_id is None:
+            return self._error("session_id non valido", 400)
+
+        try:
+            async with self.sessions.get_lock(session_id):
+                await asyncio.get_running_loop().run_in_executor(None, self.sessions.reset, session_id)
+            return web.json_response({
+                'message': 'Conversazione resettata',
+                'session_id': session_id,
+                'status': 'success'
+            }, status=200)
+
+        except Exception as e:
+            return self._error(str(e), 500)
+
+    async def search_endpoint(self, request: web.Request):
+        """
+        Endpoint di ricerca full-text nei messaggi di tutte le chat
+        Parametri: q (testo), limit (default 20, massimo 100), session_id (opzionale, limita a una chat)
+        """
+        query = request.query.get('q', '')
+        if not query.strip():
+            return self._error("Il parametro q non può essere vuoto", 400)
+        try:
+            limit = min(max(int(request.query.get('limit', 20)), 1), 100)
+        except ValueError:
+            return self._error("limit deve essere un intero", 400)
+        chat = None
+        if 'session_id' in request.query:
+            chat = self._get_session_id(dict(request.query))
+            if chat is None:
+                return self._error("session_id non valido", 400)
+
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, self.chatbot.search_chats, query, limit, chat
+            )
+            return web.json_response({'results': results, 'status': 'success'}, status=200)
+        except Exception as e:
+            return self._error(str(e), 500)
+
+    async def models_endpoint(self, request: web.Request):
+        """
+        Endpoint con i modelli configurati, quelli caricati, la RAM usata e le sostituzioni in corso
+        """
+        return web.json_response({**self.chatbot.models.stats(), 'status': 'success'}, status=200)
+
+    async def swap_model_endpoint(self, request: web.Request):
+        """
+        Endpoint di amministrazione: ricarica un modello in background e lo sostituisce.
+        Le richieste in corso finiscono sulla vecchia istanza; lo stato si legge su /models.
+        Parametri: model, default (opzionale, lo rende il modello predefinito)
+        """
+        try:
+            data = await request.json()
+        except json.JSONDecodeError:
+            return self._error("Richiesta non valida: è atteso un JSON", 400)
+        if not isinstance(data, dict):
+            return self._error("Richiesta non valida: è atteso un oggetto JSON", 400)
+        model = data.get('model')
+        if model not in self.chatbot.models.models:
+            return self._error(f"Modello non valido. Deve essere uno tra: {', '.join(self.chatbot.models.models)}", 400)
+
+        try:
+            self.chatbot.swap_model(model, make_default=bool(data.get('default', False)))
+        except ValueError as e:
+            return self._error(str(e), 409)
+        return web.json_response({'model': model, 'swap': 'loading', 'status': 'success'}, status=202)
+
+    async def health_endpoint(self, request: web.Request):
+        """
+        Endpoint con lo stato di caricamento dei sottosistemi
+        """
+        return web.json_response({
+            'ready': self.chatbot.is_model_ready(),
+            'loading': self.chatbot.get_loading_status(),
             'status': 'success'
-        }), 200
-    
-    except Exception as e:
-        return jsonify({
-            'error': str(e),
+        }, status=200)
+
+    async def metrics_endpoint(self, request: web.Request):
+        """
+        Endpoint con gli istogrammi di latenza per fase, nel formato testuale di Prometheus
+        """
+        return web.Response(
+            body=metrics.render_prometheus().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    async def stats_endpoint(self, request: web.Request):
+        """
+        Endpoint con lo stato della coda di generazione (profondità e tempi di attesa),
+        i contatori della cache delle risposte e della decodifica speculativa
+        """
+        if not self.chatbot.is_model_ready():
+            return web.json_response({'scheduler': None, 'response_cache': None, 'speculative': None,
+                                      'status': 'success'}, status=200)
+        llm_manager = self.chatbot.llm_manager
+        scheduler = llm_manager.scheduler
+        return web.json_response({
+            'scheduler': scheduler.stats() if scheduler is not None else None,
+            'response_cache': llm_manager.get_cache_stats(),
+            'speculative': llm_manager.get_speculative_stats(),
+            'status': 'success'
+        }, status=200)
+
+    async def _stream_response(self, request, user_message, session_id, history, model):
+        response = web.StreamResponse(headers={
+            'Content-Type': 'text/event-stream',
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'
+        })
+        await response.prepare(request)
+
+        full_response = ""
+        try:
+            async with aclosing(self._generate(request, user_message, session_id, history, True, model)) as items:
+                async for token, full_response in items:
+                    if token:
+                        await response.write(self._sse_event('token', {'token': token}))
+            await response.write(self._sse_event('done', {'response': full_response}))
+        except ConnectionResetError:
+            # Client disconnesso: la generazione è già stata annullata da _generate
+            return response
+        except Exception as e:
+            await response.write(self._sse_event('error', {'error': str(e)}))
+
+        await response.write_eof()
+        return response
+
+    async def _generate(self, request, user_message, session_id, history, stream, model=None):
+        """
+        Esegue la generazione sul thread del modello e ne riporta i token sull'event loop.
+        Se il client si disconnette o il chiamante smette di leggere, la generazione viene
+        annullata e il modello si libera per le richieste in coda.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        cancel = CancellationToken()
+
+        def worker():
+            try:
+                for item in self.chatbot.generate_response(
+                    user_message, stream=stream, history=history, session_id=session_id, model=model, cancel=cancel
+                ):
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        future = loop.run_in_executor(self.model_executor, worker)
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(queue.get(), self.DISCONNECT_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    # Senza streaming non si scrive nulla fino alla fine: la disconnessione si controlla qui
+                    if self._client_disconnected(request):
+                        cancel.cancel()
+                    continue
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Uscita anticipata (client disconnesso, errore di scrittura, handler annullato)
+            if not future.done():
+                cancel.cancel()
+        await future
+
+    def _client_disconnected(self, request) -> bool:
+        transport = request.transport
+        return transport is None or transport.is_closing()
+
+    def _get_session_id(self, data: dict):
+        session_id = data.get('session_id', 'default')
+        if not isinstance(session_id, str) or not SESSION_ID_PATTERN.match(session_id):
+            return None
+        return session_id
+
+    def _sse_event(self, event: str, data: dict) -> bytes:
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode('utf-8')
+
+    def _error(self, message: str, status: int):
+        return web.json_response({
+            'error': message,
             'status': 'error'
-        }), 500
+        }, status=status)
+
+def create_app(chatbot: Chatbot = None, batch_size: int = 1, llm_options: dict = None,
+               default_model: str = None, model_ram_budget: int = None,
+               max_concurrent_requests: int = None) -> web.Application:
+    # Il Chatbot carica il modello in background: il server risponde subito (503 su /chat finché non è pronto)
+    server = ChatServer(chatbot or Chatbot(use_audio=False, stream=True, preload_audio=False,
+                                           batch_size=batch_size, llm_options=llm_options,
+                                           default_model=default_model, model_ram_budget=model_ram_budget),
+                        max_concurrent_requests)
+    app = web.Application()
+    app['server'] = server
+    app.router.add_post('/chat', server.chat_endpoint)
+    app.router.add_post('/reset', server.reset_conversation)
+    app.router.add_get('/search', server.search_endpoint)
+    app.router.add_get('/stats', server.stats_endpoint)
+    app.router.add_get('/health', server.health_endpoint)
+    app.router.add_get('/metrics', server.metrics_endpoint)
+    app.router.add_get('/models', server.models_endpoint)
+    app.router.add_post('/models/swap', server.swap_model_endpoint)
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000)
\ No newline at end of file
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help="sessioni decodificate insieme dallo scheduler (1 = nessuno scheduler)")
+    parser.add_argument('--max-concurrent-requests', type=int, default=None,
+                        help="richieste accettate insieme con lo scheduler; le eccedenti attendono "
+                             "nella sua coda (predefinito: 4 × batch-size)")
+    parser.add_argument('--response-cache', type=int, default=0, metavar='N',
+                        help="risposte tenute in memoria dalla cache (0 = cache disattivata)")
+    parser.add_argument('--response-cache-dir', default=None,
+                        help="cartella per il livello su disco della cache delle risposte")
+    parser.add_argument('--response-cache-ttl', type=float, default=3600,
+                        help="secondi di validità di una risposta in cache")
+    parser.add_argument('--cache-nondeterministic', action='store_true',
+                        help="usa la cache anche con temperatura > 0")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="disattiva gli istogrammi di latenza esposti su /metrics")
+    parser.add_argument('--speculative', choices=['none', 'prompt_lookup', 'draft_model'], default=None,
+                        help="decodifica speculativa (predefinita: sezione speculative della config)")
+    parser.add_argument('--draft-tokens', type=int, default=10,
+                        help="token proposti a ogni passo della decodifica speculativa")
+    parser.add_argument('--model', default=None,
+                        help="modello predefinito, tra i moduli config/config_<nome>.py")
+    parser.add_argument('--model-ram-gb', type=float, default=None,
+                        help="RAM per i modelli caricati insieme; oltre vengono chiusi i meno usati")
+    args = parser.parse_args()
+    if args.max_concurrent_requests is not None and args.max_concurrent_requests < args.batch_size:
+        parser.error("--max-concurrent-requests deve essere almeno pari a --batch-size")
+    metrics.enable(not args.no_metrics)
+
+    llm_options = {}
+    if args.response_cache > 0:
+        from chat.response_cache import ResponseCache
+        llm_options['response_cache'] = ResponseCache(
+            max_entries=args.response_cache,
+            ttl_seconds=args.response_cache_ttl,
+            disk_dir=args.response_cache_dir
+        )
+        llm_options['cache_nondeterministic'] = args.cache_nondeterministic
+    if args.speculative is not None:
+        llm_options['speculative'] = {'mode': args.speculative, 'num_pred_tokens': args.draft_tokens}
+    model_ram_budget = int(args.model_ram_gb * (1 << 30)) if args.model_ram_gb else None
+    web.run_app(create_app(batch_size=args.batch_size, llm_options=llm_options,
+                           default_model=args.model, model_ram_budget=model_ram_budget,
+                           max_concurrent_requests=args.max_concurrent_requests), port=args.port)
@@ -1,9 +1,20 @@
+import queue
+import threading
+import time
+
 import pyttsx3
 
+import metrics
+
 class AudioPlayer:
     def __init__(self):
         self.engine = None
         self._initialize_engine()
+        # Coda di riproduzione: le frasi vengono pronunciate in ordine da un solo worker
+        self._queue = queue.Queue()
+        self._worker = None
+        self._generation = 0
+        self._lock = threading.Lock()
 
     def _initialize_engine(self):
         self.engine = pyttsx3.init()
@@ -18,21 +29,62 @@ class AudioPlayer:
         Args:
             text (str): Il testo da convertire in audio
         """
-        try:
-            self.engine.say(text)
-            self.engine.runAndWait()
-        except Exception as e:
-            print(f"Errore durante la riproduzione audio: {e}")
-            
+        self.enqueue(text)
+        self.wait_until_done()
+
+    def enqueue(self, text: str, on_start=None):
+        """
+        Accoda il testo per la riproduzione e ritorna subito
+        Args:
+            text (str): Il testo da convertire in audio
+            on_start: callback chiamato quando inizia la riproduzione di questo testo
+        """
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='tts', daemon=True)
+                self._worker.start()
+            self._queue.put((self._generation, text, on_start))
+
+    def wait_until_done(self):
+        """
+        Attende che tutte le frasi accodate siano state riprodotte (o annullate)
+        """
+        self._queue.join()
+
     def stop(self):
         """
-        Ferma la riproduzione audio in corso
+        Ferma la riproduzione audio in corso e scarta le frasi in coda (barge-in)
         """
+        with self._lock:
+            self._generation += 1
+        try:
+            while True:
+                self._queue.get_nowait()
+                self._queue.task_done()
+        except queue.Empty:
+            pass
         try:
             self.engine.stop()
         except Exception as e:
             print(f"Errore durante l'arresto della riproduzione: {e}")
 
+    def _run(self):
+        while True:
+            generation, text, on_start = self._queue.get()
+            try:
+                # Le frasi accodate prima di uno stop() vengono scartate
+                if generation != self._generation:
+                    continue
+                if on_start is not None:
+                    on_start(time.monotonic())
+                with metrics.timer('tts_play_seconds'):
+                    self.engine.say(text)
+                    self.engine.runAndWait()
+            except Exception as e:
+                print(f"Errore durante la riproduzione audio: {e}")
+            finally:
+                self._queue.task_done()
+
     def __del__(self):
         """
         Cleanup del motore TTS quando l'oggetto viene distrutto
@@ -41,4 +93,4 @@ class AudioPlayer:
             try:
                 self.engine.stop()
             except:
-                pass 
\ No newline at end of file
+                pass
@@ -1,46 +1,200 @@
-import pyaudio
+import threading
 import wave
-import os
 
-class AudioRecorder:
-    def __init__(self):
-        self.CHUNK = 1024
-        self.FORMAT = pyaudio.paInt16
-        self.CHANNELS = 1
-        self.RATE = 44100
-        self.RECORD_SECONDS = 5
-        self.WAVE_OUTPUT_FILENAME = "voice.wav"
-
-    def record(self):
-        p = pyaudio.PyAudio()
-        stream = p.open(
-            format=self.FORMAT,
-            channels=self.CHANNELS,
-            rate=self.RATE,
+import numpy as np
+
+from .vad import EnergyVAD
+
+class PyAudioInputSource:
+    """Microfono: un solo stream di input resta aperto e viene messo in pausa tra le registrazioni"""
+
+    def __init__(self, sample_rate: int = 16000, frames_per_buffer: int = 480):
+        import pyaudio
+        self.sample_rate = sample_rate
+        self.audio = pyaudio.PyAudio()
+        self.stream = self.audio.open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=sample_rate,
             input=True,
-            frames_per_buffer=self.CHUNK
+            frames_per_buffer=frames_per_buffer,
+            start=False
         )
 
+    def start(self):
+        if self.stream.is_stopped():
+            self.stream.start_stream()
+
+    def stop(self):
+        if not self.stream.is_stopped():
+            self.stream.stop_stream()
+
+    def read(self, num_samples: int) -> np.ndarray:
+        data = self.stream.read(num_samples, exception_on_overflow=False)
+        return np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+
+    def close(self):
+        self.stream.close()
+        self.audio.terminate()
+
+class WavFileInputSource:
+    """Sorgente da file WAV mono 16 bit, per provare la pipeline senza microfono"""
+
+    def __init__(self, path: str, sample_rate: int = 16000):
+        with wave.open(path, 'rb') as wf:
+            if wf.getsampwidth() != 2:
+                raise ValueError("Sono supportati solo WAV a 16 bit")
+            samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+            channels = wf.getnchannels()
+            file_rate = wf.getframerate()
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.float32) / 32768.0
+        if file_rate != sample_rate:
+            # Ricampionamento lineare: sufficiente per i fixture di test
+            duration = len(samples) / file_rate
+            target = np.linspace(0, duration, int(duration * sample_rate), endpoint=False)
+            samples = np.interp(target, np.arange(len(samples)) / file_rate, samples).astype(np.float32)
+        self.sample_rate = sample_rate
+        self.samples = samples
+        self.position = 0
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def read(self, num_samples: int) -> np.ndarray:
+        frame = self.samples[self.position:self.position + num_samples]
+        self.position += num_samples
+        if len(frame) < num_samples:
+            # Oltre la fine del file si legge silenzio, come da un microfono muto
+            frame = np.concatenate([frame, np.zeros(num_samples - len(frame), dtype=np.float32)])
+        return frame
+
+    def close(self):
+        pass
+
+class RingBuffer:
+    """Buffer circolare di campioni float32 di capacità fissa"""
+
+    def __init__(self, capacity: int):
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.total_written = 0
+        # Il buffer viene letto anche dal thread della trascrizione in streaming
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self.total_written = 0
+
+    def write(self, samples: np.ndarray):
+        with self._lock:
+            self._write(samples)
+
+    def since(self, position: int) -> np.ndarray:
+        """Campioni scritti dalla posizione assoluta indicata (limitati alla capacità)"""
+        with self._lock:
+            return self._since(position)
+
+    def _write(self, samples: np.ndarray):
+        samples = samples[-self.capacity:]
+        start = self.total_written % self.capacity
+        end = start + len(samples)
+        if end <= self.capacity:
+            self.buffer[start:end] = samples
+        else:
+            split = self.capacity - start
+            self.buffer[start:] = samples[:split]
+            self.buffer[:end - self.capacity] = samples[split:]
+        self.total_written += len(samples)
+
+    def _since(self, position: int) -> np.ndarray:
+        position = max(position, self.total_written - self.capacity, 0)
+        count = self.total_written - position
+        start = position % self.capacity
+        if start + count <= self.capacity:
+            return self.buffer[start:start + count].copy()
+        return np.concatenate([self.buffer[start:], self.buffer[:start + count - self.capacity]])
+
+class AudioRecorder:
+    """
+    Registra una frase dal microfono a 16 kHz mono e si ferma quando l'utente smette di parlare.
+    Restituisce direttamente l'array float32 da passare a WhisperModel.transcribe.
+    """
+
+    def __init__(self, source=None, vad: EnergyVAD = None, sample_rate: int = 16000,
+                 frame_ms: int = 30, silence_seconds: float = 0.8, max_seconds: float = 30.0,
+                 no_speech_timeout: float = 5.0, preroll_seconds: float = 0.3):
+        self.RATE = sample_rate
+        self.CHUNK = sample_rate * frame_ms // 1000
+        self.silence_seconds = silence_seconds
+        self.max_seconds = max_seconds
+        self.no_speech_timeout = no_speech_timeout
+        self.preroll_seconds = preroll_seconds
+        self.vad = vad or EnergyVAD()
+        self._source = source
+        self.buffer = RingBuffer(int(sample_rate * (max_seconds + no_speech_timeout)))
+
+    @property
+    def source(self):
+        # Il microfono viene aperto alla prima registrazione e poi riutilizzato
+        if self._source is None:
+            self._source = PyAudioInputSource(self.RATE, self.CHUNK)
+        return self._source
+
+    def record(self, on_frame=None) -> np.ndarray:
+        """
+        Registra finché il VAD non rileva la fine del parlato.
+        on_frame(buffer, speech_start), se fornito, viene chiamato dopo ogni frame.
+        """
+        source = self.source
+        frame_seconds = self.CHUNK / self.RATE
+        silence_frames_limit = int(self.silence_seconds / frame_seconds)
+        max_frames = int(self.max_seconds / frame_seconds)
+        timeout_frames = int(self.no_speech_timeout / frame_seconds)
+        preroll = int(self.preroll_seconds * self.RATE)
+
+        self.buffer.clear()
+        # Il rumore di fondo si stima da capo: quello della registrazione precedente può essere cambiato
+        self.vad.reset()
+        speech_start = None
+        silence_frames = 0
+        frames = 0
+
         print("* recording")
-        frames = []
+        source.start()
+        try:
+            while True:
+                frame = source.read(self.CHUNK)
+                self.buffer.write(frame)
+                frames += 1
 
-        for i in range(0, int(self.RATE / self.CHUNK * self.RECORD_SECONDS)):
-            data = stream.read(self.CHUNK)
-            frames.append(data)
+                if self.vad.is_speech(frame):
+                    if speech_start is None:
+                        speech_start = max(self.buffer.total_written - len(frame) - preroll, 0)
+                    silence_frames = 0
+                elif speech_start is not None:
+                    silence_frames += 1
 
-        print("* done recording")
+                if on_frame is not None:
+                    on_frame(self.buffer, speech_start)
 
-        stream.stop_stream()
-        stream.close()
-        p.terminate()
+                if speech_start is None and frames >= timeout_frames:
+                    break
+                if speech_start is not None and silence_frames >= silence_frames_limit:
+                    break
+                if speech_start is not None and frames >= max_frames:
+                    break
+        finally:
+            source.stop()
+        print("* done recording")
 
-        self._save_wave_file(frames, p)
-        return self.WAVE_OUTPUT_FILENAME
+        if speech_start is None:
+            return np.zeros(0, dtype=np.float32)
+        return self.buffer.since(speech_start)
 
-    def _save_wave_file(self, frames, p):
-        wf = wave.open(self.WAVE_OUTPUT_FILENAME, "wb")
-        wf.setnchannels(self.CHANNELS)
-        wf.setsampwidth(p.get_sample_size(self.FORMAT))
-        wf.setframerate(self.RATE)
-        wf.writeframes(b"".join(frames))
-        wf.close() 
\ No newline at end of file
+    def close(self):
+        if self._source is not None:
+            self._source.close()
+            self._source = None
@@ -0,0 +1,101 @@
+import re
+import time
+
+# Fine frase: punteggiatura forte seguita da spazio, oppure un a capo
+SENTENCE_END = re.compile(r'[.!?;:…]+["\')\]»]*\s+|\n+')
+# Fine proposizione: usata solo per spezzare frasi troppo lunghe
+CLAUSE_END = re.compile(r'[,–—]\s+')
+
+class SentenceSplitter:
+    """
+    Divide il testo in streaming in frasi pronte per la sintesi vocale.
+    Il primo blocco può essere più corto, così l'audio parte il prima possibile.
+    """
+
+    def __init__(self, first_min_chars: int = 8, min_chars: int = 20, max_chars: int = 200):
+        self.first_min_chars = first_min_chars
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.buffer = ""
+        self.emitted = 0
+
+    def feed(self, text: str) -> list:
+        self.buffer += text
+        sentences = []
+        while True:
+            sentence = self._next_sentence()
+            if sentence is None:
+                break
+            if sentence.strip():
+                sentences.append(sentence.strip())
+                self.emitted += 1
+        return sentences
+
+    def flush(self) -> list:
+        remainder = self.buffer.strip()
+        self.buffer = ""
+        return [remainder] if remainder else []
+
+    def _next_sentence(self):
+        min_chars = self.first_min_chars if self.emitted == 0 else self.min_chars
+        for match in SENTENCE_END.finditer(self.buffer):
+            if match.end() >= min_chars:
+                return self._cut(match.end())
+
+        if len(self.buffer) > self.max_chars:
+            # Frase troppo lunga: si spezza all'ultima virgola, altrimenti all'ultimo spazio
+            clause_ends = [match.end() for match in CLAUSE_END.finditer(self.buffer, 0, self.max_chars)]
+            if clause_ends:
+                return self._cut(clause_ends[-1])
+            space = self.buffer.rfind(' ', 0, self.max_chars)
+            return self._cut(space + 1 if space > 0 else self.max_chars)
+        return None
+
+    def _cut(self, position: int) -> str:
+        sentence = self.buffer[:position]
+        self.buffer = self.buffer[position:]
+        return sentence
+
+class SpeechPipeline:
+    """
+    Pronuncia la risposta mentre i token arrivano ancora.
+
+    I token vengono raggruppati in frasi e accodate all'AudioPlayer, che le sintetizza
+    in background: l'audio parte dopo la prima frase invece che a fine generazione.
+    cancel() interrompe subito la riproduzione (barge-in).
+    """
+
+    def __init__(self, player, splitter: SentenceSplitter = None):
+        self.player = player
+        self.splitter = splitter or SentenceSplitter()
+        self.started_at = time.monotonic()
+        self.first_audio_at = None
+
+    @property
+    def time_to_first_audio(self):
+        """Secondi tra l'inizio della risposta e l'inizio del primo audio (None se non ancora partito)"""
+        if self.first_audio_at is None:
+            return None
+        return self.first_audio_at - self.started_at
+
+    def feed(self, token: str):
+        for sentence in self.splitter.feed(token):
+            self._speak(sentence)
+
+    def finish(self, wait: bool = True):
+        """Pronuncia il testo rimasto; con wait attende la fine della riproduzione"""
+        for sentence in self.splitter.flush():
+            self._speak(sentence)
+        if wait:
+            self.player.wait_until_done()
+
+    def cancel(self):
+        self.splitter.flush()
+        self.player.stop()
+
+    def _speak(self, sentence: str):
+        self.player.enqueue(sentence, on_start=self._on_audio_start)
+
+    def _on_audio_start(self, timestamp: float):
+        if self.first_audio_at is None:
+            self.first_audio_at = timestamp
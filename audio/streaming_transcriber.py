@@ -0,0 +1,115 @@
+import threading
+
+class StreamingTranscriber:
+    """
+    Trascrizione incrementale mentre l'utente sta ancora parlando.
+
+    A intervalli fissi ridecodifica la finestra di audio non ancora confermata e confronta
+    l'ipotesi con quella precedente: le parole iniziali su cui due decodifiche consecutive
+    concordano vengono confermate e la finestra riparte dalla fine dell'ultima parola
+    confermata. A fine registrazione resta da decodificare solo la coda non confermata.
+
+    on_partial(confermato, provvisorio) riceve il testo dopo ogni decodifica.
+    """
+
+    def __init__(self, transcriber, on_partial=None, sample_rate: int = 16000,
+                 interval: float = 0.5, max_window_seconds: float = 15.0, min_audio_seconds: float = 0.5):
+        self.transcriber = transcriber
+        self.on_partial = on_partial
+        self.sample_rate = sample_rate
+        self.interval = interval
+        self.max_window_seconds = max_window_seconds
+        self.min_audio_seconds = min_audio_seconds
+        self._buffer = None
+        self._speech_start = None
+        self._offset = None
+        self._committed = []
+        self._previous = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._decode_lock = threading.Lock()
+
+    def start(self):
+        self._buffer = None
+        self._speech_start = None
+        self._offset = None
+        self._committed = []
+        self._previous = []
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='streaming-stt', daemon=True)
+        self._thread.start()
+
+    def on_frame(self, buffer, speech_start):
+        """Da passare ad AudioRecorder.record: riceve il buffer e l'inizio del parlato"""
+        self._buffer = buffer
+        self._speech_start = speech_start
+
+    def finish(self) -> str:
+        """Ferma le decodifiche parziali e trascrive la coda non ancora confermata"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._buffer is None or self._speech_start is None:
+            return ""
+
+        with self._decode_lock:
+            offset = self._get_offset()
+            audio = self._buffer.since(offset)
+            tail = self.transcriber.transcribe(audio) if len(audio) else ""
+        text = (self.committed_text() + tail).strip()
+        if self.on_partial is not None:
+            self.on_partial(text, "")
+        return text
+
+    def committed_text(self) -> str:
+        return "".join(word for word, _, _ in self._committed)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self._buffer is None or self._speech_start is None:
+                continue
+            try:
+                self._decode_partial()
+            except Exception as e:
+                print(f"Errore durante la trascrizione parziale: {e}")
+
+    def _get_offset(self) -> int:
+        if self._offset is None or self._offset < self._speech_start:
+            return self._speech_start
+        return self._offset
+
+    def _decode_partial(self):
+        with self._decode_lock:
+            offset = self._get_offset()
+            audio = self._buffer.since(offset)
+            if len(audio) < self.min_audio_seconds * self.sample_rate:
+                return
+
+            words = [
+                (word, offset + int(start * self.sample_rate), offset + int(end * self.sample_rate))
+                for word, start, end in self.transcriber.transcribe_words(
+                    audio, initial_prompt=self.committed_text() or None
+                )
+            ]
+
+            # Prefisso comune con l'ipotesi precedente: è stabile e si può confermare
+            agreed = 0
+            while (agreed < len(words) and agreed < len(self._previous)
+                   and self._normalize(words[agreed][0]) == self._normalize(self._previous[agreed][0])):
+                agreed += 1
+
+            # Finestra troppo lunga senza accordo: conferma tutto tranne le ultime parole
+            if agreed == 0 and len(audio) > self.max_window_seconds * self.sample_rate:
+                agreed = max(len(words) - 2, 0)
+
+            if agreed:
+                self._committed.extend(words[:agreed])
+                self._offset = words[agreed - 1][2]
+            self._previous = words[agreed:]
+
+        if self.on_partial is not None:
+            tentative = "".join(word for word, _, _ in self._previous)
+            self.on_partial(self.committed_text(), tentative)
+
+    def _normalize(self, word: str) -> str:
+        return word.strip().lower().strip('.,;:!?')
@@ -1,27 +1,124 @@
 from faster_whisper import WhisperModel
 import os
+import queue
+import threading
+import time
+
+import metrics
+
+# Un solo modello Whisper per processo per ogni configurazione, condiviso tra i transcriber
+_shared_models = {}
+_shared_models_lock = threading.Lock()
+
+def select_backend(device="auto", compute_type="auto"):
+    """
+    Sceglie device e compute type in base all'hardware disponibile:
+    float16 su GPU CUDA, int8 su CPU.
+    """
+    if device == "auto":
+        try:
+            import ctranslate2
+            device = "cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu"
+        except Exception:
+            device = "cpu"
+    if compute_type == "auto":
+        compute_type = "float16" if device == "cuda" else "int8"
+    return device, compute_type
+
+def get_shared_model(model_type, device, compute_type, cpu_threads=0, num_workers=1):
+    key = (model_type, device, compute_type, cpu_threads, num_workers)
+    with _shared_models_lock:
+        if key not in _shared_models:
+            _shared_models[key] = WhisperModel(
+                model_type,
+                device=device,
+                compute_type=compute_type,
+                cpu_threads=cpu_threads,
+                num_workers=num_workers
+            )
+        return _shared_models[key]
 
 class AudioTranscriber:
-    def __init__(self, model_type="base", device="cuda", compute_type="float16"):
+    def __init__(self, model_type="base", device="auto", compute_type="auto",
+                 cpu_threads=0, num_workers=1, beam_size=5):
+        """
+        Args:
+            device, compute_type: "auto" sceglie in base all'hardware (cuda/float16 o cpu/int8)
+            cpu_threads: thread usati su CPU (0 = default di CTranslate2)
+            num_workers: trascrizioni che il modello può eseguire in parallelo (usato dal batch)
+        """
         self.model = None
         self.model_type = model_type
-        self.device = device
-        self.compute_type = compute_type
+        self.device, self.compute_type = select_backend(device, compute_type)
+        self.cpu_threads = cpu_threads
+        self.num_workers = num_workers
+        self.beam_size = beam_size
 
     def load_model(self):
         if self.model is None:
-            self.model = WhisperModel(
+            self.model = get_shared_model(
                 self.model_type,
-                device=self.device,
-                compute_type=self.compute_type
+                self.device,
+                self.compute_type,
+                self.cpu_threads,
+                self.num_workers
+            )
+
+    def transcribe(self, audio):
+        """
+        Trascrive l'audio registrato
+        Args:
+            audio: array float32 mono a 16 kHz (da AudioRecorder) oppure percorso di un file audio,
+                   che viene eliminato dopo la trascrizione
+        """
+        with metrics.timer('stt_transcribe_seconds'):
+            return self._transcribe(audio)
+
+    def _transcribe(self, audio):
+        if isinstance(audio, str):
+            return self._transcribe_file(audio)
+        if len(audio) == 0:
+            return ""
+
+        self.load_model()
+        segments, info = self.model.transcribe(
+            audio,
+            vad_filter=True,
+            beam_size=self.beam_size,
+            language="it"
+        )
+        return "".join(segment.text for segment in segments)
+
+    def transcribe_words(self, audio, initial_prompt=None, beam_size=1):
+        """
+        Trascrizione veloce con timestamp per parola, usata per le ipotesi parziali in streaming.
+        Restituisce una lista di (parola, inizio_s, fine_s) relativi all'inizio dell'audio.
+        """
+        if len(audio) == 0:
+            return []
+
+        with metrics.timer('stt_partial_seconds'):
+            self.load_model()
+            segments, info = self.model.transcribe(
+                audio,
+                beam_size=beam_size,
+                language="it",
+                word_timestamps=True,
+                initial_prompt=initial_prompt,
+                condition_on_previous_text=False
             )
+            words = []
+            for segment in segments:
+                for word in segment.words or []:
+                    words.append((word.word, word.start, word.end))
+        return words
 
-    def transcribe(self, audio_file):
+    def _transcribe_file(self, audio_file):
         self.load_model()
         segments, info = self.model.transcribe(
             audio_file,
             vad_filter=True,
-            beam_size=5,
+            beam_size=self.beam_size,
             language="it"
         )
 
@@ -34,4 +131,83 @@ class AudioTranscriber:
         except:
             print("Error deleting file")
 
-        return text 
\ No newline at end of file
+        return text 
+
+    def transcribe_batch(self, items, num_workers=None, queue_size=8):
+        """
+        Trascrive in blocco una lista di file audio o array float32 a 16 kHz.
+        I file non vengono eliminati. I risultati mantengono l'ordine di ingresso e riportano
+        per ogni elemento la durata dell'audio, il tempo impiegato e il real-time factor
+        (tempo di trascrizione / durata: < 1 significa più veloce del tempo reale).
+        """
+        self.load_model()
+        num_workers = num_workers or self.num_workers
+        # Coda limitata: il produttore si ferma se i worker sono indietro
+        work_queue = queue.Queue(maxsize=queue_size)
+        results = [None] * len(items)
+
+        def worker():
+            while True:
+                job = work_queue.get()
+                try:
+                    if job is None:
+                        return
+                    index, item = job
+                    results[index] = self._transcribe_item(item)
+                finally:
+                    work_queue.task_done()
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(num_workers)]
+        for thread in threads:
+            thread.start()
+        for index, item in enumerate(items):
+            work_queue.put((index, item))
+        for _ in threads:
+            work_queue.put(None)
+        for thread in threads:
+            thread.join()
+        return results
+
+    def _transcribe_item(self, item):
+        source = item if isinstance(item, str) else f"array[{len(item)}]"
+        start = time.perf_counter()
+        try:
+            segments, info = self.model.transcribe(
+                item,
+                vad_filter=True,
+                beam_size=self.beam_size,
+                language="it"
+            )
+            text = "".join(segment.text for segment in segments)
+        except Exception as e:
+            return {'source': source, 'text': None, 'error': str(e)}
+        elapsed = time.perf_counter() - start
+        return {
+            'source': source,
+            'text': text,
+            'duration': info.duration,
+            'elapsed': elapsed,
+            'rtf': elapsed / info.duration if info.duration else None
+        }
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Trascrizione in blocco di file audio")
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--model', default="base")
+    parser.add_argument('--device', default="auto")
+    parser.add_argument('--compute-type', default="auto")
+    parser.add_argument('--cpu-threads', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--beam-size', type=int, default=5)
+    args = parser.parse_args()
+
+    transcriber = AudioTranscriber(args.model, args.device, args.compute_type,
+                                   args.cpu_threads, args.workers, args.beam_size)
+    print(f"Backend: {transcriber.device}/{transcriber.compute_type}")
+    for result in transcriber.transcribe_batch(args.files):
+        if result['text'] is None:
+            print(f"{result['source']}: errore: {result['error']}")
+        else:
+            rtf = f"{result['rtf']:.2f}" if result['rtf'] is not None else "-"
+            print(f"{result['source']} ({result['duration']:.1f} s, RTF {rtf}): {result['text'].strip()}")
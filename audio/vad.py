@@ -0,0 +1,30 @@
+import numpy as np
+
+class EnergyVAD:
+    """
+    Voice activity detection basata sull'energia dei frame.
+
+    La soglia si adatta al rumore di fondo: il livello medio dei frame di silenzio viene
+    seguito con una media mobile e un frame è parlato se la sua energia lo supera di
+    speech_ratio volte (e comunque supera min_rms).
+    """
+
+    def __init__(self, speech_ratio: float = 3.0, min_rms: float = 0.01, noise_adaptation: float = 0.05):
+        self.speech_ratio = speech_ratio
+        self.min_rms = min_rms
+        self.noise_adaptation = noise_adaptation
+        self.noise_floor = None
+
+    def reset(self):
+        self.noise_floor = None
+
+    def is_speech(self, frame: np.ndarray) -> bool:
+        rms = float(np.sqrt(np.mean(np.square(frame)))) if len(frame) else 0.0
+        if self.noise_floor is None:
+            # Non oltre min_rms: se l'utente parla già al primo frame la soglia non parte dal livello della voce
+            self.noise_floor = min(rms, self.min_rms)
+
+        speech = rms > max(self.min_rms, self.noise_floor * self.speech_ratio)
+        if not speech:
+            self.noise_floor += self.noise_adaptation * (rms - self.noise_floor)
+        return speech
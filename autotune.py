@@ -0,0 +1,135 @@
+"""
+Misura le impostazioni di thread e batch di llama.cpp su questo host e salva il profilo
+che LLMManager applica al caricamento del modello.
+
+La ricerca procede per fasi, ricaricando il modello per ogni combinazione:
+1. n_threads: velocità di decodifica (un token per volta)
+2. n_threads_batch: velocità del prefill, con n_batch e n_ubatch della config
+3. n_batch e n_ubatch: velocità del prefill con il miglior n_threads_batch
+
+Uso: python autotune.py [--model NOME] [--model-path piccolo.gguf] [--quick]
+"""
+import argparse
+import os
+import time
+
+from llama_cpp import Llama
+
+from chat.model_registry import ModelRegistry, discover_models, load_model_config
+from chat.tuning import TUNABLE_PARAMS, base_load_params, model_id, save_profile
+
+TEXT = ("Il sistema riceve la richiesta dell'utente, recupera la cronologia della chat, "
+        "costruisce il prompt e genera la risposta un token alla volta. ")
+
+def thread_candidates(maximum: int) -> list:
+    candidates = {1, maximum, max(maximum // 2, 1)}
+    value = 2
+    while value < maximum:
+        candidates.add(value)
+        value *= 2
+    return sorted(candidates)
+
+def measure(model_path: str, params: dict, prompt_tokens: int, decode_tokens: int, repeat: int) -> dict:
+    """Token/s di prefill e di decodifica con i parametri indicati (migliore di repeat misure)"""
+    llm = Llama(model_path=model_path, verbose=False, **params)
+    try:
+        tokens = llm.tokenize(TEXT.encode('utf-8'), add_bos=False)
+        prompt = [llm.token_bos()] + (tokens * (prompt_tokens // len(tokens) + 1))[:prompt_tokens - 1]
+        continuation = (tokens * (decode_tokens // len(tokens) + 1))[:decode_tokens]
+        prefill = []
+        decode = []
+        # La prima ripetizione riscalda cache e thread e non viene contata
+        for index in range(repeat + 1):
+            llm.reset()
+            start = time.perf_counter()
+            llm.eval(prompt)
+            prefill_seconds = time.perf_counter() - start
+            # La decodifica valuta un token per passo: il costo non dipende da quale token sia
+            start = time.perf_counter()
+            for token in continuation:
+                llm.eval([token])
+            decode_seconds = time.perf_counter() - start
+            if index > 0:
+                prefill.append(len(prompt) / prefill_seconds)
+                decode.append(decode_tokens / decode_seconds)
+    finally:
+        if hasattr(llm, 'close'):
+            llm.close()
+    return {'prefill_tokens_per_second': max(prefill), 'decode_tokens_per_second': max(decode)}
+
+def run_trial(args, model_path: str, base_params: dict, overrides: dict, trials: list) -> dict:
+    params = {**base_params, **overrides}
+    result = measure(model_path, params, args.prompt_tokens, args.decode_tokens, args.repeat)
+    trial = {'params': {key: params.get(key) for key in TUNABLE_PARAMS},
+             **result}
+    trials.append(trial)
+    print(f"  {trial['params']}  prefill {result['prefill_tokens_per_second']:8.1f} tok/s"
+          f"  decodifica {result['decode_tokens_per_second']:6.1f} tok/s")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', choices=discover_models(), default=None,
+                        help="modello da misurare, tra i moduli config/config_<nome>.py (predefinito del registro)")
+    parser.add_argument('--model-path', default=None,
+                        help="file GGUF da usare al posto di quello configurato (es. un modello di test)")
+    parser.add_argument('--threads', type=int, nargs='+', default=None,
+                        help="valori di n_threads e n_threads_batch da provare")
+    parser.add_argument('--batches', type=int, nargs='+', default=[128, 256, 512, 1024])
+    parser.add_argument('--ubatches', type=int, nargs='+', default=[128, 256, 512])
+    parser.add_argument('--prompt-tokens', type=int, default=512)
+    parser.add_argument('--decode-tokens', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=2)
+    parser.add_argument('--quick', action='store_true', help="misure più brevi, per una prova rapida")
+    parser.add_argument('--output-dir', default='tuned_profiles', help="cartella dei profili (tuning_dir di LLMManager)")
+    parser.add_argument('--dry-run', action='store_true', help="non salva il profilo")
+    args = parser.parse_args()
+    if args.quick:
+        args.prompt_tokens, args.decode_tokens, args.repeat = 128, 16, 1
+
+    name = args.model or ModelRegistry(factory=None).default
+    model_config, model_path = load_model_config(name)
+    model_path = args.model_path or model_path
+    base_params = base_load_params(model_config)
+    n_ctx = base_params['n_ctx']
+    args.prompt_tokens = min(args.prompt_tokens, n_ctx - args.decode_tokens)
+    threads = args.threads or thread_candidates(os.cpu_count() or 1)
+    batches = sorted({min(batch, n_ctx) for batch in args.batches})
+    trials = []
+    print(f"Modello {name}: {model_path} (n_ctx {n_ctx}), thread da provare {threads}")
+
+    print("Fase 1: n_threads (decodifica)")
+    decode = {value: run_trial(args, model_path, base_params, {'n_threads': value, 'n_threads_batch': value}, trials)
+              for value in threads}
+    n_threads = max(decode, key=lambda value: decode[value]['decode_tokens_per_second'])
+
+    print("Fase 2: n_threads_batch (prefill)")
+    prefill = {value: decode[value] if value == n_threads else
+               run_trial(args, model_path, base_params, {'n_threads': n_threads, 'n_threads_batch': value}, trials)
+               for value in threads}
+    n_threads_batch = max(prefill, key=lambda value: prefill[value]['prefill_tokens_per_second'])
+
+    print("Fase 3: n_batch e n_ubatch (prefill)")
+    batch_results = {}
+    for n_batch in batches:
+        for n_ubatch in sorted({min(ubatch, n_batch) for ubatch in args.ubatches}):
+            batch_results[(n_batch, n_ubatch)] = run_trial(args, model_path, base_params, {
+                'n_threads': n_threads, 'n_threads_batch': n_threads_batch,
+                'n_batch': n_batch, 'n_ubatch': n_ubatch
+            }, trials)
+    n_batch, n_ubatch = max(batch_results, key=lambda key: batch_results[key]['prefill_tokens_per_second'])
+
+    params = {'n_threads': n_threads, 'n_threads_batch': n_threads_batch, 'n_batch': n_batch, 'n_ubatch': n_ubatch}
+    measurements = {
+        'prefill_tokens_per_second': batch_results[(n_batch, n_ubatch)]['prefill_tokens_per_second'],
+        'decode_tokens_per_second': decode[n_threads]['decode_tokens_per_second']
+    }
+    print(f"Migliori impostazioni: {params}")
+    print(f"Prefill {measurements['prefill_tokens_per_second']:.1f} tok/s, "
+          f"decodifica {measurements['decode_tokens_per_second']:.1f} tok/s")
+    if not args.dry_run:
+        path = save_profile(args.output_dir, model_id(model_path, model_config), params, measurements, trials)
+        print(f"Profilo salvato in {path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Generazione in blocco da un file JSONL di conversazioni, per valutazioni e job notturni.
+
+Ogni riga dell'input è un oggetto con "messages" (lista di messaggi role/content) oppure
+"prompt" (testo dell'utente) e facoltativamente "id" (testo o intero); senza "id" vale il
+numero di riga. Una riga con un id già visto nell'input viene saltata.
+Se la conversazione non inizia con un messaggio di sistema si aggiunge il pre_prompt
+della config (--no-system per non aggiungerlo).
+
+Le risposte si scrivono man mano nel JSONL di output, una riga per conversazione, in
+ordine di completamento: {"id", "line", "response", "prompt_tokens", "completion_tokens",
+"seconds"} oppure {"id", "line", "error"}. L'output è anche il punto di ripresa: rilanciando
+lo stesso comando le conversazioni già presenti vengono saltate (--retry-errors rifà quelle
+con errore; vale l'ultima riga per id). Le chat history non vengono toccate.
+
+Con --batch-size > 1 le conversazioni passano dallo scheduler con batching multi-sequenza:
+più sequenze avanzano nello stesso passo di decodifica.
+
+Uso: python batch_infer.py input.jsonl output.jsonl [--batch-size 8] [--model NOME] [--temperature 0]
+"""
+import argparse
+import copy
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from chat.cancellation import CancellationToken
+from chat.model_registry import ModelRegistry, discover_models, load_model_config
+
+def read_records(path: str):
+    """(numero di riga, record o eccezione) per ogni riga non vuota dell'input"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, e
+
+def get_key(line_number: int, record):
+    """(id, record): con un "id" non valido il record diventa l'errore da riportare"""
+    if not isinstance(record, dict) or 'id' not in record:
+        return line_number, record
+    key = record['id']
+    if isinstance(key, bool) or not isinstance(key, (str, int)):
+        return line_number, ValueError(f"'id' deve essere un testo o un intero, non {type(key).__name__}")
+    return key, record
+
+def load_done(path: str, retry_errors: bool) -> set:
+    """Id già presenti nell'output; scarta una riga finale troncata da un'interruzione"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    valid_bytes = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            valid_bytes += len(line)
+            if 'error' in result and retry_errors:
+                done.discard(result['id'])
+            else:
+                done.add(result['id'])
+    if valid_bytes != os.path.getsize(path):
+        with open(path, 'r+b') as f:
+            f.truncate(valid_bytes)
+    return done
+
+def get_messages(record: dict, pre_prompt: str) -> list:
+    if not isinstance(record, dict):
+        raise ValueError("Ogni riga deve essere un oggetto JSON")
+    if isinstance(record.get('messages'), list) and record['messages']:
+        messages = record['messages']
+    elif isinstance(record.get('prompt'), str) and record['prompt'].strip():
+        messages = [{'role': 'user', 'content': record['prompt']}]
+    else:
+        raise ValueError("Il record deve contenere 'messages' (lista non vuota) o 'prompt' (testo)")
+    for message in messages:
+        if not isinstance(message, dict) or message.get('role') not in ('user', 'assistant', 'system') \
+                or not isinstance(message.get('content'), str):
+            raise ValueError("Ogni messaggio deve avere 'role' (user, assistant o system) e 'content' (testo)")
+    if pre_prompt and messages[0]['role'] != 'system':
+        messages = [{'role': 'system', 'content': pre_prompt}] + messages
+    return messages
+
+def generate(llm_manager, key, messages: list, cancel: CancellationToken = None) -> dict:
+    tokenizer = llm_manager.get_tokenizer()
+    start = time.perf_counter()
+    completion_tokens = 0
+    response_text = ""
+    # In streaming si contano i token generati senza ricodificare la risposta
+    for token_text, response_text in llm_manager.generate_response(messages, stream=True, session_id=f"batch:{key}",
+                                                                  cancel=cancel):
+        if token_text:
+            completion_tokens += 1
+    return {
+        'response': response_text,
+        'prompt_tokens': tokenizer.prompt_overhead() + sum(tokenizer.count_message(message) for message in messages),
+        'completion_tokens': completion_tokens,
+        'seconds': round(time.perf_counter() - start, 3)
+    }
+
+def run(llm_manager, input_path: str, output_path: str, workers: int = 1, system: bool = True,
+        retry_errors: bool = False) -> dict:
+    """Elabora l'input riprendendo dall'output esistente; restituisce i totali dell'esecuzione"""
+    done = load_done(output_path, retry_errors)
+    pre_prompt = llm_manager.get_pre_prompt() if system else None
+    totals = {'completed': 0, 'errors': 0, 'skipped': 0, 'duplicates': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+    start = time.perf_counter()
+    interrupted = False
+    cancels = {}  # future non ancora scritta -> token della sua generazione
+
+    def write(out, futures):
+        for future in futures:
+            cancels.pop(future, None)
+            result = future.result()
+            out.write(json.dumps(result, ensure_ascii=False) + "\n")
+            if 'error' in result:
+                totals['errors'] += 1
+            else:
+                totals['completed'] += 1
+                totals['prompt_tokens'] += result['prompt_tokens']
+                totals['completion_tokens'] += result['completion_tokens']
+        # Una riga scritta è una conversazione che la ripresa non rifà
+        out.flush()
+
+    def process(line_number, key, record, cancel):
+        result = {'id': key, 'line': line_number}
+        try:
+            if isinstance(record, json.JSONDecodeError):
+                raise ValueError(f"JSON non valido: {record}")
+            if isinstance(record, Exception):
+                raise record
+            result.update(generate(llm_manager, key, get_messages(record, pre_prompt), cancel))
+        except Exception as e:
+            result['error'] = str(e)
+        return result
+
+    with open(output_path, 'a', encoding='utf-8') as out, ThreadPoolExecutor(workers, 'batch') as executor:
+        pending = set()
+        submitted = set()
+        try:
+            for line_number, record in read_records(input_path):
+                key, record = get_key(line_number, record)
+                if key in submitted:
+                    print(f"Riga {line_number}: id {key!r} già presente nell'input, saltata")
+                    totals['duplicates'] += 1
+                    continue
+                submitted.add(key)
+                if key in done:
+                    totals['skipped'] += 1
+                    continue
+                # Al più due conversazioni in coda per worker: l'input si legge man mano
+                if len(pending) >= 2 * workers:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    write(out, finished)
+                cancel = CancellationToken()
+                future = executor.submit(process, line_number, key, record, cancel)
+                cancels[future] = cancel
+                pending.add(future)
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                write(out, finished)
+        except KeyboardInterrupt:
+            # Le conversazioni non ancora scritte verranno rifatte alla ripresa
+            # Quelle in corso si fermano al prossimo token invece di arrivare a max_tokens
+            interrupted = True
+            for future, cancel in cancels.items():
+                future.cancel()
+                cancel.cancel()
+
+    seconds = time.perf_counter() - start
+    totals.update({
+        'interrupted': interrupted,
+        'seconds': seconds,
+        'completion_tokens_per_second': totals['completion_tokens'] / seconds if seconds > 0 else 0.0,
+        'total_tokens_per_second': ((totals['prompt_tokens'] + totals['completion_tokens']) / seconds
+                                    if seconds > 0 else 0.0)
+    })
+    return totals
+
+def create_llm_manager(args):
+    # Import qui: llama_cpp è lento da importare e non serve per --help
+    from chat.llm_manager import LLMManager
+    name = args.model or ModelRegistry(factory=None).default
+    model_config, model_path = load_model_config(name)
+    if args.temperature is not None:
+        model_config = copy.deepcopy(model_config)
+        model_config["inference_params"]["temp"] = args.temperature
+    # KV cache dei prefissi solo in RAM: niente scritture su disco durante il job
+    llm_manager = LLMManager(max_new_tokens=args.max_tokens, kv_cache_dir=None, model_config=model_config,
+                             model_path=args.model_path or model_path, name=name)
+    if args.batch_size > 1:
+        llm_manager.enable_scheduler(args.batch_size)
+    return llm_manager
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help="JSONL di conversazioni")
+    parser.add_argument('output', help="JSONL delle risposte, anche punto di ripresa")
+    parser.add_argument('--model', choices=discover_models(), default=None,
+                        help="modello, tra i moduli config/config_<nome>.py (predefinito del registro)")
+    parser.add_argument('--model-path', default=None, help="file GGUF da usare al posto di quello configurato")
+    parser.add_argument('--batch-size', type=int, default=4,
+                        help="sequenze decodificate insieme (1 = una conversazione alla volta)")
+    parser.add_argument('--max-tokens', type=int, default=500, help="token massimi per risposta")
+    parser.add_argument('--temperature', type=float, default=None, help="sovrascrive la temperatura della config")
+    parser.add_argument('--no-system', action='store_true', help="non aggiunge il pre_prompt della config")
+    parser.add_argument('--retry-errors', action='store_true', help="rifà le conversazioni finite con un errore")
+    parser.add_argument('--stats', default=None, help="salva i totali dell'esecuzione in JSON")
+    args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size deve essere almeno 1")
+
+    llm_manager = create_llm_manager(args)
+    try:
+        totals = run(llm_manager, args.input, args.output, args.batch_size, not args.no_system, args.retry_errors)
+    finally:
+        llm_manager.close()
+
+    print(f"Conversazioni completate: {totals['completed']}, con errore: {totals['errors']}, "
+          f"già nell'output: {totals['skipped']}, id duplicati: {totals['duplicates']}")
+    print(f"Token: {totals['prompt_tokens']} di prompt, {totals['completion_tokens']} generati "
+          f"in {totals['seconds']:.1f} s")
+    print(f"Velocità: {totals['completion_tokens_per_second']:.1f} token generati/s, "
+          f"{totals['total_tokens_per_second']:.1f} token totali/s")
+    if totals['interrupted']:
+        print("Interrotto: rilanciare lo stesso comando per riprendere")
+    if args.stats:
+        with open(args.stats, 'w', encoding='utf-8') as f:
+            json.dump(totals, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""
+Benchmark dell'append sul journal della chat history.
+
+Misura il costo medio di un append man mano che la history cresce: con lo storage
+append-only il costo deve restare costante e non crescere con il numero di messaggi.
+
+Uso: python -m benchmarks.bench_history_append
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.journal import HistoryJournal
+
+CHECKPOINTS = [100, 1000, 10000, 50000]
+SAMPLE_SIZE = 100
+
+def run():
+    with tempfile.TemporaryDirectory() as history_dir:
+        journal = HistoryJournal(history_dir)
+        written = 0
+        print(f"{'messaggi':>10} {'us/append':>12}")
+        for checkpoint in CHECKPOINTS:
+            while written < checkpoint - SAMPLE_SIZE:
+                journal.append(_message(written))
+                written += 1
+
+            start = time.perf_counter()
+            for _ in range(SAMPLE_SIZE):
+                journal.append(_message(written))
+                written += 1
+            elapsed = time.perf_counter() - start
+            print(f"{checkpoint:>10} {elapsed / SAMPLE_SIZE * 1e6:>12.1f}")
+
+        journal.close()
+        assert len(HistoryJournal(history_dir).load()) == written
+
+def _message(index: int) -> dict:
+    role = 'user' if index % 2 == 0 else 'assistant'
+    return {'role': role, 'content': f"Messaggio numero {index} " + "lorem ipsum " * 20}
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,75 @@
+"""
+Micro-benchmark della selezione del contesto su history da 10k messaggi.
+
+Confronta get_tokenized_context (token in cache + ricerca binaria sulle somme
+cumulative) con la versione precedente che ricodificava ogni messaggio ad ogni turno.
+
+Uso: python -m benchmarks.bench_history_context
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.history import ChatHistory
+
+NUM_MESSAGES = 10000
+PREPROMPT = "Sei un assistente AI utile, intelligente, gentile ed efficiente."
+MAX_TOKENS = 2048
+REPEAT = 20
+
+def naive_tokenized_context(chat_history: ChatHistory, preprompt: str, max_tokens: int) -> list:
+    """Implementazione originale: ricodifica ogni messaggio e inserisce in testa"""
+    tokenizer = chat_history.tokenizer
+    preprompt_tokens = len(tokenizer.encode(preprompt))
+    available_tokens = max_tokens - preprompt_tokens
+    result = [{'role': 'system', 'content': preprompt}]
+    current_tokens = 0
+    for message in reversed(chat_history.history):
+        message_tokens = len(tokenizer.encode(message['content'])) + len(tokenizer.encode(message['role']))
+        if current_tokens + message_tokens > available_tokens:
+            break
+        result.insert(1, message)
+        current_tokens += message_tokens
+    return result
+
+def run():
+    with tempfile.TemporaryDirectory() as history_dir:
+        chat_history = ChatHistory(history_dir)
+        # Senza margine la finestra coincide con quella dell'implementazione originale
+        chat_history.WINDOW_SLACK = 0
+
+        elapsed = timeit.timeit(
+            lambda: chat_history.append('user', f"Messaggio {len(chat_history.history)} " + "lorem ipsum " * 20),
+            number=NUM_MESSAGES
+        )
+        _report("append", elapsed / NUM_MESSAGES * 1e6, "us/messaggio", 1)
+
+        chat_history.journal.close()
+        elapsed = timeit.timeit(lambda: ChatHistory(history_dir).journal.close(), number=3) / 3
+        _report("caricamento 10k messaggi", elapsed * 1e3, "ms", 1)
+
+        assert chat_history.get_tokenized_context(PREPROMPT, MAX_TOKENS) == \
+            naive_tokenized_context(chat_history, PREPROMPT, MAX_TOKENS)
+
+        elapsed = timeit.timeit(lambda: chat_history.get_tokenized_context(PREPROMPT, MAX_TOKENS), number=REPEAT)
+        _report("get_tokenized_context", elapsed / REPEAT * 1e6, "us/turno", 1)
+
+        elapsed = timeit.timeit(lambda: naive_tokenized_context(chat_history, PREPROMPT, MAX_TOKENS), number=REPEAT)
+        _report("versione precedente", elapsed / REPEAT * 1e6, "us/turno", 1)
+
+        # Caso peggiore della versione precedente: budget che copre tutta la history
+        full_budget = chat_history.get_total_tokens() + MAX_TOKENS
+        elapsed = timeit.timeit(lambda: chat_history.get_tokenized_context(PREPROMPT, full_budget), number=REPEAT)
+        _report("contesto completo (10k)", elapsed / REPEAT * 1e3, "ms/turno", 2)
+
+        elapsed = timeit.timeit(lambda: naive_tokenized_context(chat_history, PREPROMPT, full_budget), number=REPEAT)
+        _report("contesto completo precedente", elapsed / REPEAT * 1e3, "ms/turno", 2)
+
+def _report(label: str, value: float, unit: str, decimals: int):
+    print(f"{label + ':':<32}{value:10.{decimals}f} {unit}")
+
+if __name__ == '__main__':
+    run()
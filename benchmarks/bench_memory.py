@@ -0,0 +1,89 @@
+"""
+Token del prompt per turno con e senza memoria a lungo termine su chat lunghe.
+
+Senza memoria il prompt riempie il budget con la coda della chat, che il modello
+deve valutare (o ritrovare nella KV cache) a ogni turno; con la memoria contiene
+la coda recente e i messaggi vecchi più simili alla domanda. Riporta anche il tempo
+di get_tokenized_context con la ricerca vettoriale (FakeEmbedder: il tempo
+dell'embedder reale è a parte) e se tra i messaggi recuperati c'è quello che contiene la risposta.
+
+Uso: python -m benchmarks.bench_memory [--budget 8192]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.history import ChatHistory
+from chat.memory import VectorMemory
+from benchmarks.fakes import FakeEmbedder, FakeTokenizer
+
+HISTORY_SIZES = [1000, 5000, 20000]
+PREPROMPT = "Sei un assistente AI utile, intelligente, gentile ed efficiente."
+TOPICS = ["vacanza", "lavoro", "cucina", "giardino", "bicicletta", "computer", "musica", "libri"]
+# Fatti detti una volta sola all'inizio della chat e chiesti dopo migliaia di messaggi
+FACTS = [
+    ("Il mio gatto si chiama Romeo e ha tre anni.", "Come si chiama il mio gatto?"),
+    ("Ho parcheggiato la macchina al terzo piano del garage Verdi.", "A che piano del garage ho parcheggiato la macchina?"),
+    ("Il codice del lucchetto della cantina è 4812.", "Qual è il codice del lucchetto della cantina?"),
+]
+TURNS = 5
+
+def fill(chat_history: ChatHistory, size: int):
+    for index in range(size // 2):
+        if index < len(FACTS):
+            chat_history.append('user', FACTS[index][0])
+        else:
+            topic = TOPICS[index % len(TOPICS)]
+            chat_history.append('user', f"Parliamo ancora di {topic}: cosa ne pensi del punto {index}?")
+        chat_history.append('assistant', f"Sul tema {TOPICS[index % len(TOPICS)]} direi che il punto {index} "
+                                         "dipende dal contesto, ma in generale conviene procedere per gradi.")
+
+def prompt_tokens(chat_history: ChatHistory, question: str, budget: int) -> tuple:
+    chat_history.append('user', question)
+    start = time.perf_counter()
+    context = chat_history.get_tokenized_context(PREPROMPT, budget)
+    elapsed = time.perf_counter() - start
+    chat_history.append('assistant', "Risposta.")
+    tokens = sum(chat_history.tokenizer.count_message(message) for message in context)
+    return tokens, elapsed, context
+
+def run(budget: int):
+    print(f"{'messaggi':>9}{'senza memoria':>15}{'con memoria':>13}{'riduzione':>11}{'contesto ms':>12}{'fatti':>8}")
+    for size in HISTORY_SIZES:
+        with tempfile.TemporaryDirectory() as history_dir:
+            chat_history = ChatHistory(history_dir, FakeTokenizer())
+            fill(chat_history, size)
+
+            plain = [prompt_tokens(chat_history, FACTS[turn % len(FACTS)][1], budget)[0] for turn in range(TURNS)]
+
+            chat_history.set_memory(VectorMemory(chat_history, FakeEmbedder()))
+            chat_history.memory.wait_for_index()
+            with_memory = []
+            seconds = []
+            found = 0
+            for turn in range(TURNS):
+                fact, question = FACTS[turn % len(FACTS)]
+                tokens, elapsed, context = prompt_tokens(chat_history, question, budget)
+                with_memory.append(tokens)
+                seconds.append(elapsed)
+                found += any(fact in message['content'] for message in context)
+            chat_history.set_memory(None)
+            chat_history.journal.close()
+
+            plain_tokens = sum(plain) / TURNS
+            memory_tokens = sum(with_memory) / TURNS
+            print(f"{size:>9}{plain_tokens:>15.0f}{memory_tokens:>13.0f}{plain_tokens / memory_tokens:>10.1f}x"
+                  f"{min(seconds) * 1e3:>12.2f}{f'{found}/{TURNS}':>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=int, default=8192, help="token disponibili per il prompt")
+    args = parser.parse_args()
+    run(args.budget)
+
+if __name__ == '__main__':
+    main()
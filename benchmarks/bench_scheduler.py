@@ -0,0 +1,73 @@
+"""
+Load test dello scheduler di generazione con il backend deterministico.
+
+Più sessioni inviano richieste in contemporanea; si confrontano token/s aggregati e
+tempi di attesa al variare della dimensione del batch, senza bisogno di un modello GGUF.
+
+Uso: python -m benchmarks.bench_scheduler
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat.scheduler import RequestScheduler
+from benchmarks.fakes import FakeBackend
+
+SESSIONS = 8
+REQUESTS_PER_SESSION = 4
+RESPONSE_TOKENS = 32
+STEP_TIME = 0.005
+
+def run_load(batch_size: int) -> dict:
+    scheduler = RequestScheduler(FakeBackend(
+        max_batch_size=batch_size,
+        step_time=STEP_TIME,
+        response_tokens=RESPONSE_TOKENS
+    ))
+    scheduler.start()
+    first_token_times = []
+    lock = threading.Lock()
+
+    def session(session_id: str):
+        for turn in range(REQUESTS_PER_SESSION):
+            messages = [{'role': 'user', 'content': f"domanda {turn} della sessione {session_id}"}]
+            request = scheduler.submit(session_id, messages, max_tokens=RESPONSE_TOKENS)
+            first = True
+            for _ in request:
+                if first:
+                    with lock:
+                        first_token_times.append(time.monotonic() - request.enqueued_at)
+                    first = False
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=session, args=(f"s{i}",)) for i in range(SESSIONS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    stats = scheduler.stats()
+    scheduler.stop()
+    first_token_times.sort()
+    return {
+        'batch_size': batch_size,
+        'elapsed_s': elapsed,
+        'tokens_per_s': stats['completed'] * RESPONSE_TOKENS / elapsed,
+        'avg_wait_s': stats['avg_wait_s'],
+        'max_wait_s': stats['max_wait_s'],
+        'p95_first_token_s': first_token_times[int(len(first_token_times) * 0.95) - 1]
+    }
+
+def run():
+    print(f"{'batch':>6} {'tempo s':>9} {'token/s':>9} {'attesa media s':>15} {'attesa max s':>13} {'p95 TTFT s':>11}")
+    for batch_size in (1, 2, 4, 8):
+        result = run_load(batch_size)
+        print(f"{result['batch_size']:>6} {result['elapsed_s']:>9.2f} {result['tokens_per_s']:>9.0f} "
+              f"{result['avg_wait_s']:>15.3f} {result['max_wait_s']:>13.3f} {result['p95_first_token_s']:>11.3f}")
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,111 @@
+"""
+Confronto tra decodifica normale e speculativa su un modello GGUF locale.
+
+Per ogni modalità carica il modello, genera in greedy le risposte a prompt che copiano
+parti del contesto (correzioni, riscritture di codice) e a uno che non ne copia, e
+riporta token/s di decodifica (escluso il prefill), token di bozza accettati e se il
+testo coincide con quello della generazione normale: in greedy deve essere identico.
+
+Uso: python -m benchmarks.bench_speculative --model piccolo.gguf [--draft-model bozza.gguf]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llama_cpp import Llama
+from chat.speculative import create_draft_model
+
+PROMPTS = [
+    "Correggi gli errori di ortografia nel testo seguente e riscrivilo per intero, senza commenti:\n\n"
+    "Ieri siamo andati al mare con i nostri amici. L'acqua era fredda ma il sole era caldo, "
+    "e abbiamo mangiato un gelatto enorme sulla spiagia. Al ritorno c'era molto trafico "
+    "e siamo arivati a casa tardi, stanchi ma contenti della giornata passata insieme.",
+    "Riscrivi questa funzione Python aggiungendo le annotazioni di tipo, senza cambiare altro:\n\n"
+    "def media_mobile(valori, finestra):\n"
+    "    risultati = []\n"
+    "    for indice in range(len(valori) - finestra + 1):\n"
+    "        blocco = valori[indice:indice + finestra]\n"
+    "        risultati.append(sum(blocco) / finestra)\n"
+    "    return risultati\n",
+    "Elenca i passaggi per preparare una moka di caffè.",
+]
+
+def run_mode(args, mode: str, reference: list = None) -> dict:
+    options = {'mode': mode, 'num_pred_tokens': args.draft_tokens, 'draft_model_path': args.draft_model}
+    draft_model = create_draft_model(options, {'n_ctx': args.n_ctx})
+    llm = Llama(model_path=args.model, n_ctx=args.n_ctx, draft_model=draft_model, verbose=False)
+    completion_tokens = 0
+    decode_seconds = 0.0
+    drafted = 0
+    accepted = 0
+    outputs = []
+    # La prima generazione riscalda il modello e non viene misurata
+    for index, prompt in enumerate([PROMPTS[0]] + PROMPTS):
+        llm.reset()
+        if draft_model is not None:
+            draft_model.reset()
+        tokens = 0
+        text = ""
+        first_token_at = None
+        for chunk in llm.create_chat_completion(
+            messages=[{'role': 'user', 'content': prompt}],
+            max_tokens=args.max_tokens,
+            temperature=0,
+            stream=True
+        ):
+            token_text = chunk["choices"][0]["delta"].get("content", "")
+            if token_text:
+                tokens += 1
+                text += token_text
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+        if index == 0 or first_token_at is None:
+            continue
+        completion_tokens += tokens - 1
+        decode_seconds += time.perf_counter() - first_token_at
+        outputs.append(text)
+        if draft_model is not None:
+            drafted += draft_model.drafted
+            accepted += draft_model.accepted
+    return {
+        'mode': mode,
+        'tokens_per_s': completion_tokens / decode_seconds if decode_seconds > 0 else 0.0,
+        'acceptance_rate': accepted / drafted if drafted else None,
+        'drafted': drafted,
+        'accepted': accepted,
+        'same_output': outputs == reference if reference is not None else True,
+        'outputs': outputs
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help="modello GGUF principale (meglio se piccolo)")
+    parser.add_argument('--draft-model', default=None, help="modello GGUF di bozza, con lo stesso vocabolario")
+    parser.add_argument('--draft-tokens', type=int, default=10)
+    parser.add_argument('--max-tokens', type=int, default=200)
+    parser.add_argument('--n-ctx', type=int, default=2048)
+    parser.add_argument('--output', default=None, help="salva i risultati in JSON")
+    args = parser.parse_args()
+
+    modes = ['none', 'prompt_lookup'] + (['draft_model'] if args.draft_model else [])
+    results = [run_mode(args, 'none')]
+    for mode in modes[1:]:
+        results.append(run_mode(args, mode, reference=results[0]['outputs']))
+
+    baseline = results[0]['tokens_per_s']
+    print(f"{'modalità':<15}{'token/s':>10}{'speedup':>10}{'accettati':>12}{'stesso testo':>14}")
+    for result in results:
+        acceptance = f"{result['acceptance_rate']:.0%}" if result['acceptance_rate'] is not None else "-"
+        speedup = result['tokens_per_s'] / baseline if baseline else 0.0
+        print(f"{result['mode']:<15}{result['tokens_per_s']:>10.1f}{speedup:>9.2f}x{acceptance:>12}"
+              f"{'sì' if result['same_output'] else 'no':>14}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
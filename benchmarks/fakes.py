@@ -0,0 +1,167 @@
+"""
+Sostituti deterministici di tokenizer e modello per i benchmark.
+
+Permettono di misurare il codice attorno al modello senza llama_cpp né pesi:
+FakeLLMManager espone la stessa interfaccia di LLMManager e produce token a
+velocità fissa, così il tempo speso "nel modello" è noto e si può sottrarre.
+FakeBackend fa lo stesso per lo scheduler, con il costo di un passo di batch.
+"""
+import re
+import time
+import zlib
+
+import numpy as np
+
+from chat.memory import Embedder
+from chat.scheduler import GenerationRequest, SchedulerBackend
+from chat.tokenizer import Tokenizer
+from config.config_Meta_Llama_3_1_8B_Instruct_Q4_K_M import config as default_config
+
+WORD_PIECE = re.compile(r"\s?\w{1,4}|\s?[^\w\s]|\s+")
+
+class FakeTokenizer(Tokenizer):
+    """Spezza il testo in pezzi di al più 4 caratteri: conteggi simili a un BPE, senza file da scaricare"""
+
+    def encode(self, text: str) -> list:
+        return WORD_PIECE.findall(text)
+
+class FakeEmbedder(Embedder):
+    """Somma di vettori casuali fissi per parola (hash): testi con parole in comune sono simili"""
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.calls = 0
+        self._words = {}
+
+    def embed(self, texts: list) -> np.ndarray:
+        self.calls += len(texts)
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for word in re.findall(r"\w{3,}", text.lower()):
+                vector = self._words.get(word)
+                if vector is None:
+                    vector = self._words[word] = np.random.default_rng(zlib.crc32(word.encode('utf-8'))).standard_normal(self.dim)
+                vectors[row] += vector
+        return vectors
+
+    def get_id(self) -> str:
+        return f"fake{self.dim}"
+
+class FakeLLMManager:
+    """
+    LLMManager finto: risponde sempre con lo stesso testo, un token ogni 1/tokens_per_second secondi.
+    model_seconds accumula il tempo passato dentro la generazione (attese comprese).
+    """
+
+    def __init__(self, tokens_per_second: float = 0, response_tokens: int = 64,
+                 n_ctx: int = 8192, max_new_tokens: int = 500, tokenizer: Tokenizer = None):
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = [f" parola{i % 50}" for i in range(response_tokens)]
+        self.n_ctx = n_ctx
+        self.max_new_tokens = max_new_tokens
+        self.tokenizer = tokenizer or FakeTokenizer()
+        self.scheduler = None
+        self.model_seconds = 0.0
+        self.calls = 0
+
+    def get_model_id(self):
+        return f"fake_ctx{self.n_ctx}"
+
+    def save_state(self):
+        return {'model_id': self.get_model_id(), 'n_tokens': 0, 'llama_state': b''}
+
+    def load_state(self, snapshot) -> bool:
+        return bool(snapshot) and snapshot.get('model_id') == self.get_model_id()
+
+    def get_tokenizer(self):
+        return self.tokenizer
+
+    def get_context_budget(self):
+        return self.n_ctx - self.max_new_tokens
+
+    def get_pre_prompt(self):
+        return default_config["inference_params"]["pre_prompt"]
+
+    def get_cache_stats(self):
+        return None
+
+    def get_speculative_stats(self):
+        return None
+
+    def close(self):
+        pass
+
+    def generate_response(self, messages, stream=False, session_id="default", priority=0, cancel=None,
+                          max_tokens=None, background=False):
+        self.calls += 1
+        response_tokens = self.response_tokens[:max_tokens] if max_tokens else self.response_tokens
+        if stream:
+            return self._generate_stream_response(response_tokens, cancel)
+        return self._generate_single_response(response_tokens, cancel)
+
+    def _generate_single_response(self, response_tokens, cancel=None):
+        start = time.perf_counter()
+        response_text = ""
+        for token_text in response_tokens:
+            if cancel is not None and cancel.is_cancelled():
+                break
+            self._wait_token()
+            response_text += token_text
+        self.model_seconds += time.perf_counter() - start
+        yield "", response_text
+
+    def _generate_stream_response(self, response_tokens, cancel=None):
+        response_text = ""
+        for token_text in response_tokens:
+            if cancel is not None and cancel.is_cancelled():
+                break
+            start = time.perf_counter()
+            self._wait_token()
+            response_text += token_text
+            self.model_seconds += time.perf_counter() - start
+            yield token_text, response_text
+
+    def _wait_token(self):
+        if self.tokens_per_second > 0:
+            time.sleep(1 / self.tokens_per_second)
+
+class FakeBackend(SchedulerBackend):
+    """
+    Backend deterministico per testare lo scheduler senza un modello GGUF.
+
+    Ogni passo costa step_time secondi indipendentemente da quante sequenze contiene,
+    come avviene con il batching multi-sequenza di llama.cpp, e aggiunge una parola
+    per ogni sequenza attiva. Il prefill costa prefill_time_per_token per token del prompt.
+    """
+
+    def __init__(self, max_batch_size: int = 4, step_time: float = 0.01,
+                 prefill_time_per_token: float = 0.0, response_tokens: int = 16):
+        self.max_batch_size = max_batch_size
+        self.step_time = step_time
+        self.prefill_time_per_token = prefill_time_per_token
+        self.response_tokens = response_tokens
+        self.slots = {}
+
+    def start(self, slot: int, request: GenerationRequest):
+        prompt_tokens = sum(len(message['content'].split()) for message in request.messages)
+        if self.prefill_time_per_token:
+            time.sleep(prompt_tokens * self.prefill_time_per_token)
+        last_message = request.messages[-1]['content'] if request.messages else ""
+        words = last_message.split() or ["ok"]
+        length = min(self.response_tokens, request.max_tokens)
+        self.slots[slot] = {'words': [words[i % len(words)] for i in range(length)], 'position': 0}
+
+    def step(self, slots: list) -> dict:
+        if self.step_time:
+            time.sleep(self.step_time)
+        results = {}
+        for slot in slots:
+            state = self.slots[slot]
+            word = state['words'][state['position']]
+            state['position'] += 1
+            text = word if state['position'] == 1 else " " + word
+            results[slot] = (text, state['position'] >= len(state['words']))
+        return results
+
+    def release(self, slot: int):
+        self.slots.pop(slot, None)
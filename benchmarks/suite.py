@@ -0,0 +1,240 @@
+"""
+Suite di benchmark dei percorsi critici della chat, con risultati in JSON.
+
+Misura:
+- ChatHistory.append, get_tokenized_context e _load_all_history a 100, 1k e 10k messaggi
+- ChatHistoryManager.list_histories con migliaia di chat
+- l'overhead di Chatbot.generate_response fuori dal modello, con un FakeLLMManager
+  deterministico che produce token a velocità configurabile
+
+Ogni risultato riporta mediana e minimo per operazione; il JSON include commit e
+versione di Python, così due esecuzioni si possono confrontare con --compare.
+
+Uso:
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --compare baseline.json --threshold 0.2
+    python -m benchmarks.suite --tokenizer fake --quick
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+import chat.tokenizer as tokenizer_module
+from chat.history import ChatHistory
+from chat.history_manager import ChatHistoryManager
+from benchmarks.fakes import FakeLLMManager, FakeTokenizer
+
+HISTORY_SIZES = [100, 1000, 10000]
+CHAT_COUNTS = [1000, 5000]
+PREPROMPT = "Sei un assistente AI utile, intelligente, gentile ed efficiente."
+MAX_TOKENS = 2048
+REPEAT = 7
+
+def measure(fn, number: int = 1, repeat: int = REPEAT) -> dict:
+    """Esegue fn number volte per ripetizione; restituisce i tempi per chiamata in microsecondi"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number * 1e6)
+    return {'median_us': statistics.median(samples), 'min_us': min(samples), 'repeat': repeat, 'number': number}
+
+def bench_history(sizes: list, results: list):
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as history_dir:
+            chat_history = ChatHistory(history_dir)
+            sample = max(size // 100, 5)
+            prefilled = size - sample * REPEAT
+            for index in range(prefilled):
+                chat_history.append(*_message(index))
+
+            # Append: ogni ripetizione aggiunge un blocco, alla fine la history ha size messaggi
+            counter = iter(range(prefilled, size))
+            result = measure(lambda: chat_history.append(*_message(next(counter))), number=sample)
+            results.append(_result('history.append', {'messages': size}, result))
+
+            results.append(_result('history.get_tokenized_context', {'messages': size}, measure(
+                lambda: chat_history.get_tokenized_context(PREPROMPT, MAX_TOKENS), number=20
+            )))
+
+            chat_history.journal.close()
+            results.append(_result('history._load_all_history', {'messages': size}, measure(
+                chat_history._load_all_history
+            )))
+
+            # Apertura: indice dei segmenti, coda della chat e token dei messaggi caricati
+            results.append(_result('history.open', {'messages': size}, measure(
+                lambda: ChatHistory(history_dir).journal.close()
+            )))
+
+def bench_list_histories(counts: list, results: list):
+    for count in counts:
+        with tempfile.TemporaryDirectory() as base_dir:
+            manager = ChatHistoryManager(base_dir, tokenizer=tokenizer_module.get_default_tokenizer())
+            for index in range(count):
+                manager.create_history(f"chat_{index}").journal.close()
+            listed = manager.list_histories()
+            assert len(listed) == count
+            results.append(_result('history_manager.list_histories', {'chats': count}, measure(
+                manager.list_histories, repeat=5
+            )))
+
+def bench_generate_response(tokens_per_second: float, response_tokens: int, history_size: int,
+                            turns: int, results: list):
+    from main import Chatbot
+
+    class BenchChatbot(Chatbot):
+        """Chatbot con FakeLLMManager al posto del modello"""
+
+        def __init__(self, llm_manager, **kwargs):
+            self._fake_llm_manager = llm_manager
+            super().__init__(**kwargs)
+
+        def _create_llm_manager(self, name, model_config, model_path):
+            return self._fake_llm_manager
+
+        def _use_default_model(self, llm_manager):
+            self.history_manager.set_tokenizer(llm_manager.get_tokenizer())
+
+    for stream in (False, True):
+        with tempfile.TemporaryDirectory() as work_dir, _chdir(work_dir):
+            llm_manager = FakeLLMManager(tokens_per_second, response_tokens,
+                                         tokenizer=tokenizer_module.get_default_tokenizer())
+            chatbot = BenchChatbot(llm_manager, use_audio=False, stream=stream)
+            chatbot.wait_until_ready()
+            for index in range(history_size):
+                chatbot.current_history.append(*_message(index))
+
+            walls = []
+            first_tokens = []
+            for turn in range(turns):
+                model_seconds = llm_manager.model_seconds
+                start = time.perf_counter()
+                first_token = None
+                for _ in chatbot.generate_response(f"Domanda di prova numero {turn}?", stream=stream):
+                    if first_token is None:
+                        first_token = time.perf_counter() - start
+                walls.append((time.perf_counter() - start, llm_manager.model_seconds - model_seconds))
+                first_tokens.append(first_token)
+            chatbot.current_history.journal.close()
+
+        overheads = [(wall - model) * 1e6 for wall, model in walls]
+        params = {'stream': stream, 'history_messages': history_size,
+                  'tokens_per_second': tokens_per_second, 'response_tokens': response_tokens}
+        results.append(_result('chatbot.generate_response.overhead', params, {
+            'median_us': statistics.median(overheads), 'min_us': min(overheads),
+            'repeat': turns, 'number': 1,
+            'median_total_us': statistics.median(wall * 1e6 for wall, _ in walls),
+            'median_first_token_us': statistics.median(first_tokens) * 1e6
+        }))
+
+def run(args) -> dict:
+    if args.tokenizer == 'fake':
+        # Tokenizer deterministico per tutte le history, senza scaricare la codifica tiktoken
+        tokenizer_module._default_tokenizer = FakeTokenizer()
+
+    sizes = HISTORY_SIZES[:2] if args.quick else HISTORY_SIZES
+    counts = [count // 5 for count in CHAT_COUNTS] if args.quick else CHAT_COUNTS
+    results = []
+    # Le stampe del Chatbot (caricamento, report) non devono finire nel JSON su stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        bench_history(sizes, results)
+        bench_list_histories(counts, results)
+        bench_generate_response(args.tokens_per_second, args.response_tokens, sizes[-1] // 10,
+                                args.turns, results)
+    return {'meta': _metadata(args), 'results': results}
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Risultati più lenti della baseline oltre la soglia relativa"""
+    baseline_results = {_result_key(result): result for result in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        previous = baseline_results.get(_result_key(result))
+        if previous is None or previous['median_us'] <= 0:
+            continue
+        ratio = result['median_us'] / previous['median_us']
+        print(f"{result['name']:<40} {json.dumps(result['params'], sort_keys=True):<60} "
+              f"{previous['median_us']:>12.1f} -> {result['median_us']:>12.1f} us ({ratio:.2f}x)",
+              file=sys.stderr)
+        if ratio > 1 + threshold:
+            regressions.append({'name': result['name'], 'params': result['params'], 'ratio': ratio})
+    return regressions
+
+def _result(name: str, params: dict, timing: dict) -> dict:
+    return {'name': name, 'params': params, **timing}
+
+def _result_key(result: dict) -> str:
+    return result['name'] + json.dumps(result['params'], sort_keys=True)
+
+def _message(index: int) -> tuple:
+    role = 'user' if index % 2 == 0 else 'assistant'
+    return role, f"Messaggio numero {index} " + "lorem ipsum " * 20
+
+def _metadata(args) -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'tokenizer': args.tokenizer,
+        'quick': args.quick
+    }
+
+@contextlib.contextmanager
+def _chdir(path: str):
+    # Chatbot crea ChatHistoryManager nella cartella corrente
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dei percorsi critici della chat")
+    parser.add_argument('--output', help="file JSON dei risultati (default: stdout)")
+    parser.add_argument('--compare', metavar='BASELINE', help="JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="rallentamento relativo oltre il quale il confronto fallisce")
+    parser.add_argument('--tokenizer', choices=['tiktoken', 'fake'], default='tiktoken')
+    parser.add_argument('--tokens-per-second', type=float, default=0,
+                        help="velocità del modello finto (0 = nessuna attesa)")
+    parser.add_argument('--response-tokens', type=int, default=64)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--quick', action='store_true', help="solo le taglie piccole")
+    args = parser.parse_args()
+
+    report = run(args)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressioni oltre il {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+import codecs
+
+import numpy as np
+import llama_cpp
+
+from .scheduler import GenerationRequest, SchedulerBackend
+
+def render_prompt(messages: list, template: dict) -> str:
+    """Applica il chat template del config (lo stesso conteggiato da Tokenizer) ai messaggi"""
+    prompt = ""
+    for index, message in enumerate(messages):
+        if index == 0 and message['role'] == 'system':
+            prompt += template['pre_prompt_prefix'] + message['content'] + template['pre_prompt_suffix']
+        elif message['role'] == 'assistant':
+            prompt += template['input_suffix'] + message['content']
+        else:
+            prompt += template['input_prefix'].replace('user', message['role']) + message['content']
+    return prompt + template['input_suffix']
+
+class LlamaBatchBackend(SchedulerBackend):
+    """
+    Decodifica multi-sequenza con le API di basso livello di llama.cpp.
+
+    Usa un contesto dedicato creato sullo stesso modello già caricato (i pesi non vengono
+    duplicati) con una sequenza KV per slot. A ogni passo un solo llama_decode valuta
+    l'ultimo token di tutte le sequenze in generazione più un blocco del prompt di una
+    sequenza in prefill, così le nuove richieste entrano senza fermare le altre.
+    """
+
+    def __init__(self, llm, template: dict, max_batch_size: int = 4, n_ctx_per_seq: int = None,
+                 temperature: float = 0.5, top_k: int = 40, top_p: float = 0.95, seed: int = None):
+        self.llm = llm
+        self.template = template
+        self.max_batch_size = max_batch_size
+        self.n_ctx_per_seq = n_ctx_per_seq or llm.n_ctx()
+        self.n_batch = llm.n_batch
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.rng = np.random.default_rng(seed if seed is not None and seed >= 0 else None)
+        self.n_vocab = llm.n_vocab()
+
+        params = llama_cpp.llama_context_default_params()
+        params.n_ctx = self.n_ctx_per_seq * max_batch_size
+        params.n_batch = self.n_batch
+        params.n_seq_max = max_batch_size
+        params.n_threads = llm.context_params.n_threads
+        params.n_threads_batch = llm.context_params.n_threads_batch
+        if hasattr(llama_cpp, 'llama_init_from_model'):
+            self.ctx = llama_cpp.llama_init_from_model(llm.model, params)
+        else:
+            self.ctx = llama_cpp.llama_new_context_with_model(llm.model, params)
+        if not self.ctx:
+            raise RuntimeError("Impossibile creare il contesto per il batching")
+        self.batch = llama_cpp.llama_batch_init(self.n_batch, 0, max_batch_size)
+
+        # Token che chiudono il turno: EOS e gli antiprompt che corrispondono a un solo token
+        self.stop_tokens = {llm.token_eos()}
+        for antiprompt in template.get('antiprompt', []):
+            tokens = llm.tokenize(antiprompt.encode('utf-8'), add_bos=False, special=True)
+            if len(tokens) == 1:
+                self.stop_tokens.add(tokens[0])
+
+        self.slots = {}
+
+    def start(self, slot: int, request: GenerationRequest):
+        prompt = render_prompt(request.messages, self.template)
+        tokens = self.llm.tokenize(prompt.encode('utf-8'), add_bos=True, special=True)
+        max_prompt = self.n_ctx_per_seq - request.max_tokens
+        if len(tokens) > max_prompt:
+            raise ValueError(f"Prompt troppo lungo ({len(tokens)} token). Massimo consentito: {max_prompt} token")
+
+        self._clear_sequence(slot)
+        self.slots[slot] = {
+            'pending': tokens,
+            'n_past': 0,
+            'next_token': None,
+            'decoder': codecs.getincrementaldecoder('utf-8')(errors='replace')
+        }
+
+    def step(self, slots: list) -> dict:
+        results = {}
+        logits_owners = []
+        n_tokens = 0
+
+        # Un token per ogni sequenza già in generazione
+        for slot in slots:
+            state = self.slots[slot]
+            if state['next_token'] is not None:
+                self._add_token(n_tokens, state['next_token'], state['n_past'], slot, True)
+                state['n_past'] += 1
+                logits_owners.append((n_tokens, slot))
+                n_tokens += 1
+
+        # Lo spazio rimanente va al prompt delle sequenze in prefill
+        for slot in slots:
+            state = self.slots[slot]
+            if not state['pending'] or n_tokens >= self.n_batch:
+                results.setdefault(slot, ("", False))
+                continue
+            chunk = state['pending'][:self.n_batch - n_tokens]
+            state['pending'] = state['pending'][len(chunk):]
+            for position, token in enumerate(chunk):
+                last = not state['pending'] and position == len(chunk) - 1
+                self._add_token(n_tokens, token, state['n_past'], slot, last)
+                state['n_past'] += 1
+                if last:
+                    logits_owners.append((n_tokens, slot))
+                n_tokens += 1
+            results[slot] = ("", False)
+
+        if n_tokens == 0:
+            return results
+
+        self.batch.n_tokens = n_tokens
+        if llama_cpp.llama_decode(self.ctx, self.batch) != 0:
+            raise RuntimeError("llama_decode non riuscito")
+
+        for index, slot in logits_owners:
+            state = self.slots[slot]
+            token = self._sample(index)
+            if token in self.stop_tokens:
+                state['next_token'] = None
+                results[slot] = (state['decoder'].decode(b"", final=True), True)
+                continue
+            state['next_token'] = token
+            text = state['decoder'].decode(self.llm.detokenize([token]))
+            finished = state['n_past'] + 1 >= self.n_ctx_per_seq
+            results[slot] = (text, finished)
+        return results
+
+    def release(self, slot: int):
+        self.slots.pop(slot, None)
+        self._clear_sequence(slot)
+
+    def close(self):
+        if self.batch is not None:
+            llama_cpp.llama_batch_free(self.batch)
+            self.batch = None
+        if self.ctx is not None:
+            llama_cpp.llama_free(self.ctx)
+            self.ctx = None
+
+    def _add_token(self, index: int, token: int, position: int, slot: int, logits: bool):
+        self.batch.token[index] = token
+        self.batch.pos[index] = position
+        self.batch.n_seq_id[index] = 1
+        self.batch.seq_id[index][0] = slot
+        self.batch.logits[index] = logits
+
+    def _sample(self, index: int) -> int:
+        logits = np.ctypeslib.as_array(
+            llama_cpp.llama_get_logits_ith(self.ctx, index), shape=(self.n_vocab,)
+        ).astype(np.float64)
+        if self.temperature <= 0:
+            return int(np.argmax(logits))
+
+        top_k = min(self.top_k, self.n_vocab) if self.top_k > 0 else self.n_vocab
+        candidates = np.argpartition(logits, -top_k)[-top_k:]
+        candidate_logits = logits[candidates] / self.temperature
+        order = np.argsort(candidate_logits)[::-1]
+        candidates = candidates[order]
+        probabilities = np.exp(candidate_logits[order] - candidate_logits[order][0])
+        probabilities /= probabilities.sum()
+        # top-p: tiene il minimo insieme di candidati che copre la probabilità richiesta
+        keep = int(np.searchsorted(np.cumsum(probabilities), self.top_p)) + 1
+        probabilities = probabilities[:keep] / probabilities[:keep].sum()
+        return int(self.rng.choice(candidates[:keep], p=probabilities))
+
+    def _clear_sequence(self, slot: int):
+        # Il nome della funzione cambia tra le versioni di llama.cpp
+        if hasattr(llama_cpp, 'llama_kv_cache_seq_rm'):
+            llama_cpp.llama_kv_cache_seq_rm(self.ctx, slot, -1, -1)
+        elif hasattr(llama_cpp, 'llama_kv_self_seq_rm'):
+            llama_cpp.llama_kv_self_seq_rm(self.ctx, slot, -1, -1)
+        else:
+            llama_cpp.llama_memory_seq_rm(llama_cpp.llama_get_memory(self.ctx), slot, -1, -1)
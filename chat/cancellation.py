@@ -0,0 +1,33 @@
+import threading
+
+class CancellationToken:
+    """
+    Richiesta di interrompere una generazione, condivisa tra chi la chiede (GUI, API)
+    e chi genera. La generazione controlla il token a ogni passo di decodifica, quindi
+    il modello si libera al passo successivo a cancel().
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+    def is_cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def add_callback(self, callback):
+        """callback() viene chiamato (dal thread di cancel) all'annullamento, subito se già annullato"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+from datetime import datetime
+
+class ChatCatalog:
+    """
+    Indice SQLite delle chat: nome, date, numero di messaggi e di token.
+
+    È un dato derivato: la fonte di verità restano le cartelle delle chat, da cui
+    il catalogo può essere ricostruito. Per questo usa WAL con synchronous=NORMAL,
+    così l'aggiornamento a ogni messaggio non paga un fsync.
+    """
+
+    SORT_COLUMNS = ('last_modified', 'created_at', 'name', 'message_count', 'token_count')
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        # La connessione è condivisa tra i thread (GUI, worker dell'API) e protetta dal lock
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS chats (
+                    name TEXT PRIMARY KEY,
+                    created_at TEXT NOT NULL,
+                    last_modified TEXT NOT NULL,
+                    message_count INTEGER NOT NULL DEFAULT 0,
+                    token_count INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS chats_last_modified ON chats (last_modified)")
+
+    def add(self, name: str, created_at: str, last_modified: str = None,
+            message_count: int = 0, token_count: int = 0):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO chats VALUES (?, ?, ?, ?, ?)",
+                (name, created_at, last_modified or created_at, message_count, token_count)
+            )
+
+    def remove(self, name: str):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM chats WHERE name = ?", (name,))
+
+    def exists(self, name: str) -> bool:
+        with self._lock:
+            return self.conn.execute("SELECT 1 FROM chats WHERE name = ?", (name,)).fetchone() is not None
+
+    def record_append(self, name: str, tokens: int):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE chats SET message_count = message_count + 1, token_count = token_count + ?, "
+                "last_modified = ? WHERE name = ?",
+                (tokens, datetime.now().isoformat(), name)
+            )
+
+    def set_counts(self, name: str, message_count: int, token_count: int, touch: bool = True):
+        with self._lock, self.conn:
+            if touch:
+                self.conn.execute(
+                    "UPDATE chats SET message_count = ?, token_count = ?, last_modified = ? WHERE name = ?",
+                    (message_count, token_count, datetime.now().isoformat(), name)
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE chats SET message_count = ?, token_count = ? WHERE name = ?",
+                    (message_count, token_count, name)
+                )
+
+    def list(self, sort_by: str = 'last_modified', descending: bool = True,
+             limit: int = None, offset: int = 0) -> list:
+        if sort_by not in self.SORT_COLUMNS:
+            raise ValueError(f"Ordinamento non valido. Deve essere uno tra: {', '.join(self.SORT_COLUMNS)}")
+        query = f"SELECT * FROM chats ORDER BY {sort_by} {'DESC' if descending else 'ASC'}, name"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            params = (limit, offset)
+        else:
+            params = ()
+        with self._lock:
+            return [dict(row) for row in self.conn.execute(query, params)]
+
+    def count(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chats").fetchone()[0]
+
+    def clear(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM chats")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
@@ -1,27 +1,132 @@
-import tiktoken
 import json
+import math
 import os
+import threading
+from bisect import bisect_left
+import metrics
+from .journal import HistoryJournal
+from .summarizer import ROLE_LABELS
+from .tokenizer import Tokenizer, get_default_tokenizer
 
 class ChatHistory:
-    def __init__(self, history_dir: str):
+    # Quando la finestra di contesto deve avanzare, lascia libera questa frazione del budget:
+    # l'inizio del prompt resta stabile per più turni e il modello può riusare la KV cache
+    WINDOW_SLACK = 0.25
+    # Riassunto progressivo: quando i messaggi non ancora riassunti superano SUMMARY_TRIGGER
+    # dello spazio per la history, i più vecchi vengono riassunti fino a scendere a SUMMARY_TARGET
+    SUMMARY_TRIGGER = 0.75
+    SUMMARY_TARGET = 0.5
+    SUMMARY_HEADER = "Riassunto della conversazione precedente:"
+    MEMORY_HEADER = "Messaggi precedenti della conversazione pertinenti alla domanda:"
+    # All'apertura si caricano solo gli ultimi messaggi, fino a TAIL_TOKENS token: abbastanza
+    # per la finestra di contesto. I più vecchi si leggono dal journal a pagine di PAGE_SIZE
+    TAIL_TOKENS = 4096
+    PAGE_SIZE = 256
+
+    def __init__(self, history_dir: str, tokenizer: Tokenizer = None, summarizer=None, listener=None,
+                 tail_tokens: float = None):
         self.history_dir = history_dir
+        self.name = os.path.basename(os.path.normpath(history_dir))
+        # Notificato a ogni append e clear (history_appended / history_cleared), es. dal catalogo delle chat
+        self.listener = listener
+        self.tail_tokens = tail_tokens if tail_tokens is not None else self.TAIL_TOKENS
+        # Messaggi caricati: history[i] è il messaggio in posizione base + i della chat
+        self.base = 0
         self.history = []
-        self.encoding = tiktoken.get_encoding("cl100k_base")
-        self.history = self._load_all_history()
+        # Token di ogni messaggio caricato e somme cumulative: token_prefix[i] = token dei primi i
+        self.token_counts = []
+        self.token_prefix = [0]
+        # Inizio della finestra di contesto, come posizione assoluta nella chat
+        self._window_start = 0
+        self._window_budget = None
+        self.tokenizer = tokenizer or get_default_tokenizer()
+        self.journal = HistoryJournal(history_dir)
+        # Riassunto dei primi summary_covered messaggi, salvato in summary.json accanto al journal
+        self.summarizer = summarizer
+        self.summary = ""
+        self.summary_covered = 0
+        self._history_budget = None
+        self._summary_lock = threading.Lock()
+        self._summary_thread = None
+        self._summary_generation = 0
+        # Memoria a lungo termine (VectorMemory), impostata con set_memory
+        self.memory = None
+        self._open()
         
     def append(self, role: str, content: str):
         self._manage_chat_history({'role': role, 'content': content})
 
     def get_history(self):
-        return self.history
+        """Tutti i messaggi della chat: legge dal journal anche quelli non caricati"""
+        if self.base == 0:
+            return self.history
+        return self.journal.read(0, self.base) + self.history
+
+    def message_count(self) -> int:
+        return self.base + len(self.history)
+
+    def get_messages(self, start: int, count: int) -> list:
+        """Pagina di messaggi dalla posizione assoluta start, letta dal journal se non caricata"""
+        start = max(start, 0)
+        end = min(start + count, self.message_count())
+        if start >= self.base:
+            return self.history[start - self.base:end - self.base]
+        return self.journal.read(start, min(end, self.base)) + self.history[:max(end - self.base, 0)]
 
     def clear(self):
+        self.base = 0
         self.history = []
+        self.token_counts = []
+        self.token_prefix = [0]
+        self._window_start = 0
+        with self._summary_lock:
+            # Un riassunto in corso si riferisce ai vecchi messaggi e verrà scartato
+            self._summary_generation += 1
+            self.summary = ""
+            self.summary_covered = 0
+        self._save_summary()
         self._save_history()
+        if self.memory is not None:
+            self.memory.clear()
+        if self.listener is not None:
+            self.listener.history_cleared(self)
+
+    def set_tokenizer(self, tokenizer: Tokenizer):
+        """Cambia il tokenizer e ricalcola i token dei messaggi caricati"""
+        self.tokenizer = tokenizer
+        self.token_counts = []
+        self.token_prefix = [0]
+        self._window_start = self.base
+        self._window_budget = None
+        self._index_tokens(self.history)
+
+    def set_memory(self, memory):
+        """
+        Memoria a lungo termine: il prompt contiene solo la coda recente della chat e i
+        messaggi precedenti più simili all'ultima domanda. None per disattivarla.
+        """
+        if self.memory is not None:
+            self.memory.close()
+        self.memory = memory
+        self._window_budget = None
+        if memory is not None:
+            memory.update()
 
     def get_tokenized_context (self, preprompt: str, max_tokens: int = 2048) -> list:
-        # Calcola i token del preprompt
-        preprompt_tokens = self._num_tokens_from_string(preprompt)
+        with metrics.timer('context_build_seconds'):
+            return self._select_context(preprompt, max_tokens)
+
+    def _select_context(self, preprompt: str, max_tokens: int) -> list:
+        with self._summary_lock:
+            summary, summary_covered = self.summary, self.summary_covered
+        system_content = f"{preprompt}\n\n{self.SUMMARY_HEADER}\n{summary}" if summary else preprompt
+
+        # Calcola i token del preprompt, compresi quelli fissi del chat template
+        preprompt_tokens = self.tokenizer.count(system_content) + self.tokenizer.prompt_overhead()
+        if self.summarizer is not None:
+            # Spazio per la history quando il riassunto ha la dimensione massima
+            self._history_budget = (max_tokens - self.tokenizer.count(preprompt) - self.tokenizer.prompt_overhead()
+                                    - self.summarizer.max_summary_tokens)
         
         # Verifica che il preprompt non superi già il limite
         if preprompt_tokens >= max_tokens:
@@ -29,39 +134,234 @@ class ChatHistory:
         
         # Tokens disponibili per la history
         available_tokens = max_tokens - preprompt_tokens
+        window_tokens = available_tokens
+        if self.memory is not None:
+            # Con la memoria nel prompt resta solo la coda recente (almeno l'ultimo messaggio):
+            # il resto del budget va ai messaggi recuperati
+            window_tokens = min(available_tokens - self.memory.max_tokens, self.memory.recent_tokens)
+            window_tokens = min(max(window_tokens, self.token_counts[-1] if self.token_counts else 0), available_tokens)
         
-        # Crea la lista risultante iniziando con il preprompt
-        result = [{'role': 'system', 'content': preprompt}]
-        current_tokens = preprompt_tokens
+        # Se tutti i messaggi caricati entrano nel budget, la finestra potrebbe includerne di più vecchi
+        if self.base > summary_covered and self.token_prefix[-1] < window_tokens:
+            self._load_older(window_tokens - self.token_prefix[-1], stop=summary_covered)
         
-        # Scorri la history dall'ultimo messaggio verso il primo
-        for message in reversed(self.history):
-            message_tokens = self._count_tokens([message])
-            
-            # Se aggiungendo questo messaggio superiamo i token disponibili, ci fermiamo
-            if current_tokens + message_tokens > available_tokens:
-                break
-                
-            # Altrimenti, aggiungiamo il messaggio all'inizio della lista (dopo il preprompt)
-            result.insert(1, message)
-            current_tokens += message_tokens
-            
-        return result
+        # Primo messaggio tale che la coda della history stia nei token disponibili:
+        # token_prefix è crescente, quindi basta una ricerca binaria.
+        # I messaggi già nel riassunto non vengono ripetuti. Gli indici sono relativi a base
+        loaded = len(self.history)
+        lowest = min(max(summary_covered - self.base, 0), loaded)
+        window_start = min(max(self._window_start - self.base, 0), loaded)
+        total_tokens = self.token_prefix[-1]
+        first_index = bisect_left(self.token_prefix, total_tokens - window_tokens, lowest, loaded)
+        
+        if self._window_budget != max_tokens:
+            # Budget cambiato: la finestra precedente non è più un riferimento valido
+            self._window_budget = max_tokens
+        elif first_index > window_start:
+            # La finestra precedente non entra più: avanza lasciando margine per i prossimi turni
+            target_tokens = window_tokens - int(window_tokens * self.WINDOW_SLACK)
+            first_index = bisect_left(self.token_prefix, total_tokens - target_tokens, lowest, loaded)
+        else:
+            # Mantiene lo stesso inizio del prompt dei turni precedenti
+            first_index = max(window_start, lowest)
+        self._window_start = self.base + first_index
+        
+        context = self.history[first_index:]
+        if self.memory is not None and context and context[-1]['role'] == 'user':
+            window_used = total_tokens - self.token_prefix[first_index]
+            recalled = self._recall(context[-1]['content'], self._window_start,
+                                    min(self.memory.max_tokens, available_tokens - window_used))
+            if recalled is not None:
+                # Subito prima della domanda: l'inizio del prompt resta uguale e la KV cache si riusa
+                context = context[:-1] + [recalled, context[-1]]
+        return [{'role': 'system', 'content': system_content}] + context
 
-    def _count_tokens(self, messages: list[dict]) -> int:
-        num_tokens = 0
+    def _recall(self, query: str, window_start: int, budget: int):
+        """Messaggio di sistema con i messaggi prima di window_start più simili a query, nel budget di token"""
+        budget -= self._message_tokens({'role': 'system', 'content': self.MEMORY_HEADER})
+        if window_start == 0 or budget <= 0:
+            return None
+        with metrics.timer('memory_search_seconds'):
+            hits = self.memory.search(query, window_start)
+        recalled = []
+        for position, _ in hits:
+            message = self.get_messages(position, 1)[0]
+            line = f"{ROLE_LABELS.get(message['role'], message['role'])}: {message['content']}"
+            # Un token in più per l'a capo tra le righe
+            line_tokens = self.tokenizer.count(line) + 1
+            if line_tokens <= budget:
+                recalled.append((position, line))
+                budget -= line_tokens
+        if not recalled:
+            return None
+        # In ordine cronologico, come nella conversazione
+        lines = [line for _, line in sorted(recalled)]
+        return {'role': 'system', 'content': self.MEMORY_HEADER + "\n" + "\n".join(lines)}
+
+    def set_summarizer(self, summarizer):
+        self.summarizer = summarizer
+
+    def maybe_summarize(self) -> bool:
+        """
+        Da chiamare a fine turno: se i messaggi non riassunti occupano troppo spazio,
+        avvia in background il riassunto dei più vecchi. Restituisce True se l'ha avviato.
+        """
+        if self.summarizer is None or self._history_budget is None or self._history_budget <= 0:
+            return False
+        if self._summary_thread is not None and self._summary_thread.is_alive():
+            return False
+
+        with self._summary_lock:
+            # I messaggi precedenti alla parte caricata non sono più nel contesto e non vengono
+            # riassunti: succede solo per chat lunghe create prima del riassunto progressivo
+            start = min(max(self.summary_covered - self.base, 0), len(self.history))
+            generation = self._summary_generation
+        total_tokens = self.token_prefix[-1]
+        if total_tokens - self.token_prefix[start] <= self._history_budget * self.SUMMARY_TRIGGER:
+            return False
+
+        # Riassume fino a lasciare SUMMARY_TARGET del budget, senza separare domanda e risposta
+        target_tokens = int(self._history_budget * self.SUMMARY_TARGET)
+        end = bisect_left(self.token_prefix, total_tokens - target_tokens, start, len(self.history))
+        while end < len(self.history) and self.history[end]['role'] != 'user':
+            end += 1
+        if end <= start or end >= len(self.history):
+            return False
+
+        messages = self.history[start:end]
+        self._summary_thread = threading.Thread(
+            target=self._summarize, args=(messages, self.base + end, generation), name='history-summary', daemon=True
+        )
+        self._summary_thread.start()
+        return True
+
+    def wait_for_summary(self, timeout: float = None):
+        if self._summary_thread is not None:
+            self._summary_thread.join(timeout)
+
+    def _summarize(self, messages: list, end: int, generation: int):
+        try:
+            summary = self.summarizer.summarize(
+                self.summary, messages, session_id=f"summary:{os.path.basename(self.history_dir)}"
+            )
+        except Exception as e:
+            print(f"Errore durante il riassunto della chat history: {e}")
+            return
+        with self._summary_lock:
+            if generation != self._summary_generation:
+                return
+            self.summary = summary
+            self.summary_covered = end
+        self._save_summary()
+
+    def get_total_tokens(self) -> int:
+        """Token dei messaggi caricati (tutti, se la chat è stata aperta con tail_tokens=math.inf)"""
+        return self.token_prefix[-1]
+
+    def _open(self):
+        if not self.journal.exists():
+            # Chat nuova o migrazione dal vecchio formato: i messaggi sono già tutti in memoria
+            self.history = self._load_all_history()
+            self._index_tokens(self.history)
+            self._load_summary()
+            return
+        self.base = self.journal.open()
+        self._window_start = self.base
+        self._load_summary()
+        # Non serve caricare i messaggi già compresi nel riassunto, tranne quando si chiede
+        # l'intera chat (tail_tokens infinito, es. per ricostruire catalogo e indice di ricerca)
+        stop = 0 if math.isinf(self.tail_tokens) else min(self.summary_covered, self.base)
+        self._load_older(self.tail_tokens, stop=stop)
+
+    def _load_older(self, min_tokens: float, stop: int = 0):
+        """Carica pagine di messaggi precedenti a base finché non si aggiungono min_tokens token"""
+        pages = []
+        counts = []
+        loaded_tokens = 0
+        position = self.base
+        while position > stop and loaded_tokens < min_tokens:
+            page_start = max(stop, position - self.PAGE_SIZE)
+            page = self.journal.read(page_start, position)
+            page_counts = [self._message_tokens(message) for message in page]
+            pages.append(page)
+            counts.append(page_counts)
+            loaded_tokens += sum(page_counts)
+            position = page_start
+        if not pages:
+            return
+
+        # Le pagine sono state lette dalla più recente: si ricompongono in ordine
+        self.history = [message for page in reversed(pages) for message in page] + self.history
+        self.token_counts = [count for page_counts in reversed(counts) for count in page_counts] + self.token_counts
+        self.base = position
+        self.token_prefix = [0]
+        total_tokens = 0
+        for message_tokens in self.token_counts:
+            total_tokens += message_tokens
+            self.token_prefix.append(total_tokens)
+
+    def _index_tokens(self, messages: list):
+        total_tokens = self.token_prefix[-1]
         for message in messages:
-            # Count tokens in content
-            num_tokens += len(self.encoding.encode(message['content']))
-            # Count tokens in role
-            num_tokens += len(self.encoding.encode(message['role']))
-        return num_tokens
+            message_tokens = self._message_tokens(message)
+            total_tokens += message_tokens
+            self.token_counts.append(message_tokens)
+            self.token_prefix.append(total_tokens)
+
+    def _message_tokens(self, message: dict) -> int:
+        return self.tokenizer.count_message(message)
+
+    def _count_tokens(self, messages: list[dict]) -> int:
+        return sum(self._message_tokens(message) for message in messages)
 
     def _num_tokens_from_string(self, string: str) -> int:
-        return len(self.encoding.encode(string))
+        return self.tokenizer.count(string)
     
     def _load_all_history(self) -> list:
+        if self.journal.exists():
+            return self.journal.load()
+
+        # Migrazione una tantum dal vecchio formato chat_N.json
+        legacy_messages, legacy_files = self._load_legacy_history()
+        if legacy_files:
+            self.journal.rewrite(legacy_messages)
+            for filename in legacy_files:
+                os.remove(filename)
+        return legacy_messages
+
+    def _load_summary(self):
+        summary_path = os.path.join(self.history_dir, 'summary.json')
+        if not os.path.exists(summary_path):
+            return
+        try:
+            with open(summary_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Errore durante il caricamento del riassunto: {str(e)}")
+            return
+        # Un riassunto che copre più messaggi di quelli presenti non è più valido
+        if data.get('covered', 0) <= self.message_count():
+            self.summary = data.get('text', "")
+            self.summary_covered = data.get('covered', 0)
+
+    def _save_summary(self):
+        summary_path = os.path.join(self.history_dir, 'summary.json')
+        with self._summary_lock:
+            data = {'text': self.summary, 'covered': self.summary_covered}
+        try:
+            if not data['text']:
+                if os.path.exists(summary_path):
+                    os.remove(summary_path)
+                return
+            with open(summary_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(summary_path + '.tmp', summary_path)
+        except Exception as e:
+            print(f"Errore durante il salvataggio del riassunto: {str(e)}")
+
+    def _load_legacy_history(self) -> tuple:
         all_messages = []
+        legacy_files = []
         file_index = 0
         
         while True:
@@ -72,10 +372,11 @@ class ChatHistory:
             with open(filename, 'r', encoding='utf-8') as f:
                 messages = json.load(f)
                 all_messages.extend(messages)
+            legacy_files.append(filename)
                 
             file_index += 1
             
-        return all_messages
+        return all_messages, legacy_files
     
     def _manage_chat_history(self, new_message: dict) -> bool:
         # Validazione del formato del messaggio
@@ -97,49 +398,26 @@ class ChatHistory:
             raise ValueError("Il contenuto del messaggio deve essere una stringa non vuota")
             
         # Validazione della lunghezza (opzionale, puoi modificare il limite)
-        message_tokens = self._count_tokens([new_message])
+        message_tokens = self._message_tokens(new_message)
         if message_tokens > 1500:
             raise ValueError(f"Il messaggio è troppo lungo ({message_tokens} token). Massimo consentito: 1500 token")
     
-        # Aggiungi il nuovo messaggio alla history
+        # Aggiungi il nuovo messaggio alla history e scrivi solo la nuova riga
         self.history.append(new_message)
-        self._save_history()
-      
-    def _save_history_chunk(self, messages: list, file_index: int):
-        # Crea la directory se non esiste
-        os.makedirs(self.history_dir, exist_ok=True)
-        
-        # Definisci il nome del file usando l'indice
-        filename = os.path.join(self.history_dir, f'chat_{file_index}.json')
-        
-        # Salva la cronologia in formato JSON
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
+        self.token_counts.append(message_tokens)
+        self.token_prefix.append(self.token_prefix[-1] + message_tokens)
+        with metrics.timer('history_save_seconds'):
+            self.journal.append(new_message)
+        if self.memory is not None:
+            self.memory.update()
+        if self.listener is not None:
+            self.listener.history_appended(self, self.message_count() - 1, new_message, message_tokens)
             
     def _save_history(self):
         try:
-            # Inizializza variabili
-            current_chunk = []
-            current_tokens = 0
-            file_index = 0
-            
-            # Analizza tutti i messaggi nella history
-            for message in self.history:
-                message_tokens = self._count_tokens([message])
-                
-                if current_tokens + message_tokens > 1500:
-                    self._save_history_chunk(current_chunk, file_index)
-                    current_chunk = [message]
-                    current_tokens = message_tokens
-                    file_index += 1
-                else:
-                    current_chunk.append(message)
-                    current_tokens += message_tokens
-            
-            # Salva l'ultimo chunk se contiene messaggi
-            if current_chunk:
-                self._save_history_chunk(current_chunk, file_index)
-                
+            # Riscrive l'intero journal (usato solo da clear, non ad ogni messaggio)
+            with metrics.timer('history_save_seconds'):
+                self.journal.rewrite(self.get_history())
             return True
             
         except Exception as e:
@@ -1,14 +1,45 @@
 import os
 import json
+import math
+import threading
+import weakref
 from typing import List, Optional
 from datetime import datetime
+import numpy as np
+from .catalog import ChatCatalog
 from .history import ChatHistory
+from .memory import VectorMemory
+from .search_index import SearchIndex
+from .tokenizer import Tokenizer
 
 class ChatHistoryManager:
-    def __init__(self, base_dir: str = 'chat_histories'):
+    MODEL_STATE_FILE = 'model_state.bin'
+    # Formato precedente: non viene più letto, per non eseguire pickle.load su file della chat
+    LEGACY_MODEL_STATE_FILE = 'model_state.pkl'
+
+    def __init__(self, base_dir: str = 'chat_histories', tokenizer: Optional[Tokenizer] = None):
         self.base_dir = base_dir
+        self.tokenizer = tokenizer
+        self.summarizer = None
+        self.embedder = None
+        self.memory_options = None
         self.current_history: Optional[ChatHistory] = None
+        self._open_histories = weakref.WeakSet()
+        # Ultima history aperta per ogni chat: l'unica con la memoria, che ha un indice su disco per chat
+        self._memory_histories = weakref.WeakValueDictionary()
+        # Salvataggi dello stato del modello in corso, per chat: un thread ciascuno
+        self._state_writes = {}
+        self._state_lock = threading.Lock()
         os.makedirs(base_dir, exist_ok=True)
+        
+        catalog_path = os.path.join(base_dir, 'catalog.sqlite3')
+        search_path = os.path.join(base_dir, 'search.sqlite3')
+        catalog_missing = not os.path.exists(catalog_path)
+        search_missing = not os.path.exists(search_path)
+        self.catalog = ChatCatalog(catalog_path)
+        self.search_index = SearchIndex(search_path)
+        if catalog_missing or search_missing:
+            self._rebuild_indexes(catalog_missing, search_missing)
     
     def create_history(self, name: str) -> ChatHistory:
         """Creates a new chat history with the given name"""
@@ -23,9 +54,9 @@ class ChatHistoryManager:
             'last_modified': datetime.now().isoformat()
         }
         self._save_metadata(name, metadata)
+        self.catalog.add(name, metadata['created_at'], metadata['last_modified'])
         
-        self.current_history = ChatHistory(history_dir)
-        return self.current_history
+        return self._open_history(history_dir)
     
     def load_history(self, name: str) -> ChatHistory:
         """Loads an existing chat history"""
@@ -33,8 +64,7 @@ class ChatHistoryManager:
         if not os.path.exists(history_dir):
             raise ValueError(f"Chat history '{name}' does not exist")
         
-        self.current_history = ChatHistory(history_dir)
-        return self.current_history
+        return self._open_history(history_dir)
     
     def delete_history(self, name: str) -> bool:
         """Deletes a chat history"""
@@ -43,22 +73,254 @@ class ChatHistoryManager:
             return False
         
         import shutil
+        self._wait_model_state(name)
         shutil.rmtree(history_dir)
+        self.catalog.remove(name)
+        self.search_index.remove_chat(name)
         return True
     
-    def list_histories(self) -> List[dict]:
-        """Returns a list of all available chat histories with their metadata"""
-        histories = []
+    def list_histories(self, sort_by: str = 'last_modified', descending: bool = True,
+                       limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        """
+        Returns the chat histories from the catalog, most recently modified first by default.
+        Each entry has name, created_at, last_modified, message_count and token_count.
+        """
+        return self.catalog.list(sort_by, descending, limit, offset)
+    
+    def count_histories(self) -> int:
+        """Returns the number of chat histories"""
+        return self.catalog.count()
+    
+    def history_exists(self, name: str) -> bool:
+        """Checks whether a chat history exists, with a single catalog lookup"""
+        return self.catalog.exists(name)
+    
+    def search(self, query: str, limit: int = 20, chat: Optional[str] = None) -> List[dict]:
+        """
+        Full-text search over the messages of all chats (or of one chat), best match first.
+        Each hit has chat, position (message index in the chat), role, snippet and score.
+        """
+        return self.search_index.search(query, limit, chat)
+    
+    def rebuild_catalog(self):
+        """Rebuilds the catalog by scanning the chat directories on disk"""
+        self._rebuild_indexes(catalog=True, search=False)
+    
+    def rebuild_search_index(self):
+        """Rebuilds the full-text index by reading every chat history on disk"""
+        self._rebuild_indexes(catalog=False, search=True)
+    
+    def set_tokenizer(self, tokenizer: Tokenizer):
+        """Sets the tokenizer for new histories and re-counts the tokens of the open ones"""
+        self.tokenizer = tokenizer
+        for history in list(self._open_histories):
+            history.set_tokenizer(tokenizer)
+            # Solo le chat caricate per intero conoscono il totale dei token
+            if history.base == 0:
+                self.catalog.set_counts(history.name, history.message_count(), history.get_total_tokens(), touch=False)
+    
+    def set_summarizer(self, summarizer):
+        """Sets the summarizer that folds old turns into a running summary, for new and open histories"""
+        self.summarizer = summarizer
+        for history in list(self._open_histories):
+            history.set_summarizer(summarizer)
+    
+    def set_memory(self, embedder, options: Optional[dict] = None):
+        """
+        Sets the embedder of the per-chat retrieval memory (None to disable it), for new and
+        open histories. options is the "memory" section of the model config.
+        The previous embedder is closed once no memory uses it.
+        """
+        previous = self.embedder
+        self.embedder = embedder
+        self.memory_options = options
+        for history in list(self._memory_histories.values()):
+            self._attach_memory(history)
+        # Le memorie precedenti sono chiuse: nessun thread usa più il vecchio embedder
+        if previous is not None and previous is not embedder:
+            previous.close()
+    
+    def get_chat_model(self, name: str) -> Optional[str]:
+        """Returns the model chosen for a chat, or None for the default model"""
+        metadata = self._load_metadata(name)
+        return metadata.get('model') if metadata is not None else None
+    
+    def set_chat_model(self, name: str, model: Optional[str]):
+        """Stores the model used by a chat in its metadata (None for the default model)"""
+        metadata = self._load_metadata(name)
+        if metadata is None:
+            raise ValueError(f"Chat history '{name}' does not exist")
+        if model is None:
+            metadata.pop('model', None)
+        else:
+            metadata['model'] = model
+        self._save_metadata(name, metadata)
+    
+    def save_model_state(self, name: str, snapshot: dict) -> bool:
+        """
+        Saves the model state snapshot of a chat in a background thread, so it can be resumed
+        without prefill. The snapshot holds JSON values, numpy arrays and bytes: the file is
+        a JSON header line followed by the raw arrays and bytes.
+        """
+        history_dir = self._get_history_path(name)
+        if not os.path.exists(history_dir):
+            return False
+        
+        with self._state_lock:
+            # Dopo il salvataggio precedente della stessa chat, che altrimenti lo sovrascriverebbe
+            previous = self._state_writes.get(name)
+            thread = threading.Thread(target=self._write_model_state, args=(history_dir, snapshot, previous),
+                                      name=f'model-state-{name}')
+            self._state_writes[name] = thread
+        thread.start()
+        return True
+    
+    def load_model_state(self, name: str) -> Optional[dict]:
+        """Returns the model state snapshot saved for a chat, if any"""
+        self._wait_model_state(name)
+        state_path = os.path.join(self._get_history_path(name), self.MODEL_STATE_FILE)
+        if not os.path.exists(state_path):
+            return None
+        
+        try:
+            with open(state_path, 'rb') as f:
+                header = json.loads(f.readline())
+                snapshot = dict(header['values'])
+                for field in header['arrays']:
+                    count = math.prod(field['shape'])
+                    array = np.fromfile(f, dtype=np.dtype(field['dtype']), count=count)
+                    if len(array) != count:
+                        raise ValueError(f"truncated array '{field['name']}'")
+                    snapshot[field['name']] = array.reshape(field['shape'])
+                for field in header['bytes']:
+                    data = f.read(field['size'])
+                    if len(data) != field['size']:
+                        raise ValueError(f"truncated data '{field['name']}'")
+                    snapshot[field['name']] = data
+            return snapshot
+        except Exception as e:
+            print(f"Error loading model state for '{name}': {e}")
+            return None
+    
+    def history_appended(self, history: ChatHistory, index: int, message: dict, tokens: int):
+        """Listener called by ChatHistory after each appended message"""
+        self.catalog.record_append(history.name, tokens)
+        self.search_index.add(history.name, index, message['role'], message['content'])
+    
+    def history_cleared(self, history: ChatHistory):
+        """Listener called by ChatHistory after clear()"""
+        self.catalog.set_counts(history.name, 0, 0)
+        self.search_index.remove_chat(history.name)
+    
+    def _rebuild_indexes(self, catalog: bool, search: bool):
+        # Una sola lettura delle chat su disco per ricostruire catalogo e indice di ricerca
+        if catalog:
+            self.catalog.clear()
+        if search:
+            self.search_index.clear()
         for name in os.listdir(self.base_dir):
-            metadata_path = os.path.join(self._get_history_path(name), 'metadata.json')
-            if os.path.exists(metadata_path):
-                with open(metadata_path, 'r', encoding='utf-8') as f:
-                    histories.append(json.load(f))
-        return histories
+            history_dir = self._get_history_path(name)
+            metadata_path = os.path.join(history_dir, 'metadata.json')
+            if not os.path.exists(metadata_path):
+                continue
+            
+            # Caricata per intero: servono tutti i messaggi e il totale dei token
+            history = ChatHistory(history_dir, self.tokenizer, tail_tokens=math.inf)
+            history.journal.close()
+            if search:
+                self.search_index.add_many(name, history.history, start=history.base)
+            if not catalog:
+                continue
+            
+            with open(metadata_path, 'r', encoding='utf-8') as f:
+                metadata = json.load(f)
+            # metadata.json non viene aggiornato: l'ultima modifica è quella dei file della chat
+            newest = max(os.path.getmtime(os.path.join(history_dir, filename))
+                         for filename in os.listdir(history_dir))
+            last_modified = max(metadata.get('last_modified', metadata['created_at']),
+                                datetime.fromtimestamp(newest).isoformat())
+            self.catalog.add(name, metadata['created_at'], last_modified,
+                             history.message_count(), history.get_total_tokens())
+    
+    def _open_history(self, history_dir: str) -> ChatHistory:
+        history = ChatHistory(history_dir, self.tokenizer, self.summarizer, listener=self)
+        if not self.catalog.exists(history.name):
+            # Chat copiata nella cartella dopo la creazione del catalogo
+            created_at = datetime.now().isoformat()
+            messages = history.get_history()
+            self.catalog.add(history.name, created_at, created_at, len(messages), history._count_tokens(messages))
+            self.search_index.remove_chat(history.name)
+            self.search_index.add_many(history.name, messages)
+        previous = self._memory_histories.get(history.history_dir)
+        if previous is not None and previous.memory is not None:
+            # Riaperta la stessa chat: due indicizzatori sullo stesso memory.f16 lo corromperebbero
+            previous.set_memory(None)
+        self._memory_histories[history.history_dir] = history
+        self._attach_memory(history)
+        self.current_history = history
+        self._open_histories.add(history)
+        return history
+    
+    def _attach_memory(self, history: ChatHistory):
+        memory = VectorMemory(history, self.embedder, self.memory_options) if self.embedder is not None else None
+        history.set_memory(memory)
+    
+    def _write_model_state(self, history_dir: str, snapshot: dict, previous: Optional[threading.Thread]):
+        if previous is not None:
+            previous.join()
+        header = {'values': {}, 'arrays': [], 'bytes': []}
+        arrays = []
+        blobs = []
+        for key, value in snapshot.items():
+            if isinstance(value, np.ndarray):
+                value = np.ascontiguousarray(value)
+                header['arrays'].append({'name': key, 'dtype': value.dtype.str, 'shape': list(value.shape)})
+                arrays.append(value)
+            elif isinstance(value, (bytes, bytearray)):
+                header['bytes'].append({'name': key, 'size': len(value)})
+                blobs.append(value)
+            else:
+                header['values'][key] = value
+        
+        state_path = os.path.join(history_dir, self.MODEL_STATE_FILE)
+        try:
+            with open(state_path + '.tmp', 'wb') as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+                for array in arrays:
+                    f.write(array.data)
+                for blob in blobs:
+                    f.write(blob)
+            os.replace(state_path + '.tmp', state_path)
+            legacy_path = os.path.join(history_dir, self.LEGACY_MODEL_STATE_FILE)
+            if os.path.exists(legacy_path):
+                os.remove(legacy_path)
+        except Exception as e:
+            print(f"Error saving model state in '{history_dir}': {e}")
+        finally:
+            self._forget_state_write(os.path.basename(history_dir), threading.current_thread())
+    
+    def _wait_model_state(self, name: str):
+        with self._state_lock:
+            thread = self._state_writes.get(name)
+        if thread is not None:
+            thread.join()
+            self._forget_state_write(name, thread)
+    
+    def _forget_state_write(self, name: str, thread: threading.Thread):
+        with self._state_lock:
+            if self._state_writes.get(name) is thread:
+                del self._state_writes[name]
     
     def _get_history_path(self, name: str) -> str:
         return os.path.join(self.base_dir, name)
     
+    def _load_metadata(self, name: str) -> Optional[dict]:
+        metadata_path = os.path.join(self._get_history_path(name), 'metadata.json')
+        if not os.path.exists(metadata_path):
+            return None
+        with open(metadata_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    
     def _save_metadata(self, name: str, metadata: dict):
         metadata_path = os.path.join(self._get_history_path(name), 'metadata.json')
         with open(metadata_path, 'w', encoding='utf-8') as f:
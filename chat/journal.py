@@ -0,0 +1,333 @@
+import json
+import os
+import re
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+class HistoryJournal:
+    """
+    Storage append-only della chat history.
+
+    I messaggi sono salvati in segmenti JSONL (una riga per messaggio) chiamati
+    `segment_<indice_primo_messaggio>.jsonl`. Un append scrive una sola riga nel
+    segmento di coda; quando la coda è piena viene chiusa e se ne apre una nuova.
+    I segmenti chiusi sono immutabili e vengono fusi in background dalla compattazione.
+
+    open() prepara il journal leggendo solo il segmento di coda: la lunghezza dei segmenti
+    chiusi si ricava dai nomi dei file e i messaggi si leggono poi a pagine con read().
+    """
+
+    SEGMENT_PATTERN = re.compile(r'^segment_(\d+)\.jsonl$')
+    COMPACTION_INTENT = 'compaction.json'
+
+    def __init__(self, history_dir: str, segment_max_messages: int = 256,
+                 compact_max_messages: int = 8192, compact_trigger: int = 4):
+        self.history_dir = history_dir
+        self.segment_max_messages = segment_max_messages
+        self.compact_max_messages = compact_max_messages
+        self.compact_trigger = compact_trigger
+        # Lista di [indice_primo_messaggio, numero_messaggi] ordinata per indice
+        self.segments = []
+        self._tail_file = None
+        self._lock = threading.Lock()
+        self._compaction_thread = None
+        # Ultimi segmenti chiusi letti da read(), per non rileggerli pagina dopo pagina
+        self._segment_cache = OrderedDict()
+        self._segment_cache_size = 4
+        # Incrementata quando compattazione o rewrite cambiano i file dei segmenti chiusi:
+        # una lettura fatta fuori lock durante il cambio viene scartata e ripetuta
+        self._layout_version = 0
+        # Messaggi del segmento di coda, aggiornati a ogni append (None se non ancora letti)
+        self._tail_messages = None
+
+    def exists(self) -> bool:
+        """Indica se nella directory sono presenti segmenti JSONL"""
+        return bool(self._list_segment_files())
+
+    def open(self) -> int:
+        """Prepara il journal senza leggere i segmenti chiusi; restituisce il numero di messaggi"""
+        self._recover_compaction()
+        self._remove_temp_files()
+        files = self._list_segment_files()
+        self.segments = []
+        for index, (start, path) in enumerate(files):
+            if index + 1 < len(files):
+                # Un segmento chiuso arriva fino all'inizio del successivo
+                self.segments.append([start, files[index + 1][0] - start])
+                continue
+            tail_messages, valid = self._read_segment(path)
+            if not valid:
+                self._write_segment(path, tail_messages)
+            self.segments.append([start, len(tail_messages)])
+            self._tail_messages = tail_messages
+        return self.count()
+
+    def count(self) -> int:
+        if not self.segments:
+            return 0
+        return self.segments[-1][0] + self.segments[-1][1]
+
+    def read(self, start: int, end: int) -> list:
+        """Messaggi dalla posizione start (inclusa) a end (esclusa)"""
+        messages = []
+        position = max(start, 0)
+        while position < end:
+            with self._lock:
+                starts = [segment[0] for segment in self.segments]
+                index = bisect_right(starts, position) - 1
+                if index < 0:
+                    break
+                segment_start = starts[index]
+                layout_version = self._layout_version
+                if index == len(starts) - 1:
+                    # La coda cambia a ogni append: è tenuta in memoria e letta sotto lock
+                    if self._tail_messages is None:
+                        self._tail_messages = self._read_segment(self._segment_path(segment_start))[0]
+                    segment_messages = self._tail_messages
+                else:
+                    segment_messages = None
+            if segment_messages is None:
+                segment_messages = self._read_closed_segment(segment_start, layout_version)
+                if segment_messages is None:
+                    # Segmento sostituito dalla compattazione durante la lettura: si sceglie di nuovo
+                    continue
+            chunk = segment_messages[position - segment_start:end - segment_start]
+            if not chunk:
+                break
+            messages.extend(chunk)
+            position += len(chunk)
+        return messages
+
+    def load(self) -> list:
+        """Legge tutti i segmenti e ricostruisce la lista dei messaggi"""
+        messages = []
+        self.segments = []
+        self._recover_compaction()
+        self._remove_temp_files()
+        for start, path in self._list_segment_files():
+            # Un segmento già coperto è il residuo di una compattazione interrotta
+            if start < len(messages):
+                os.remove(path)
+                continue
+            segment_messages, valid = self._read_segment(path)
+            if not valid:
+                # Riscrive il segmento senza le righe troncate per poter appendere in sicurezza
+                self._write_segment(path, segment_messages)
+            messages.extend(segment_messages)
+            self.segments.append([start, len(segment_messages)])
+            self._tail_messages = None
+        return messages
+
+    def append(self, message: dict):
+        """Aggiunge un messaggio in coda scrivendo una sola riga"""
+        line = json.dumps(message, ensure_ascii=False) + '\n'
+        with self._lock:
+            if not self.segments or self.segments[-1][1] >= self.segment_max_messages:
+                self._roll()
+            tail = self._get_tail_file()
+            tail.write(line)
+            tail.flush()
+            self.segments[-1][1] += 1
+            if self._tail_messages is not None:
+                self._tail_messages.append(message)
+        self._maybe_schedule_compaction()
+
+    def rewrite(self, messages: list):
+        """Riscrive da zero l'intero journal (usato per clear e migrazione)"""
+        self.wait_for_compaction()
+        with self._lock:
+            self._close_tail()
+            self._segment_cache.clear()
+            self._tail_messages = None
+            self._layout_version += 1
+            for _, path in self._list_segment_files():
+                os.remove(path)
+            self.segments = []
+            os.makedirs(self.history_dir, exist_ok=True)
+            for start in range(0, len(messages), self.segment_max_messages):
+                chunk = messages[start:start + self.segment_max_messages]
+                self._write_segment(self._segment_path(start), chunk)
+                self.segments.append([start, len(chunk)])
+
+    def compact(self):
+        """Fonde i segmenti chiusi consecutivi fino a compact_max_messages"""
+        with self._lock:
+            closed = [list(segment) for segment in self.segments[:-1]]
+
+        groups = []
+        current = []
+        current_count = 0
+        for start, count in closed:
+            if current and current_count + count > self.compact_max_messages:
+                groups.append(current)
+                current = []
+                current_count = 0
+            current.append((start, count))
+            current_count += count
+        if current:
+            groups.append(current)
+
+        for group in groups:
+            if len(group) < 2:
+                continue
+            first_start = group[0][0]
+            merged = []
+            for start, _ in group:
+                # Per posizione: un segmento residuo che si sovrappone non duplica i messaggi
+                segment_messages = self._read_segment(self._segment_path(start))[0]
+                merged.extend(segment_messages[max(first_start + len(merged) - start, 0):])
+            # Il file fuso sostituisce atomicamente il primo segmento del gruppo. L'intento
+            # registrato prima permette a open() di completare una compattazione interrotta
+            tmp_path = self._segment_path(first_start) + '.tmp'
+            self._write_segment(tmp_path, merged)
+            self._write_intent({'first': first_start, 'remove': [start for start, _ in group[1:]]})
+            with self._lock:
+                os.replace(tmp_path, self._segment_path(first_start))
+                for start, _ in group[1:]:
+                    os.remove(self._segment_path(start))
+                os.remove(os.path.join(self.history_dir, self.COMPACTION_INTENT))
+                for start, _ in group:
+                    self._segment_cache.pop(start, None)
+                self._layout_version += 1
+                merged_starts = {start for start, _ in group}
+                # Nuova lista completa prima di assegnarla: count() la legge senza lock
+                segments = [s for s in self.segments if s[0] not in merged_starts] + [[first_start, len(merged)]]
+                self.segments = sorted(segments, key=lambda s: s[0])
+
+    def wait_for_compaction(self):
+        thread = self._compaction_thread
+        if thread is not None:
+            thread.join()
+
+    def close(self):
+        self.wait_for_compaction()
+        with self._lock:
+            self._close_tail()
+
+    def _maybe_schedule_compaction(self):
+        small_closed = [s for s in self.segments[:-1] if s[1] < self.compact_max_messages]
+        if len(small_closed) < self.compact_trigger:
+            return
+        if self._compaction_thread is not None and self._compaction_thread.is_alive():
+            return
+        self._compaction_thread = threading.Thread(target=self._run_compaction, daemon=True)
+        self._compaction_thread.start()
+
+    def _run_compaction(self):
+        try:
+            self.compact()
+        except Exception as e:
+            print(f"Errore durante la compattazione della chat history: {str(e)}")
+
+    def _roll(self):
+        # Chiude la coda corrente e apre un nuovo segmento
+        self._close_tail()
+        start = self.count()
+        os.makedirs(self.history_dir, exist_ok=True)
+        self.segments.append([start, 0])
+        self._tail_messages = []
+
+    def _get_tail_file(self):
+        if self._tail_file is None:
+            path = self._segment_path(self.segments[-1][0])
+            self._tail_file = open(path, 'a', encoding='utf-8')
+        return self._tail_file
+
+    def _close_tail(self):
+        if self._tail_file is not None:
+            self._tail_file.close()
+            self._tail_file = None
+
+    def _segment_path(self, start: int) -> str:
+        return os.path.join(self.history_dir, f'segment_{start:010d}.jsonl')
+
+    def _list_segment_files(self) -> list:
+        if not os.path.isdir(self.history_dir):
+            return []
+        segments = []
+        for filename in os.listdir(self.history_dir):
+            match = self.SEGMENT_PATTERN.match(filename)
+            if match:
+                segments.append((int(match.group(1)), os.path.join(self.history_dir, filename)))
+        return sorted(segments)
+
+    def _read_segment(self, path: str) -> tuple:
+        messages = []
+        valid = True
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    valid = False
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    messages.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # Riga troncata da una scrittura interrotta: la ignoriamo
+                    print(f"Riga non valida ignorata in {path}")
+                    valid = False
+        return messages, valid
+
+    def _remove_temp_files(self):
+        if not os.path.isdir(self.history_dir):
+            return
+        for filename in os.listdir(self.history_dir):
+            if filename.startswith('segment_') and filename.endswith('.tmp'):
+                os.remove(os.path.join(self.history_dir, filename))
+
+    def _read_closed_segment(self, start: int, layout_version: int):
+        """Messaggi di un segmento chiuso, o None se i segmenti sono cambiati dopo layout_version"""
+        with self._lock:
+            if layout_version != self._layout_version:
+                return None
+            cached = self._segment_cache.get(start)
+            if cached is not None:
+                self._segment_cache.move_to_end(start)
+                return cached
+        try:
+            segment_messages = self._read_segment(self._segment_path(start))[0]
+        except FileNotFoundError:
+            # Fuso in un altro segmento e rimosso mentre lo si apriva
+            with self._lock:
+                if layout_version != self._layout_version:
+                    return None
+            raise
+        with self._lock:
+            # Letto mentre veniva sostituito: il contenuto può essere quello vecchio
+            if layout_version != self._layout_version:
+                return None
+            self._segment_cache[start] = segment_messages
+            if len(self._segment_cache) > self._segment_cache_size:
+                self._segment_cache.popitem(last=False)
+        return segment_messages
+
+    def _write_intent(self, intent: dict):
+        intent_path = os.path.join(self.history_dir, self.COMPACTION_INTENT)
+        with open(intent_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(intent, f)
+        os.replace(intent_path + '.tmp', intent_path)
+
+    def _recover_compaction(self):
+        intent_path = os.path.join(self.history_dir, self.COMPACTION_INTENT)
+        if os.path.exists(intent_path + '.tmp'):
+            os.remove(intent_path + '.tmp')
+        if not os.path.exists(intent_path):
+            return
+        with open(intent_path, 'r', encoding='utf-8') as f:
+            intent = json.load(f)
+        if os.path.exists(self._segment_path(intent['first']) + '.tmp'):
+            # Interrotta prima della sostituzione: i segmenti originali sono intatti
+            os.remove(self._segment_path(intent['first']) + '.tmp')
+        else:
+            # Interrotta dopo la sostituzione: i segmenti fusi sono già nel primo
+            for start in intent['remove']:
+                if os.path.exists(self._segment_path(start)):
+                    os.remove(self._segment_path(start))
+        os.remove(intent_path)
+
+    def _write_segment(self, path: str, messages: list):
+        with open(path, 'w', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps(message, ensure_ascii=False) + '\n')
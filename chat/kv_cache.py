@@ -0,0 +1,132 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_cache import BaseLlamaCache
+
+class TieredLlamaCache(BaseLlamaCache):
+    """
+    Cache degli stati del modello (KV cache) su due livelli, compatibile con Llama.set_cache.
+
+    Le chiavi sono le sequenze di token già valutate: llama.cpp cerca lo stato con il
+    prefisso comune più lungo rispetto al nuovo prompt e prefilla solo i token mancanti.
+    Gli stati usati di recente restano in RAM; quando si supera capacity_bytes i meno
+    recenti vengono spostati su disco, a sua volta limitato da disk_capacity_bytes (LRU).
+    """
+
+    def __init__(self, capacity_bytes: int = (2 << 30), disk_dir: str = None,
+                 disk_capacity_bytes: int = (8 << 30)):
+        super().__init__(capacity_bytes)
+        self.disk_dir = disk_dir
+        self.disk_capacity_bytes = disk_capacity_bytes
+        self.ram = OrderedDict()
+        # chiave -> (nome file, dimensione in byte), ordinato dal meno recente
+        self.disk = OrderedDict()
+        self._lock = threading.RLock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self.ram.values())
+
+    @property
+    def disk_size(self) -> int:
+        return sum(size for _, size in self.disk.values())
+
+    def _find_longest_prefix_key(self, key):
+        best_len = 0
+        best_key = None
+        with self._lock:
+            for candidate in list(self.ram.keys()) + list(self.disk.keys()):
+                prefix_len = Llama.longest_token_prefix(candidate, key)
+                if prefix_len > best_len:
+                    best_len = prefix_len
+                    best_key = candidate
+        return best_key
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        with self._lock:
+            best_key = self._find_longest_prefix_key(key)
+            if best_key is None:
+                raise KeyError("Key not found")
+            if best_key in self.ram:
+                self.ram.move_to_end(best_key)
+                return self.ram[best_key]
+
+            # Promozione dal disco alla RAM
+            filename, _ = self.disk.pop(best_key)
+            state = self._read_state(filename)
+            self._remove_files(filename)
+            self.ram[best_key] = state
+            self._evict()
+            return state
+
+    def __contains__(self, key) -> bool:
+        return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key, value):
+        key = tuple(key)
+        with self._lock:
+            if key in self.ram:
+                del self.ram[key]
+            if key in self.disk:
+                filename, _ = self.disk.pop(key)
+                self._remove_files(filename)
+            self.ram[key] = value
+            self._evict()
+
+    def _evict(self):
+        while self.ram and self.cache_size > self.capacity_bytes:
+            key, state = self.ram.popitem(last=False)
+            if self.disk_dir and state.llama_state_size <= self.disk_capacity_bytes:
+                self._spill(key, state)
+
+        while self.disk and self.disk_size > self.disk_capacity_bytes:
+            _, (filename, _) = self.disk.popitem(last=False)
+            self._remove_files(filename)
+
+    def _spill(self, key, state):
+        filename = hashlib.sha1(np.asarray(key, dtype=np.int32).tobytes()).hexdigest()
+        base_path = os.path.join(self.disk_dir, filename)
+        with open(base_path + '.state.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        np.save(base_path + '.tokens.npy', np.asarray(key, dtype=np.int32))
+        os.replace(base_path + '.state.tmp', base_path + '.state')
+        self.disk[key] = (filename, os.path.getsize(base_path + '.state'))
+
+    def _read_state(self, filename: str):
+        with open(os.path.join(self.disk_dir, filename + '.state'), 'rb') as f:
+            return pickle.load(f)
+
+    def _remove_files(self, filename: str):
+        for suffix in ('.state', '.tokens.npy'):
+            try:
+                os.remove(os.path.join(self.disk_dir, filename + suffix))
+            except FileNotFoundError:
+                pass
+
+    def _load_disk_index(self):
+        # Ricostruisce l'indice dal disco: l'ordine LRU segue la data di modifica
+        entries = []
+        for name in os.listdir(self.disk_dir):
+            if not name.endswith('.state'):
+                continue
+            filename = name[:-len('.state')]
+            tokens_path = os.path.join(self.disk_dir, filename + '.tokens.npy')
+            if not os.path.exists(tokens_path):
+                self._remove_files(filename)
+                continue
+            state_path = os.path.join(self.disk_dir, name)
+            key = tuple(int(token) for token in np.load(tokens_path))
+            entries.append((os.path.getmtime(state_path), key, filename, os.path.getsize(state_path)))
+
+        for _, key, filename, size in sorted(entries):
+            self.disk[key] = (filename, size)
+        self._evict()
@@ -1,41 +1,412 @@
-from llama_cpp import Llama
-from config.config_Meta_Llama_3_1_8B_Instruct_Q4_K_M import config
+import os
+import re
+import threading
+import time
+from llama_cpp import Llama, LlamaState
+from config.config_Meta_Llama_3_1_8B_Instruct_Q4_K_M import config as default_config
 import config.paths as paths
+import metrics
+from .kv_cache import TieredLlamaCache
+from .cancellation import CancellationToken
+from .response_cache import ResponseCache
+from .speculative import create_draft_model
+from .tuning import base_load_params, load_profile, model_id
+from .tokenizer import LlamaTokenizer
 
 class LLMManager:
-    def __init__(self):
+    def __init__(self, max_new_tokens=500, kv_cache_dir='kv_cache',
+                 kv_cache_ram_bytes=2 << 30, kv_cache_disk_bytes=8 << 30,
+                 response_cache: ResponseCache = None, cache_nondeterministic=False,
+                 speculative: dict = None, model_config: dict = None, model_path: str = None,
+                 name: str = None, tuning_dir='tuned_profiles'):
+        # Modello servito: config e file GGUF, quelli predefiniti se non indicati (vedi ModelRegistry)
+        self.config = model_config or default_config
+        self.model_path = model_path or paths.llm_model
+        self.name = name or os.path.splitext(os.path.basename(self.model_path))[0]
         self.llm = None
+        self.tokenizer = None
+        # Token riservati alla risposta: il prompt può usare il resto di n_ctx
+        self.max_new_tokens = max_new_tokens
+        self.kv_cache_dir = kv_cache_dir
+        self.kv_cache_ram_bytes = kv_cache_ram_bytes
+        self.kv_cache_disk_bytes = kv_cache_disk_bytes
+        self.scheduler = None
+        # Senza scheduler il modello serve una generazione alla volta (chat e riassunti in background)
+        self._generation_lock = threading.Lock()
+        # Cache delle risposte: usata solo con campionamento deterministico (temp 0),
+        # a meno che cache_nondeterministic non la abiliti comunque
+        self.response_cache = response_cache
+        self.cache_nondeterministic = cache_nondeterministic
+        # Profili misurati da autotune.py (thread e batch per questo host); None per non usarli
+        self.tuning_dir = tuning_dir
+        # Decodifica speculativa (sezione "speculative" della config, se non indicata): il modello
+        # di bozza propone più token e il modello principale li verifica in un solo passo.
+        # Vale per le generazioni dirette, non per quelle in batch dello scheduler
+        self.speculative = speculative if speculative is not None else self.config.get("speculative")
+        self.draft_model = None
+        self._speculative_totals = {'generations': 0, 'drafted': 0, 'accepted': 0,
+                                    'completion_tokens': 0, 'decode_seconds': 0.0}
+        self._speculative_last = None
         self.load_model()
 
     def load_model(self):
-        print("Loading Llama 3.1")
+        print(f"Loading {self.name}")
+        speculative = dict(self.speculative or {})
+        if speculative.get('mode') == 'draft_model':
+            speculative.setdefault('draft_model_path', paths.draft_model)
+        # Con un modello di bozza llama.cpp conserva i logit di tutti i token (logits_all):
+        # gli stati salvati nella KV cache dei prefissi diventano più grandi
+        self.draft_model = create_draft_model(speculative, self.config["load_params"])
         self.llm = Llama(
-            model_path=paths.llm_model,
-            **config["load_params"],
+            model_path=self.model_path,
+            draft_model=self.draft_model,
+            **self.get_load_params(),
         )
-        print("Llama 3.1 loaded")
-
-    def generate_response(self, messages, stream=False):
-        if stream:
-            return self._generate_stream_response(messages)
-        return self._generate_single_response(messages)
-
-    def _generate_single_response(self, messages):
-        response = self.llm.create_chat_completion(
-            messages=messages,
-            max_tokens=500,
-            temperature=config["inference_params"]["temp"]
+        # Riusa gli stati già valutati che condividono un prefisso con il nuovo prompt
+        self.llm.set_cache(TieredLlamaCache(
+            self.kv_cache_ram_bytes,
+            disk_dir=os.path.join(self.kv_cache_dir, self.get_model_id()) if self.kv_cache_dir else None,
+            disk_capacity_bytes=self.kv_cache_disk_bytes
+        ))
+        self.tokenizer = LlamaTokenizer(self.llm, template=self.config["inference_params"])
+        print(f"{self.name} loaded")
+
+    def close(self):
+        """Libera il modello e quello di bozza: attende la generazione in corso e ferma lo scheduler"""
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.scheduler = None
+        with self._generation_lock:
+            if self.llm is not None and hasattr(self.llm, 'close'):
+                self.llm.close()
+            self.llm = None
+            if self.draft_model is not None:
+                self.draft_model.close()
+                self.draft_model = None
+
+    def get_load_params(self):
+        """Parametri di Llama: quelli della config, con thread e batch del profilo dell'host se c'è"""
+        params = base_load_params(self.config)
+        profile = load_profile(self.tuning_dir, self.get_model_id()) if self.tuning_dir else None
+        if profile is not None:
+            params.update(profile['params'])
+            print(f"Profilo di tuning applicato: {profile['params']}")
+        return params
+
+    def get_model_id(self):
+        """Identifica modello e contesto: uno stato salvato è valido solo per la stessa coppia"""
+        return model_id(self.model_path, self.config)
+
+    def save_state(self):
+        """
+        Snapshot dello stato del modello (KV cache e token valutati): solo numeri, array
+        numpy e bytes, così si salva senza pickle (vedi ChatHistoryManager.save_model_state)
+        """
+        with self._generation_lock:
+            state = self.llm.save_state()
+        return {
+            'model_id': self.get_model_id(),
+            'n_tokens': int(state.n_tokens),
+            'seed': int(state.seed),
+            'input_ids': state.input_ids,
+            'scores': state.scores,
+            'llama_state': state.llama_state
+        }
+
+    def load_state(self, snapshot) -> bool:
+        """Ripristina uno snapshot creato da save_state, se compatibile con il modello caricato"""
+        if not snapshot or snapshot.get('model_id') != self.get_model_id():
+            return False
+        state = LlamaState(
+            input_ids=snapshot['input_ids'],
+            scores=snapshot['scores'],
+            n_tokens=snapshot['n_tokens'],
+            llama_state=snapshot['llama_state'],
+            llama_state_size=len(snapshot['llama_state']),
+            seed=snapshot['seed']
+        )
+        with self._generation_lock:
+            self.llm.load_state(state)
+        return True
+
+    def get_tokenizer(self):
+        return self.tokenizer
+
+    def get_context_budget(self):
+        """Token disponibili per il prompt: n_ctx meno il budget di generazione"""
+        return self.config["load_params"]["n_ctx"] - self.max_new_tokens
+
+    def get_pre_prompt(self):
+        return self.config["inference_params"]["pre_prompt"]
+
+    def get_stop_strings(self):
+        """Antiprompt della config: la risposta termina prima di uno di questi testi"""
+        return [stop for stop in self.config["inference_params"].get("antiprompt", []) if stop]
+
+    def enable_scheduler(self, max_batch_size=4, backend=None):
+        """
+        Instrada le generazioni nello scheduler equo con batching multi-sequenza.
+        Serve quando più sessioni (API) generano in contemporanea sullo stesso modello.
+        """
+        from .scheduler import RequestScheduler
+        if backend is None:
+            from .batch_backend import LlamaBatchBackend
+            params = self.config["inference_params"]
+            backend = LlamaBatchBackend(
+                self.llm,
+                template=params,
+                max_batch_size=max_batch_size,
+                temperature=params["temp"],
+                top_k=params["top_k"],
+                top_p=params["top_p"],
+                seed=params["seed"]
+            )
+        self.scheduler = RequestScheduler(backend)
+        self.scheduler.start()
+        return self.scheduler
+
+    def get_sampling_params(self):
+        params = self.config["inference_params"]
+        return {
+            'max_tokens': self.max_new_tokens,
+            'temperature': params["temp"],
+            'top_k': params["top_k"],
+            'top_p': params["top_p"],
+            'seed': params["seed"]
+        }
+
+    def get_cache_stats(self):
+        return self.response_cache.stats() if self.response_cache is not None else None
+
+    def get_speculative_stats(self):
+        """Token di bozza proposti e accettati e velocità effettiva, in totale e nell'ultima generazione"""
+        if self.draft_model is None:
+            return None
+        totals = dict(self._speculative_totals)
+        return {
+            'mode': self.speculative['mode'],
+            'generations': totals['generations'],
+            'drafted': totals['drafted'],
+            'accepted': totals['accepted'],
+            'acceptance_rate': totals['accepted'] / totals['drafted'] if totals['drafted'] else 0.0,
+            'tokens_per_second': (totals['completion_tokens'] / totals['decode_seconds']
+                                  if totals['decode_seconds'] > 0 else 0.0),
+            'last': self._speculative_last
+        }
+
+    def generate_response(self, messages, stream=False, session_id="default", priority=0,
+                          cancel: CancellationToken = None, max_tokens=None, background=False):
+        """
+        Genera la risposta ai messaggi: coppie (token, risposta_completa), una per token in
+        streaming, altrimenti solo quella finale. Con cancel la generazione si ferma al passo
+        di decodifica successivo all'annullamento e restituisce il testo prodotto fin lì.
+        max_tokens limita la risposta (predefinito max_new_tokens). Le generazioni in
+        background (riassunti) non passano dalla cache delle risposte né dalle metriche llm_*.
+        """
+        max_tokens = max_tokens or self.max_new_tokens
+        key = None if background else self._get_cache_key(messages, max_tokens)
+        if key is None:
+            return self._generate_uncached_response(messages, stream, session_id, priority, cancel, max_tokens,
+                                                    measure=not background)
+        cached = self.response_cache.get(key)
+        if cached is not None:
+            return self._replay_cached_response(cached, stream)
+        return self._cache_response(
+            key, self._generate_uncached_response(messages, stream, session_id, priority, cancel, max_tokens), cancel
         )
+
+    def _get_cache_key(self, messages, max_tokens):
+        if self.response_cache is None:
+            return None
+        sampling_params = self.get_sampling_params()
+        sampling_params['max_tokens'] = max_tokens
+        if sampling_params['temperature'] > 0 and not self.cache_nondeterministic:
+            return None
+        return self.response_cache.make_key(messages, self.get_model_id(), sampling_params)
+
+    def _replay_cached_response(self, response_text, stream):
+        """Restituisce una risposta dalla cache con la stessa forma di una generazione"""
+        if not stream:
+            yield "", response_text
+            return
+        replayed = ""
+        for token_text in re.findall(r'\s*\S+|\s+', response_text):
+            replayed += token_text
+            yield token_text, replayed
+
+    def _cache_response(self, key, generator, cancel):
+        # La risposta entra in cache solo se la generazione arriva fino in fondo
+        response_text = None
+        for token_text, response_text in generator:
+            yield token_text, response_text
+        if response_text and not (cancel is not None and cancel.is_cancelled()):
+            self.response_cache.put(key, response_text)
+
+    def _generate_uncached_response(self, messages, stream, session_id, priority, cancel, max_tokens, measure=True):
+        if self.scheduler is not None:
+            generator = self._generate_scheduled_response(messages, stream, session_id, priority, cancel, max_tokens)
+        elif stream:
+            generator = self._generate_stream_response(messages, cancel, max_tokens)
+        elif cancel is not None:
+            # Una generazione non in streaming non si può interrompere: si genera in streaming
+            # e si restituisce solo il testo finale
+            generator = self._final_response(self._generate_stream_response(messages, cancel, max_tokens))
+        else:
+            generator = self._generate_single_response(messages, max_tokens)
+        if measure and metrics.is_enabled():
+            return self._measure_response(messages, generator, stream)
+        return generator
+
+    def _measure_response(self, messages, generator, stream):
+        """Registra tempo al primo token, velocità e token di prompt e risposta"""
+        start = time.perf_counter()
+        first_token_at = None
+        completion_tokens = 0
+        response_text = ""
+        for token_text, response_text in generator:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            if token_text:
+                completion_tokens += 1
+            yield token_text, response_text
+        end = time.perf_counter()
+        if first_token_at is None:
+            return
+
+        if not stream:
+            # Senza streaming arriva solo il testo completo: i token si contano con il tokenizer
+            completion_tokens = self.tokenizer.count(response_text)
+        prompt_tokens = self.tokenizer.prompt_overhead() + sum(
+            self.tokenizer.count_message(message) for message in messages
+        )
+        metrics.observe('llm_time_to_first_token_seconds', first_token_at - start)
+        metrics.observe('llm_generation_seconds', end - start)
+        metrics.observe('llm_prompt_tokens', prompt_tokens)
+        metrics.observe('llm_completion_tokens', completion_tokens)
+        # In streaming la velocità di decodifica esclude il prefill (misurato dal primo token)
+        decode_seconds = end - first_token_at if stream else end - start
+        if completion_tokens > 1 and decode_seconds > 0:
+            metrics.observe('llm_tokens_per_second', (completion_tokens - (1 if stream else 0)) / decode_seconds)
+
+    def _generate_scheduled_response(self, messages, stream, session_id, priority, cancel, max_tokens):
+        # Il backend si ferma solo sugli antiprompt di un token: gli altri si cercano nel testo.
+        # Trovato un antiprompt la richiesta viene annullata e lo slot si libera
+        stop_request = CancellationToken()
+        if cancel is not None:
+            cancel.add_callback(stop_request.cancel)
+        stop_strings = self.get_stop_strings()
+        request = self.scheduler.submit(session_id, messages, max_tokens, priority, stop_request)
+        response_text = ""
+        for _, generated_text in request:
+            end, stopped = self._find_stop(generated_text, stop_strings)
+            if end > len(response_text):
+                token_text, response_text = generated_text[len(response_text):end], generated_text[:end]
+                if stream:
+                    yield token_text, response_text
+            if stopped:
+                stop_request.cancel()
+                break
+        else:
+            # Testo trattenuto perché poteva essere l'inizio di un antiprompt
+            end, _ = self._find_stop(request.response_text, stop_strings, final=True)
+            if end > len(response_text):
+                token_text, response_text = request.response_text[len(response_text):end], request.response_text[:end]
+                if stream:
+                    yield token_text, response_text
+        if not stream:
+            yield "", response_text
+
+    def _find_stop(self, text, stop_strings, final=False):
+        """
+        Quanta parte del testo si può restituire e se contiene un antiprompt. A generazione
+        in corso si trattiene la coda che potrebbe essere l'inizio di un antiprompt.
+        """
+        positions = [text.find(stop) for stop in stop_strings if stop in text]
+        if positions:
+            return min(positions), True
+        if final:
+            return len(text), False
+        held = 0
+        for stop in stop_strings:
+            for length in range(min(len(stop) - 1, len(text)), held, -1):
+                if text.endswith(stop[:length]):
+                    held = length
+                    break
+        return len(text) - held, False
+
+    def _final_response(self, generator):
+        response_text = ""
+        for _, response_text in generator:
+            pass
+        yield "", response_text
+
+    def _generate_single_response(self, messages, max_tokens):
+        with self._generation_lock:
+            self._begin_speculative()
+            start = time.perf_counter()
+            response = self.llm.create_chat_completion(
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=self.config["inference_params"]["temp"],
+                stop=self.get_stop_strings()
+            )
+            self._record_speculative(response["usage"]["completion_tokens"], time.perf_counter() - start)
         yield "", response["choices"][0]["message"]["content"]
 
-    def _generate_stream_response(self, messages):
+    def _generate_stream_response(self, messages, cancel, max_tokens):
         response_text = ""
-        for token in self.llm.create_chat_completion(
-            messages=messages,
-            max_tokens=500,
-            temperature=config["inference_params"]["temp"],
-            stream=True
-        ):
-            token_text = token["choices"][0]["delta"].get("content", "")
-            response_text += token_text
-            yield token_text, response_text
\ No newline at end of file
+        completion_tokens = 0
+        first_token_at = None
+        with self._generation_lock:
+            # Annullata mentre aspettava il modello: non lo occupa nemmeno per il prefill
+            if cancel is not None and cancel.is_cancelled():
+                return
+            self._begin_speculative()
+            chunks = self.llm.create_chat_completion(
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=self.config["inference_params"]["temp"],
+                stop=self.get_stop_strings(),
+                stream=True
+            )
+            for token in chunks:
+                if cancel is not None and cancel.is_cancelled():
+                    # Chiude il generatore di llama.cpp: il modello è libero per la prossima richiesta
+                    chunks.close()
+                    break
+                token_text = token["choices"][0]["delta"].get("content", "")
+                if token_text:
+                    completion_tokens += 1
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                response_text += token_text
+                yield token_text, response_text
+            # In streaming la velocità esclude il prefill, come llm_tokens_per_second
+            if first_token_at is not None:
+                self._record_speculative(completion_tokens - 1, time.perf_counter() - first_token_at)
+
+    def _begin_speculative(self):
+        if self.draft_model is not None:
+            self.draft_model.reset()
+
+    def _record_speculative(self, completion_tokens, decode_seconds):
+        """Aggiorna le statistiche della decodifica speculativa a fine generazione"""
+        if self.draft_model is None:
+            return
+        drafted, accepted = self.draft_model.drafted, self.draft_model.accepted
+        acceptance_rate = accepted / drafted if drafted else 0.0
+        totals = self._speculative_totals
+        totals['generations'] += 1
+        totals['drafted'] += drafted
+        totals['accepted'] += accepted
+        totals['completion_tokens'] += completion_tokens
+        totals['decode_seconds'] += decode_seconds
+        self._speculative_last = {
+            'drafted': drafted,
+            'accepted': accepted,
+            'acceptance_rate': acceptance_rate,
+            'completion_tokens': completion_tokens,
+            'tokens_per_second': completion_tokens / decode_seconds if decode_seconds > 0 else 0.0
+        }
+        if drafted:
+            metrics.observe('llm_draft_acceptance_ratio', acceptance_rate)
\ No newline at end of file
@@ -0,0 +1,327 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+
+class Embedder(ABC):
+    """
+    Interfaccia usata da VectorMemory per trasformare i testi in vettori.
+
+    get_id() identifica il modello: un indice calcolato con un altro embedder
+    non è confrontabile e viene ricostruito.
+    """
+
+    @abstractmethod
+    def embed(self, texts: list) -> np.ndarray:
+        """Una riga per testo, di dimensione fissa (non serve normalizzarle)"""
+
+    @abstractmethod
+    def get_id(self) -> str:
+        pass
+
+    def close(self):
+        """Libera il modello; l'embedder non viene più usato"""
+        pass
+
+class LlamaEmbedder(Embedder):
+    """
+    Embedding con un modello GGUF in modalità embedding: media dei vettori dei token.
+
+    Può essere un embedder piccolo dedicato o lo stesso file del modello di chat
+    (con use_mmap i pesi in RAM sono condivisi). Il modello si carica al primo uso
+    e serve un testo alla volta: ricerca e indicizzazione si alternano.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int = 512, n_threads: int = None, n_gpu_layers: int = 0):
+        self.model_path = model_path
+        self.n_ctx = n_ctx
+        self.n_threads = n_threads
+        self.n_gpu_layers = n_gpu_layers
+        self.llm = None
+        self._lock = threading.Lock()
+
+    def embed(self, texts: list) -> np.ndarray:
+        with self._lock:
+            if self.llm is None:
+                self._load()
+            vectors = []
+            for text in texts:
+                # truncate: i messaggi più lunghi di n_ctx token vengono rappresentati dall'inizio
+                embedding = np.asarray(self.llm.embed(text, truncate=True), dtype=np.float32)
+                if embedding.ndim == 2:
+                    # Modello senza pooling: un vettore per token
+                    embedding = embedding.mean(axis=0)
+                vectors.append(embedding)
+        return np.vstack(vectors)
+
+    def get_id(self) -> str:
+        return os.path.splitext(os.path.basename(self.model_path))[0]
+
+    def close(self):
+        with self._lock:
+            if self.llm is not None and hasattr(self.llm, 'close'):
+                self.llm.close()
+            self.llm = None
+
+    def _load(self):
+        # Import qui: llama_cpp è lento da importare e la history non ne ha bisogno
+        import llama_cpp
+        params = {'n_threads': self.n_threads} if self.n_threads else {}
+        # Con l'embedding il testo si valuta in un solo batch: n_batch e n_ubatch coprono n_ctx
+        self.llm = llama_cpp.Llama(
+            model_path=self.model_path,
+            embedding=True,
+            pooling_type=llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+            n_ctx=self.n_ctx,
+            n_batch=self.n_ctx,
+            n_ubatch=self.n_ctx,
+            n_gpu_layers=self.n_gpu_layers,
+            verbose=False,
+            **params
+        )
+
+def create_embedder(options: dict, model_path: str, n_threads: int = None):
+    """
+    Embedder per la configurazione "memory". Senza embedding_model_path usa il modello
+    di chat indicato da model_path. Restituisce None se la memoria è disattivata.
+    """
+    options = options or {}
+    if not options.get('enabled'):
+        return None
+    return LlamaEmbedder(
+        options.get('embedding_model_path') or model_path,
+        n_ctx=options.get('embedding_n_ctx', 512),
+        n_threads=n_threads,
+        n_gpu_layers=options.get('embedding_n_gpu_layers', 0)
+    )
+
+class VectorMemory:
+    """
+    Memoria a lungo termine di una chat: un vettore per messaggio, cercato per similarità.
+
+    La riga i dell'indice è il messaggio in posizione i della chat. Gli embedding si
+    calcolano in un thread che legge dal journal i messaggi non ancora indicizzati,
+    così append() non aspetta il modello e le chat esistenti si indicizzano da sole.
+
+    I vettori normalizzati sono salvati in float16 in memory.f16, accanto al journal,
+    ogni riga alla posizione del suo messaggio; memory.json contiene embedder e dimensione.
+    Dopo un'interruzione la riga incompleta viene scartata e ricalcolata. Deve esserci
+    una sola VectorMemory aperta per chat (vedi ChatHistoryManager): i file sono comunque
+    protetti da un lock per percorso.
+    """
+    VECTORS_FILE = 'memory.f16'
+    META_FILE = 'memory.json'
+    # Valori predefiniti delle opzioni (sezione "memory" della config)
+    TOP_K = 4
+    RECENT_TOKENS = 1024
+    MAX_TOKENS = 512
+    MIN_SCORE = 0.2
+    # Messaggi per chiamata all'embedder durante l'indicizzazione: una ricerca aspetta al più un batch
+    BATCH_SIZE = 8
+    # Righe convertite in float32 per volta durante la ricerca
+    SEARCH_CHUNK = 8192
+    # Un lock per file dell'indice, condiviso dalle istanze sulla stessa chat
+    _file_locks = {}
+    _file_locks_guard = threading.Lock()
+
+    def __init__(self, history, embedder: Embedder, options: dict = None):
+        options = options or {}
+        self.history = history
+        self.embedder = embedder
+        # Messaggi recuperati per turno, con similarità coseno almeno min_score
+        self.top_k = options.get('top_k', self.TOP_K)
+        self.min_score = options.get('min_score', self.MIN_SCORE)
+        # Token della coda recente della chat che resta nel prompt e token per i messaggi recuperati
+        self.recent_tokens = options.get('recent_tokens', self.RECENT_TOKENS)
+        self.max_tokens = options.get('max_tokens', self.MAX_TOKENS)
+        self.vectors_path = os.path.join(history.history_dir, self.VECTORS_FILE)
+        self.meta_path = os.path.join(history.history_dir, self.META_FILE)
+        with self._file_locks_guard:
+            self._file_lock = self._file_locks.setdefault(os.path.abspath(self.vectors_path), threading.Lock())
+        self.dim = None
+        self.count = 0
+        # Righe [0, count) valide; la capacità raddoppia quando si riempie
+        self._vectors = None
+        self._lock = threading.Lock()
+        # Incrementata da clear(): un batch calcolato prima viene scartato
+        self._generation = 0
+        self._closed = False
+        self._worker = None
+        self._pending = False
+        # Ultima domanda cercata: è anche l'ultimo messaggio, da non ricalcolare all'indicizzazione
+        self._last_query = None
+        self._load()
+
+    def update(self):
+        """Indicizza in background i messaggi aggiunti alla history"""
+        with self._lock:
+            if self._closed:
+                return
+            if self._worker is not None:
+                self._pending = True
+                return
+            self._worker = threading.Thread(target=self._index_pending, name='memory-index', daemon=True)
+            self._worker.start()
+
+    def wait_for_index(self, timeout: float = None):
+        worker = self._worker
+        if worker is not None:
+            worker.join(timeout)
+
+    def search(self, query: str, before: int) -> list:
+        """
+        Messaggi con posizione < before più simili a query, dal più simile:
+        lista di (posizione, similarità). I messaggi non ancora indicizzati non vengono cercati.
+        """
+        with self._lock:
+            vectors, count = self._vectors, min(self.count, before)
+        if count == 0 or self.top_k <= 0:
+            return []
+        try:
+            vector = self._normalize(self.embedder.embed([query]))[0]
+        except Exception as e:
+            print(f"Errore durante l'embedding della domanda: {e}")
+            return []
+        self._last_query = (query, vector)
+        if vector.shape[0] != vectors.shape[1]:
+            return []
+
+        scores = np.empty(count, dtype=np.float32)
+        for start in range(0, count, self.SEARCH_CHUNK):
+            end = min(start + self.SEARCH_CHUNK, count)
+            scores[start:end] = vectors[start:end].astype(np.float32) @ vector
+        k = min(self.top_k, count)
+        top = np.argpartition(-scores, k - 1)[:k] if k < count else np.arange(count)
+        top = top[np.argsort(-scores[top])]
+        return [(int(position), float(scores[position])) for position in top if scores[position] >= self.min_score]
+
+    def clear(self):
+        """Svuota l'indice (la history è stata svuotata)"""
+        with self._lock:
+            self._generation += 1
+            self._reset()
+
+    def close(self):
+        """Ferma l'indicizzazione: i file restano per la prossima apertura"""
+        with self._lock:
+            self._closed = True
+        self.wait_for_index()
+
+    def _index_pending(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    self._worker = None
+                    return
+                start, generation = self.count, self._generation
+                self._pending = False
+            # Dal journal, che ha un lock: i messaggi caricati della history cambiano dal thread principale
+            journal = self.history.journal
+            messages = journal.read(start, min(journal.count(), start + self.BATCH_SIZE))
+            if not messages:
+                with self._lock:
+                    if not self._pending:
+                        self._worker = None
+                        return
+                continue
+            try:
+                vectors = self._embed([message['content'] for message in messages])
+            except Exception as e:
+                print(f"Errore durante l'indicizzazione della memoria: {e}")
+                with self._lock:
+                    self._worker = None
+                return
+            with self._lock:
+                if generation == self._generation and self.count == start:
+                    self._append(vectors)
+
+    def _embed(self, texts: list) -> np.ndarray:
+        last_query = self._last_query
+        missing = [index for index, text in enumerate(texts) if last_query is None or text != last_query[0]]
+        if len(missing) == len(texts):
+            return self._normalize(self.embedder.embed(texts))
+        vectors = np.empty((len(texts), last_query[1].shape[0]), dtype=np.float32)
+        vectors[:] = last_query[1]
+        if missing:
+            vectors[missing] = self._normalize(self.embedder.embed([texts[index] for index in missing]))
+        return vectors
+
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _append(self, vectors: np.ndarray):
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._save_meta()
+        elif vectors.shape[1] != self.dim:
+            print(f"Dimensione degli embedding cambiata ({self.dim} -> {vectors.shape[1]}): indice ricostruito")
+            self._reset()
+            return
+        rows = vectors.astype(np.float16)
+        needed = self.count + len(rows)
+        if self._vectors is None or needed > len(self._vectors):
+            # Nuovo buffer: una ricerca in corso continua a leggere il precedente
+            grown = np.empty((max(needed, 2 * self.count, 64), self.dim), dtype=np.float16)
+            if self._vectors is not None:
+                grown[:self.count] = self._vectors[:self.count]
+            self._vectors = grown
+        self._vectors[self.count:needed] = rows
+        try:
+            with self._file_lock:
+                # Alla posizione delle righe, non in coda: il file resta allineato ai messaggi
+                with open(self.vectors_path, 'r+b' if os.path.exists(self.vectors_path) else 'wb') as f:
+                    f.seek(self.count * self.dim * rows.itemsize)
+                    f.write(rows.tobytes())
+        except OSError as e:
+            print(f"Errore durante il salvataggio della memoria: {e}")
+        self.count = needed
+
+    def _load(self):
+        with self._file_lock:
+            self._load_files()
+
+    def _load_files(self):
+        try:
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            meta = None
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Errore durante il caricamento della memoria: {e}")
+            meta = None
+        if meta is None or meta.get('embedder') != self.embedder.get_id() or not meta.get('dim'):
+            self._remove_files()
+            return
+        self.dim = meta['dim']
+        try:
+            vectors = np.fromfile(self.vectors_path, dtype=np.float16)
+        except OSError:
+            vectors = np.empty(0, dtype=np.float16)
+        # Più righe che messaggi: la history è stata riscritta senza aggiornare l'indice
+        rows = min(len(vectors) // self.dim, self.history.journal.count())
+        if rows * self.dim != len(vectors):
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(rows * self.dim * vectors.itemsize)
+        self._vectors = vectors[:rows * self.dim].reshape(rows, self.dim)
+        self.count = rows
+
+    def _reset(self):
+        with self._file_lock:
+            self._remove_files()
+
+    def _remove_files(self):
+        self.dim = None
+        self.count = 0
+        self._vectors = None
+        for path in (self.vectors_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _save_meta(self):
+        with self._file_lock:
+            with open(self.meta_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'embedder': self.embedder.get_id(), 'dim': self.dim}, f)
+            os.replace(self.meta_path + '.tmp', self.meta_path)
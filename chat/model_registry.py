@@ -0,0 +1,271 @@
+import importlib
+import os
+import pkgutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import config
+import config.paths as paths
+
+DEFAULT_MODEL = 'Meta_Llama_3_1_8B_Instruct_Q4_K_M'
+CONFIG_PREFIX = 'config_'
+
+def discover_models() -> list:
+    """Nomi dei modelli configurati: un modulo config/config_<nome>.py per modello"""
+    return sorted(
+        module.name[len(CONFIG_PREFIX):]
+        for module in pkgutil.iter_modules(config.__path__)
+        if module.name.startswith(CONFIG_PREFIX)
+    )
+
+def load_model_config(name: str, reload: bool = False) -> tuple:
+    """Configurazione e percorso del file GGUF di un modello; reload rilegge il modulo da disco"""
+    module = importlib.import_module(f'config.{CONFIG_PREFIX}{name}')
+    if reload:
+        module = importlib.reload(module)
+    model_config = module.config
+    return model_config, model_config.get('model_path') or paths.get_model_path(name)
+
+def estimate_model_bytes(model_config: dict, model_path: str, speculative: dict = None,
+                         memory: bool = False) -> int:
+    """
+    RAM occupata dal modello: "ram_bytes" della config, altrimenti la dimensione del file GGUF.
+    Si aggiungono il modello di bozza, se la decodifica speculativa ne usa uno (speculative
+    sostituisce la sezione della config, come in LLMManager), e con memory l'embedder della
+    memoria a lungo termine, se è un file diverso dal modello di chat (altrimenti i pesi sono condivisi).
+    """
+    size = model_config.get('ram_bytes') or _file_size(model_path)
+    speculative = speculative if speculative is not None else model_config.get('speculative') or {}
+    if speculative.get('mode') == 'draft_model':
+        size += _file_size(speculative.get('draft_model_path') or paths.draft_model)
+    memory_options = model_config.get('memory') or {}
+    if memory and memory_options.get('enabled'):
+        embedding_path = memory_options.get('embedding_model_path') or paths.embedding_model
+        if embedding_path and os.path.abspath(embedding_path) != os.path.abspath(model_path):
+            size += _file_size(embedding_path)
+    return size
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path) if path else 0
+    except OSError:
+        return 0
+
+class _LoadedModel:
+    def __init__(self, name: str, llm_manager, size: int):
+        self.name = name
+        self.llm_manager = llm_manager
+        self.size = size
+        # Richieste in corso sul modello: finché ce ne sono non viene chiuso
+        self.leases = 0
+        # Tolto dal registro (sfrattato o sostituito): si chiude quando le richieste finiscono
+        self.retired = False
+
+class ModelRegistry:
+    """
+    Modelli disponibili in config/ e istanze LLMManager caricate, con un budget di RAM.
+
+    I modelli si caricano al primo uso; quando il budget non basta vengono chiusi i meno
+    usati di recente, tranne quello predefinito. Le richieste usano un modello tramite
+    lease(): un modello sfrattato o sostituito da swap() resta aperto finché le richieste
+    in corso non finiscono, mentre le nuove usano già la nuova istanza.
+
+    factory(nome, config, percorso) crea l'LLMManager; listener.model_swapped(nome,
+    llm_manager) viene chiamato quando swap() installa una nuova istanza. speculative è
+    l'eventuale sezione speculative passata alla factory al posto di quella della config,
+    per contare il modello di bozza nel budget.
+    """
+
+    def __init__(self, factory, ram_budget_bytes: int = None, default: str = None, listener=None,
+                 speculative: dict = None):
+        self.factory = factory
+        self.ram_budget_bytes = ram_budget_bytes
+        self.listener = listener
+        self.speculative = speculative
+        self.models = discover_models()
+        if default is None:
+            default = paths.default_model or (DEFAULT_MODEL if DEFAULT_MODEL in self.models else None)
+        if default is None and self.models:
+            default = self.models[0]
+        if default not in self.models:
+            raise ValueError(f"Modello predefinito '{default}' non trovato in config/")
+        self.default = default
+        # Modelli caricati, dal meno usato di recente
+        self._loaded = OrderedDict()
+        self._loading = set()
+        self._swaps = {}
+        self._condition = threading.Condition()
+
+    def get(self, name: str = None):
+        """LLMManager del modello, caricato se necessario (senza lease: per stato e statistiche)"""
+        return self._acquire(name, lease=False).llm_manager
+
+    def peek(self, name: str = None):
+        """LLMManager del modello se è già caricato, altrimenti None"""
+        with self._condition:
+            entry = self._loaded.get(name or self.default)
+            return entry.llm_manager if entry is not None else None
+
+    @contextmanager
+    def lease(self, name: str = None):
+        """Usa un modello per una richiesta: non viene chiuso finché il blocco non termina"""
+        entry = self._acquire(name, lease=True)
+        try:
+            yield entry.llm_manager
+        finally:
+            with self._condition:
+                entry.leases -= 1
+                close = entry.retired and entry.leases == 0
+            if close:
+                self._close(entry)
+
+    def swap(self, name: str, make_default: bool = False) -> threading.Thread:
+        """
+        Ricarica in background configurazione e modello e li sostituisce in modo atomico.
+        Le richieste in corso finiscono sulla vecchia istanza. Lo stato è in swap_status().
+        """
+        self._check_name(name)
+        with self._condition:
+            if self._swaps.get(name) == 'loading':
+                raise ValueError(f"Sostituzione del modello '{name}' già in corso")
+            self._swaps[name] = 'loading'
+        thread = threading.Thread(target=self._swap, args=(name, make_default), name=f'model-swap-{name}', daemon=True)
+        thread.start()
+        return thread
+
+    def swap_status(self, name: str):
+        with self._condition:
+            return self._swaps.get(name)
+
+    def stats(self) -> dict:
+        with self._condition:
+            loaded = {name: entry for name, entry in self._loaded.items()}
+            return {
+                'default': self.default,
+                'ram_budget_bytes': self.ram_budget_bytes,
+                'ram_used_bytes': sum(entry.size for entry in loaded.values()),
+                'models': [
+                    {
+                        'name': name,
+                        'loaded': name in loaded,
+                        'default': name == self.default,
+                        'active_requests': loaded[name].leases if name in loaded else 0,
+                        'ram_bytes': loaded[name].size if name in loaded else None,
+                        'swap': self._swaps.get(name)
+                    }
+                    for name in self.models
+                ]
+            }
+
+    def close(self):
+        with self._condition:
+            entries = list(self._loaded.values())
+            self._loaded.clear()
+        for entry in entries:
+            self._close(entry)
+
+    def _acquire(self, name: str, lease: bool) -> _LoadedModel:
+        name = name or self.default
+        self._check_name(name)
+        with self._condition:
+            # Un solo caricamento per modello: le altre richieste aspettano quello in corso
+            while name in self._loading:
+                self._condition.wait()
+            entry = self._loaded.get(name)
+            if entry is None:
+                self._loading.add(name)
+            else:
+                self._loaded.move_to_end(name)
+                if lease:
+                    entry.leases += 1
+                return entry
+        try:
+            entry = self._load(name)
+        except BaseException:
+            with self._condition:
+                self._loading.discard(name)
+                self._condition.notify_all()
+            raise
+        with self._condition:
+            self._loading.discard(name)
+            self._condition.notify_all()
+            # Una sostituzione conclusa nel frattempo ha già installato un'istanza più recente
+            installed = self._loaded.get(name)
+            if installed is None:
+                self._loaded[name] = entry
+                installed = entry
+            if lease:
+                installed.leases += 1
+        if installed is not entry:
+            self._close(entry)
+        return installed
+
+    def _load(self, name: str, reload: bool = False, default: bool = False) -> _LoadedModel:
+        model_config, model_path = load_model_config(name, reload)
+        # L'embedder della memoria segue il modello predefinito (vedi Chatbot)
+        size = estimate_model_bytes(model_config, model_path, self.speculative,
+                                    memory=default or name == self.default)
+        self._make_room(size, keep=name)
+        return _LoadedModel(name, self.factory(name, model_config, model_path), size)
+
+    def _swap(self, name: str, make_default: bool):
+        try:
+            entry = self._load(name, reload=True, default=make_default)
+        except Exception as e:
+            print(f"Errore durante la sostituzione del modello {name}: {e}")
+            with self._condition:
+                self._swaps[name] = f"error: {e}"
+            return
+        with self._condition:
+            old = self._loaded.pop(name, None)
+            self._loaded[name] = entry
+            if make_default:
+                self.default = name
+            self._swaps[name] = 'ready'
+            close_old = old is not None and self._retire(old)
+        if close_old:
+            self._close(old)
+        if self.listener is not None:
+            self.listener.model_swapped(name, entry.llm_manager)
+
+    def _make_room(self, size: int, keep: str):
+        """Sfratta i modelli meno usati di recente finché il nuovo non sta nel budget"""
+        if self.ram_budget_bytes is None:
+            return
+        if size > self.ram_budget_bytes:
+            raise ValueError(f"Il modello ({size} byte) supera il budget di RAM ({self.ram_budget_bytes} byte)")
+        to_close = []
+        with self._condition:
+            used = sum(entry.size for entry in self._loaded.values())
+            # Prima i modelli inattivi, poi quelli con richieste in corso (chiusi quando finiscono)
+            candidates = sorted(
+                (entry for name, entry in self._loaded.items() if name not in (self.default, keep)),
+                key=lambda entry: entry.leases > 0
+            )
+            for entry in candidates:
+                if used + size <= self.ram_budget_bytes:
+                    break
+                del self._loaded[entry.name]
+                used -= entry.size
+                if self._retire(entry):
+                    to_close.append(entry)
+        for entry in to_close:
+            self._close(entry)
+        if used + size > self.ram_budget_bytes:
+            print(f"Budget di RAM superato caricando il modello {keep}: {used + size} byte su {self.ram_budget_bytes}")
+
+    def _retire(self, entry: _LoadedModel) -> bool:
+        # Restituisce True se il modello si può chiudere subito
+        entry.retired = True
+        return entry.leases == 0
+
+    def _close(self, entry: _LoadedModel):
+        try:
+            entry.llm_manager.close()
+        except Exception as e:
+            print(f"Errore durante la chiusura del modello {entry.name}: {e}")
+
+    def _check_name(self, name: str):
+        if name not in self.models:
+            raise ValueError(f"Modello non valido. Deve essere uno tra: {', '.join(self.models)}")
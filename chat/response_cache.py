@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+class ResponseCache:
+    """
+    Cache delle risposte complete del modello.
+
+    La chiave è l'hash dei messaggi inviati, dell'identità del modello e dei parametri di
+    campionamento, quindi una risposta viene riusata solo per una richiesta identica.
+    Livello in memoria LRU (max_entries) e livello opzionale su disco (disk_max_bytes),
+    entrambi con scadenza ttl_seconds.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600,
+                 disk_dir: str = None, disk_max_bytes: int = 64 << 20):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.memory = OrderedDict()  # chiave -> (creato_il, risposta)
+        self.disk = OrderedDict()  # chiave -> dimensione in byte, dal meno recente
+        self.disk_bytes = 0  # somma delle dimensioni in self.disk
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._load_disk_index()
+
+    @staticmethod
+    def make_key(messages: list, model_id: str, params: dict) -> str:
+        payload = json.dumps({'model': model_id, 'params': params, 'messages': messages},
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            response = self._get_memory(key)
+            if response is None and self.disk_dir:
+                response = self._get_disk(key)
+                if response is not None:
+                    self._put_memory(key, response[0], response[1])
+                    response = response[1]
+            if response is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return response
+
+    def put(self, key: str, response: str):
+        created_at = time.time()
+        with self._lock:
+            self._put_memory(key, created_at, response)
+            if self.disk_dir:
+                self._put_disk(key, created_at, response)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'memory_entries': len(self.memory),
+                'disk_entries': len(self.disk),
+                'disk_bytes': self.disk_bytes
+            }
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl_seconds is not None and time.time() - created_at > self.ttl_seconds
+
+    def _get_memory(self, key: str):
+        entry = self.memory.get(key)
+        if entry is None:
+            return None
+        if self._expired(entry[0]):
+            del self.memory[key]
+            return None
+        self.memory.move_to_end(key)
+        return entry[1]
+
+    def _put_memory(self, key: str, created_at: float, response: str):
+        self.memory[key] = (created_at, response)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _get_disk(self, key: str):
+        if key not in self.disk:
+            return None
+        try:
+            with open(self._disk_path(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self._remove_disk(key)
+            return None
+        if self._expired(entry['created_at']):
+            self._remove_disk(key)
+            return None
+        self.disk.move_to_end(key)
+        return entry['created_at'], entry['response']
+
+    def _put_disk(self, key: str, created_at: float, response: str):
+        path = self._disk_path(key)
+        data = json.dumps({'created_at': created_at, 'response': response}, ensure_ascii=False)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+        size = os.path.getsize(path)
+        self.disk_bytes += size - self.disk.get(key, 0)
+        self.disk[key] = size
+        self.disk.move_to_end(key)
+        while self.disk and self.disk_bytes > self.disk_max_bytes:
+            oldest = next(iter(self.disk))
+            self._remove_disk(oldest)
+
+    def _remove_disk(self, key: str):
+        self.disk_bytes -= self.disk.pop(key, 0)
+        try:
+            os.remove(self._disk_path(key))
+        except FileNotFoundError:
+            pass
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f'{key}.json')
+
+    def _load_disk_index(self):
+        entries = []
+        for filename in os.listdir(self.disk_dir):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.disk_dir, filename)
+            entries.append((os.path.getmtime(path), filename[:-len('.json')], os.path.getsize(path)))
+        for _, key, size in sorted(entries):
+            self.disk[key] = size
+        self.disk_bytes = sum(self.disk.values())
@@ -0,0 +1,263 @@
+import itertools
+import queue
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+class GenerationRequest:
+    """
+    Richiesta di generazione accodata nello scheduler.
+    Iterandola si ottengono le coppie (token, risposta_completa) come da LLMManager in streaming.
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, session_id: str, messages: list, max_tokens: int, priority: int = 0, cancel=None):
+        self.id = next(self._ids)
+        self.session_id = session_id
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.priority = priority
+        # CancellationToken: una richiesta annullata termina senza errore con il testo prodotto fin lì
+        self.cancel = cancel
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self.response_text = ""
+        self.completion_tokens = 0
+        self.error = None
+        self._events = queue.Queue()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel is not None and self.cancel.is_cancelled()
+
+    @property
+    def wait_time(self) -> float:
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+    def __iter__(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            if isinstance(event, Exception):
+                raise event
+            yield event
+
+    def _emit(self, token_text: str):
+        self.response_text += token_text
+        self.completion_tokens += 1
+        self._events.put((token_text, self.response_text))
+
+    def _finish(self, error: Exception = None):
+        self.finished_at = time.monotonic()
+        self.error = error
+        if error is not None:
+            self._events.put(error)
+        self._events.put(None)
+
+class SchedulerBackend(ABC):
+    """
+    Interfaccia del motore di decodifica usato dallo scheduler.
+
+    Ogni sequenza attiva occupa uno slot (0..max_batch_size-1). step() avanza di un passo
+    tutte le sequenze passate, in un unico batch, e restituisce per ciascuno slot il testo
+    prodotto e se la sequenza è terminata.
+    """
+
+    max_batch_size = 1
+
+    @abstractmethod
+    def start(self, slot: int, request: GenerationRequest):
+        pass
+
+    @abstractmethod
+    def step(self, slots: list) -> dict:
+        pass
+
+    def release(self, slot: int):
+        pass
+
+    def close(self):
+        pass
+
+class RequestScheduler:
+    """
+    Coda di generazione equa davanti all'unico modello.
+
+    - Al massimo una sequenza attiva per sessione, così una sessione non occupa tutto il batch
+    - Tra le sessioni in attesa vince la priorità più alta; a parità, quella servita meno di recente
+    - L'attesa fa crescere la priorità (aging_seconds per punto), così nessuna richiesta resta ferma
+    - Le sequenze attive avanzano insieme in un unico batch; i posti liberi vengono
+      riempiti appena una sequenza termina (continuous batching)
+    - Una richiesta annullata libera il suo posto prima del passo successivo
+    """
+
+    def __init__(self, backend: SchedulerBackend, aging_seconds: float = 10.0):
+        self.backend = backend
+        self.aging_seconds = aging_seconds
+        self.pending = {}  # session_id -> deque di GenerationRequest
+        self.active = {}  # slot -> GenerationRequest
+        self.last_served = {}
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+        # Statistiche
+        self.completed_requests = 0
+        self.completed_tokens = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.decode_time = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.backend.close()
+
+    def submit(self, session_id: str, messages: list, max_tokens: int, priority: int = 0,
+               cancel=None) -> GenerationRequest:
+        request = GenerationRequest(session_id, messages, max_tokens, priority, cancel)
+        with self._condition:
+            self.pending.setdefault(session_id, deque()).append(request)
+            self._condition.notify_all()
+        if cancel is not None:
+            # Sveglia il ciclo anche se è fermo in attesa: la richiesta in coda va chiusa subito
+            cancel.add_callback(self._wake)
+        return request
+
+    def queue_depth(self) -> int:
+        with self._condition:
+            return sum(len(requests) for requests in self.pending.values())
+
+    def stats(self) -> dict:
+        with self._condition:
+            waiting = [request for requests in self.pending.values() for request in requests]
+            return {
+                'queue_depth': len(waiting),
+                'active': len(self.active),
+                'oldest_wait_s': max((request.wait_time for request in waiting), default=0.0),
+                'avg_wait_s': self.total_wait_time / self.completed_requests if self.completed_requests else 0.0,
+                'max_wait_s': self.max_wait_time,
+                'completed': self.completed_requests,
+                'tokens_per_s': self.completed_tokens / self.decode_time if self.decode_time else 0.0
+            }
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self.active and not self._has_pending():
+                    self._condition.wait()
+                if not self._running:
+                    break
+                admitted = self._admit()
+
+            for slot, request in admitted:
+                try:
+                    self.backend.start(slot, request)
+                except Exception as e:
+                    self._complete(slot, e)
+
+            for slot in [slot for slot, request in self.active.items() if request.cancelled]:
+                self._complete(slot)
+            if not self.active:
+                continue
+
+            slots = list(self.active.keys())
+            start = time.monotonic()
+            try:
+                results = self.backend.step(slots)
+            except Exception as e:
+                for slot in slots:
+                    self._complete(slot, e)
+                continue
+            self.decode_time += time.monotonic() - start
+
+            for slot, (token_text, finished) in results.items():
+                request = self.active[slot]
+                if token_text:
+                    request._emit(token_text)
+                if finished or request.completion_tokens >= request.max_tokens:
+                    self._complete(slot)
+
+        # Chiusura: le richieste ancora aperte terminano con un errore
+        for slot in list(self.active.keys()):
+            self._complete(slot, RuntimeError("Scheduler arrestato"))
+        with self._condition:
+            for requests in self.pending.values():
+                for request in requests:
+                    request._finish(RuntimeError("Scheduler arrestato"))
+            self.pending.clear()
+
+    def _has_pending(self) -> bool:
+        return any(self.pending.values())
+
+    def _wake(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _drop_cancelled(self):
+        """Chiude le richieste annullate mentre erano in coda"""
+        for session_id in list(self.pending.keys()):
+            requests = self.pending[session_id]
+            for request in [request for request in requests if request.cancelled]:
+                requests.remove(request)
+                request._finish()
+            if not requests:
+                del self.pending[session_id]
+
+    def _admit(self) -> list:
+        """Assegna gli slot liberi alle richieste scelte dalla politica di equità"""
+        self._drop_cancelled()
+        admitted = []
+        free_slots = [slot for slot in range(self.backend.max_batch_size) if slot not in self.active]
+        active_sessions = {request.session_id for request in self.active.values()}
+        now = time.monotonic()
+        while free_slots:
+            candidates = [
+                session_id for session_id, requests in self.pending.items()
+                if requests and session_id not in active_sessions
+            ]
+            if not candidates:
+                break
+            session_id = max(candidates, key=lambda s: (
+                self._effective_priority(self.pending[s][0], now),
+                -self.last_served.get(s, 0.0)
+            ))
+            request = self.pending[session_id].popleft()
+            if not self.pending[session_id]:
+                del self.pending[session_id]
+
+            slot = free_slots.pop(0)
+            request.started_at = now
+            self.total_wait_time += request.wait_time
+            self.max_wait_time = max(self.max_wait_time, request.wait_time)
+            self.last_served[session_id] = now
+            self.active[slot] = request
+            active_sessions.add(session_id)
+            admitted.append((slot, request))
+        return admitted
+
+    def _effective_priority(self, request: GenerationRequest, now: float) -> float:
+        return request.priority + (now - request.enqueued_at) / self.aging_seconds
+
+    def _complete(self, slot: int, error: Exception = None):
+        request = self.active.pop(slot)
+        self.backend.release(slot)
+        with self._condition:
+            self.completed_requests += 1
+            self.completed_tokens += request.completion_tokens
+        request._finish(error)
@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+
+class SearchIndex:
+    """
+    Indice full-text (SQLite FTS5) dei messaggi di tutte le chat.
+
+    I messaggi stanno in una tabella normale indicizzata per chat; la tabella FTS5 usa
+    quella come contenuto esterno ed è tenuta allineata dai trigger, così l'indice cresce
+    di un messaggio per append e la cancellazione di una chat non scandisce tutto l'indice.
+    Come il catalogo è un dato derivato e può essere ricostruito dalle history.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY,
+                    chat TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS messages_chat ON messages (chat, position);
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+                    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+                END;
+            """)
+
+    def add(self, chat: str, position: int, role: str, content: str):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO messages (chat, position, role, content) VALUES (?, ?, ?, ?)",
+                (chat, position, role, content)
+            )
+
+    def add_many(self, chat: str, messages: list, start: int = 0):
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO messages (chat, position, role, content) VALUES (?, ?, ?, ?)",
+                ((chat, start + offset, message['role'], message['content']) for offset, message in enumerate(messages))
+            )
+
+    def remove_chat(self, chat: str):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM messages WHERE chat = ?", (chat,))
+
+    def search(self, query: str, limit: int = 20, chat: str = None) -> list:
+        """
+        Messaggi che contengono tutte le parole della query, dal più rilevante (BM25).
+        Ogni risultato ha chat, position (indice del messaggio nella chat), role, snippet e score.
+        """
+        match = self._to_match(query)
+        if not match:
+            return []
+        sql = (
+            "SELECT m.chat, m.position, m.role, "
+            "snippet(messages_fts, 0, '[', ']', '…', 16) AS snippet, bm25(messages_fts) AS score "
+            "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+            "WHERE messages_fts MATCH ?"
+        )
+        params = [match]
+        if chat is not None:
+            sql += " AND m.chat = ?"
+            params.append(chat)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [
+            {'chat': row[0], 'position': row[1], 'role': row[2], 'snippet': row[3], 'score': -row[4]}
+            for row in rows
+        ]
+
+    def clear(self):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM messages")
+            self.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    def _to_match(self, query: str) -> str:
+        # Ogni parola diventa una frase tra virgolette: la sintassi FTS5 nel testo dell'utente
+        # (trattini, due punti, operatori) non produce errori e le parole vanno tutte trovate
+        terms = [term.replace('"', '""') for term in query.split()]
+        return " ".join(f'"{term}"' for term in terms if term.strip('"'))
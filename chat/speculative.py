@@ -0,0 +1,101 @@
+import numpy as np
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+SPECULATIVE_MODES = ('none', 'prompt_lookup', 'draft_model')
+
+class GGUFDraftModel(LlamaDraftModel):
+    """
+    Bozze generate da un modello GGUF piccolo, in greedy.
+
+    Deve usare lo stesso vocabolario del modello principale: le bozze sono id di token.
+    Llama.generate riusa il prefisso già valutato, quindi a ogni passo il modello di bozza
+    valuta solo i token accettati dall'ultima chiamata.
+    """
+
+    def __init__(self, model_path: str, num_pred_tokens: int = 8, n_ctx: int = 2048, **load_params):
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(model_path=model_path, n_ctx=n_ctx, verbose=False, **load_params)
+
+    def __call__(self, input_ids, **kwargs):
+        draft = []
+        try:
+            for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0, repeat_penalty=1.0):
+                if token == self.llm.token_eos():
+                    break
+                draft.append(token)
+                if len(draft) >= self.num_pred_tokens:
+                    break
+        except Exception as e:
+            # Una bozza mancata rallenta solo il passo: il modello principale prosegue da solo
+            print(f"Errore del modello di bozza: {e}")
+        return np.array(draft, dtype=np.intc)
+
+    def close(self):
+        if hasattr(self.llm, 'close'):
+            self.llm.close()
+
+class MeasuredDraftModel(LlamaDraftModel):
+    """
+    Conta i token proposti da un modello di bozza e quelli accettati dal modello principale.
+
+    Llama chiama il modello di bozza con il contesto che termina con l'ultimo token
+    campionato: se dalla chiamata precedente il contesto è cresciuto di n token, le prime
+    n - 1 bozze sono state accettate. La bozza dell'ultimo passo resta non verificata.
+    """
+
+    def __init__(self, draft_model: LlamaDraftModel):
+        self.draft_model = draft_model
+        self.reset()
+
+    def reset(self):
+        """Da chiamare all'inizio di ogni generazione"""
+        self.drafted = 0
+        self.accepted = 0
+        self._last_length = None
+        self._last_drafted = 0
+
+    def __call__(self, input_ids, **kwargs):
+        length = len(input_ids)
+        if self._last_length is not None and self._last_drafted:
+            self.drafted += self._last_drafted
+            self.accepted += min(max(length - self._last_length - 1, 0), self._last_drafted)
+        draft = self.draft_model(input_ids, **kwargs)
+        self._last_length = length
+        self._last_drafted = len(draft)
+        return draft
+
+    def close(self):
+        """Libera il modello di bozza, se ne carica uno (le bozze da n-grammi non hanno risorse)"""
+        if hasattr(self.draft_model, 'close'):
+            self.draft_model.close()
+
+def create_draft_model(options: dict, load_params: dict = None):
+    """
+    Modello di bozza per la configurazione "speculative", misurato da MeasuredDraftModel.
+    Restituisce None se la decodifica speculativa è disattivata.
+    """
+    options = options or {}
+    mode = options.get('mode', 'none')
+    if mode not in SPECULATIVE_MODES:
+        raise ValueError(f"Modalità speculativa non valida. Deve essere una tra: {', '.join(SPECULATIVE_MODES)}")
+    if mode == 'none':
+        return None
+    num_pred_tokens = options.get('num_pred_tokens', 10)
+    if mode == 'prompt_lookup':
+        # Bozze copiate dal contesto: la continuazione dell'ultima occorrenza dell'n-gramma finale
+        draft_model = LlamaPromptLookupDecoding(
+            max_ngram_size=options.get('max_ngram_size', 2),
+            num_pred_tokens=num_pred_tokens
+        )
+    else:
+        if not options.get('draft_model_path'):
+            raise ValueError("La modalità draft_model richiede il percorso del modello di bozza (draft_model_path)")
+        load_params = load_params or {}
+        draft_model = GGUFDraftModel(
+            options['draft_model_path'],
+            num_pred_tokens=num_pred_tokens,
+            n_ctx=load_params.get('n_ctx', 2048),
+            n_gpu_layers=load_params.get('n_gpu_layers', 0)
+        )
+    return MeasuredDraftModel(draft_model)
@@ -0,0 +1,79 @@
+SUMMARY_INSTRUCTIONS = (
+    "Sei un assistente che mantiene il riassunto di una conversazione. "
+    "Aggiorna il riassunto con i nuovi messaggi conservando fatti, nomi, numeri, "
+    "preferenze e decisioni dell'utente. Scrivi solo il riassunto, in italiano, "
+    "in terza persona e senza commenti."
+)
+
+ROLE_LABELS = {'user': "Utente", 'assistant': "Assistente", 'system': "Sistema"}
+
+class HistorySummarizer:
+    """
+    Riassume i messaggi usciti dalla finestra di contesto in un riassunto progressivo.
+
+    I messaggi vengono passati al modello a blocchi di al più max_input_tokens, ognuno
+    insieme al riassunto precedente, così il prompt del riassunto ha dimensione limitata
+    anche quando c'è molto da riassumere. La generazione si ferma a max_summary_tokens e il
+    risultato viene tagliato all'ultima parola intera.
+    """
+
+    def __init__(self, llm_manager, max_summary_tokens: int = 256, max_input_tokens: int = 1024,
+                 priority: int = -1):
+        self.llm_manager = llm_manager
+        self.max_summary_tokens = max_summary_tokens
+        self.max_input_tokens = max_input_tokens
+        # Con lo scheduler i riassunti passano dopo le risposte agli utenti
+        self.priority = priority
+
+    def summarize(self, summary: str, messages: list, session_id: str = "summary") -> str:
+        """Restituisce il riassunto aggiornato con i messaggi indicati"""
+        tokenizer = self.llm_manager.get_tokenizer()
+        chunk = []
+        chunk_tokens = 0
+        for message in messages:
+            message_tokens = tokenizer.count_message(message)
+            if chunk and chunk_tokens + message_tokens > self.max_input_tokens:
+                summary = self._fold(summary, chunk, session_id)
+                chunk = []
+                chunk_tokens = 0
+            chunk.append(message)
+            chunk_tokens += message_tokens
+        if chunk:
+            summary = self._fold(summary, chunk, session_id)
+        return summary
+
+    def _fold(self, summary: str, messages: list, session_id: str) -> str:
+        transcript = "\n".join(
+            f"{ROLE_LABELS.get(message['role'], message['role'])}: {message['content']}" for message in messages
+        )
+        request = (
+            f"Riassunto attuale:\n{summary or '(vuoto)'}\n\n"
+            f"Nuovi messaggi:\n{transcript}\n\n"
+            f"Scrivi il riassunto aggiornato in al massimo {self.max_summary_tokens * 2 // 3} parole."
+        )
+        response_text = ""
+        for _, response_text in self.llm_manager.generate_response(
+            [{'role': 'system', 'content': SUMMARY_INSTRUCTIONS}, {'role': 'user', 'content': request}],
+            stream=False,
+            session_id=session_id,
+            priority=self.priority,
+            max_tokens=self.max_summary_tokens,
+            background=True
+        ):
+            pass
+        return self._fit(response_text.strip(), self.max_summary_tokens) or summary
+
+    def _fit(self, text: str, max_tokens: int) -> str:
+        """Tronca il testo all'ultima parola che sta nel limite di token"""
+        tokenizer = self.llm_manager.get_tokenizer()
+        if tokenizer.count(text) <= max_tokens:
+            return text
+        words = text.split(' ')
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if tokenizer.count(' '.join(words[:middle])) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        return ' '.join(words[:low])
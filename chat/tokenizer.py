@@ -0,0 +1,113 @@
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+class Tokenizer(ABC):
+    """
+    Interfaccia usata da ChatHistory per misurare i messaggi in token.
+
+    Le sottoclassi implementano solo encode(); i conteggi passano da una cache LRU
+    perché gli stessi testi (preprompt, header del template, messaggi ricaricati)
+    vengono misurati molte volte.
+
+    Se viene fornito un template (gli inference_params del config) il conteggio
+    include anche i token fissi del chat template:
+    - system (preprompt): BOS + pre_prompt_prefix + contenuto + pre_prompt_suffix
+    - user: input_prefix (chiude il turno precedente e apre quello utente) + contenuto
+    - assistant: input_suffix (chiude il turno precedente e apre quello assistente) + contenuto
+    - a fine prompt: input_suffix, l'header da cui parte la generazione
+    """
+
+    def __init__(self, template: dict = None, cache_size: int = 4096):
+        self.template = template
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._role_overhead = {}
+
+    @abstractmethod
+    def encode(self, text: str) -> list:
+        pass
+
+    def bos_tokens(self) -> int:
+        return 0
+
+    def count(self, text: str) -> int:
+        with self._lock:
+            num_tokens = self._cache.get(text)
+            if num_tokens is not None:
+                self._cache.move_to_end(text)
+                return num_tokens
+
+        num_tokens = len(self.encode(text))
+
+        with self._lock:
+            self._cache[text] = num_tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return num_tokens
+
+    def count_message(self, message: dict) -> int:
+        return self.count(message['content']) + self.message_overhead(message['role'])
+
+    def message_overhead(self, role: str) -> int:
+        overhead = self._role_overhead.get(role)
+        if overhead is None:
+            if self.template is None:
+                overhead = self.count(role)
+            elif role == 'assistant':
+                overhead = self.count(self.template['input_suffix'])
+            else:
+                # L'header ha la stessa forma per user e system, cambia solo il ruolo
+                overhead = self.count(self.template['input_prefix'].replace('user', role))
+            self._role_overhead[role] = overhead
+        return overhead
+
+    def prompt_overhead(self) -> int:
+        """Token fissi del prompt oltre al contenuto del preprompt e dei messaggi"""
+        if self.template is None:
+            return 0
+        return (self.bos_tokens()
+                + self.count(self.template['pre_prompt_prefix'])
+                + self.count(self.template['pre_prompt_suffix'])
+                + self.count(self.template['input_suffix']))
+
+class TiktokenTokenizer(Tokenizer):
+    """Stima con tiktoken, usata quando il modello non è disponibile"""
+
+    def __init__(self, encoding_name: str = "cl100k_base", template: dict = None, cache_size: int = 4096):
+        super().__init__(template, cache_size)
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding_name)
+
+    def encode(self, text: str) -> list:
+        return self.encoding.encode(text)
+
+class LlamaTokenizer(Tokenizer):
+    """Tokenizer del modello caricato: i conteggi coincidono con quelli di llama.cpp"""
+
+    def __init__(self, llm, template: dict = None, cache_size: int = 4096):
+        super().__init__(template, cache_size)
+        self.llm = llm
+        self._bos_tokens = None
+
+    def encode(self, text: str) -> list:
+        # special=True come nel chat handler, così <|eot_id|> conta come un solo token
+        return self.llm.tokenize(text.encode('utf-8'), add_bos=False, special=True)
+
+    def bos_tokens(self) -> int:
+        if self._bos_tokens is None:
+            self._bos_tokens = len(self.llm.tokenize(b"", add_bos=True, special=True))
+        return self._bos_tokens
+
+_default_tokenizer = None
+_default_tokenizer_lock = threading.Lock()
+
+def get_default_tokenizer() -> Tokenizer:
+    """Restituisce l'unico tokenizer tiktoken condiviso da tutte le ChatHistory"""
+    global _default_tokenizer
+    if _default_tokenizer is None:
+        with _default_tokenizer_lock:
+            if _default_tokenizer is None:
+                _default_tokenizer = TiktokenTokenizer()
+    return _default_tokenizer
@@ -0,0 +1,60 @@
+import json
+import os
+import platform
+import re
+from datetime import datetime
+
+# Parametri di Llama misurati da autotune.py e sovrascritti dal profilo dell'host
+TUNABLE_PARAMS = ('n_threads', 'n_threads_batch', 'n_batch', 'n_ubatch')
+
+def host_id() -> str:
+    """Nome dell'host utilizzabile in un nome di file"""
+    return re.sub(r'[^\w.-]', '_', platform.node() or 'localhost')
+
+def model_id(model_path: str, model_config: dict) -> str:
+    """Identifica modello e contesto (vedi LLMManager.get_model_id)"""
+    model_name = os.path.splitext(os.path.basename(model_path))[0]
+    return f"{model_name}_ctx{model_config['load_params']['n_ctx']}"
+
+def base_load_params(model_config: dict) -> dict:
+    """Parametri di caricamento della config, compreso n_threads che sta in inference_params"""
+    params = dict(model_config["load_params"])
+    n_threads = model_config["inference_params"].get("n_threads")
+    if n_threads and 'n_threads' not in params:
+        params['n_threads'] = n_threads
+    return params
+
+def profile_path(directory: str, model_id: str) -> str:
+    return os.path.join(directory, f"{host_id()}__{model_id}.json")
+
+def load_profile(directory: str, model_id: str):
+    """Profilo misurato su questo host per il modello, o None se non c'è"""
+    path = profile_path(directory, model_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            profile = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Errore durante il caricamento del profilo di tuning: {str(e)}")
+        return None
+    # Solo i parametri misurati: un profilo modificato a mano non cambia altro
+    profile['params'] = {key: value for key, value in profile.get('params', {}).items() if key in TUNABLE_PARAMS}
+    return profile
+
+def save_profile(directory: str, model_id: str, params: dict, measurements: dict, trials: list) -> str:
+    os.makedirs(directory, exist_ok=True)
+    path = profile_path(directory, model_id)
+    profile = {
+        'host': host_id(),
+        'model_id': model_id,
+        'created_at': datetime.now().isoformat(),
+        'cpu_count': os.cpu_count(),
+        'params': params,
+        'measurements': measurements,
+        'trials': trials
+    }
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(profile, f, ensure_ascii=False, indent=2)
+    os.replace(path + '.tmp', path)
+    return path
@@ -13,7 +13,8 @@ config = {
     "f16_kv": True,
     "use_mmap": True,
     "no_kv_offload": False,
-    "num_experts_used": 0
+    "num_experts_used": 0,
+    "chat_format": "llama-3" # template usato per contare i token di header
   },
   "inference_params": {
     "n_threads": 4,
@@ -43,5 +44,18 @@ config = {
     "memory_f16": True,
     "multiline_input": False,
     "penalize_nl": True
+  },
+  "speculative": {
+    "mode": "none", # "none", "prompt_lookup" (n-grammi dal contesto) o "draft_model" (paths.draft_model)
+    "num_pred_tokens": 10, # token proposti a ogni passo
+    "max_ngram_size": 2 # solo prompt_lookup
+  },
+  "memory": {
+    "enabled": False, # memoria a lungo termine: nel prompt la coda recente e i messaggi vecchi pertinenti
+    "top_k": 4, # messaggi recuperati per turno
+    "min_score": 0.2, # similarità coseno minima
+    "recent_tokens": 1024, # token della coda recente della chat
+    "max_tokens": 512, # token per i messaggi recuperati
+    "embedding_n_ctx": 512 # token per messaggio letti dall'embedder (paths.embedding_model o il modello di chat)
   }
 }
@@ -9,7 +9,9 @@ if not os.path.exists('config/_private.py'):
     "audio_model": "path/to/audio_model.onnx",
     "audio_model_json": "path/to/audio_model.json",
     "audio_output": "path/to/output.wav",
-    "piper_exe": "path/to/piper.exe"
+    "piper_exe": "path/to/piper.exe",
+    "draft_model": "path/to/draft_model.gguf",
+    "embedding_model": "path/to/embedding_model.gguf"
 }
 
 print("*"*50)
@@ -23,4 +25,16 @@ llm_model = private.config["llm_model"]
 audio_model = private.config["audio_model"]
 audio_model_json = private.config["audio_model_json"]
 audio_output = private.config["audio_output"]
-piper_exe = private.config["piper_exe"]
\ No newline at end of file
+piper_exe = private.config["piper_exe"]
+# Facoltativo: modello GGUF piccolo per la decodifica speculativa (speculative.mode = "draft_model")
+draft_model = private.config.get("draft_model")
+# Facoltativo: modello GGUF di embedding per la memoria a lungo termine (memory.enabled);
+# senza, gli embedding si calcolano con il modello di chat
+embedding_model = private.config.get("embedding_model")
+# Facoltativi: file GGUF per ogni modello in config/ ({"nome": "percorso"}) e modello predefinito.
+# Un modello senza percorso né "model_path" nella sua config usa llm_model
+models = private.config.get("models", {})
+default_model = private.config.get("default_model")
+
+def get_model_path(name: str) -> str:
+    return models.get(name, llm_model)
\ No newline at end of file
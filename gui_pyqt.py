@@ -1,26 +1,90 @@
 from PyQt6.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QTextEdit, QPushButton, QCheckBox,
-                            QComboBox, QInputDialog, QMessageBox)
-from PyQt6.QtCore import Qt, QThread, pyqtSignal
+                            QComboBox, QInputDialog, QMessageBox, QLineEdit,
+                            QDialog, QListWidget, QListWidgetItem, QListView,
+                            QAbstractItemView)
+from PyQt6.QtCore import Qt, QThread, QTimer, pyqtSignal, QAbstractListModel, QModelIndex
 from PyQt6.QtGui import QIcon
 from main import Chatbot
+from chat.cancellation import CancellationToken
+import metrics
+import queue
 import sys
+import threading
 
 class StreamWorker(QThread):
-    token_received = pyqtSignal(str, str)
+    """
+    Thread unico che genera le risposte ai messaggi in coda.
+
+    I token non passano per un segnale ciascuno: si accumulano in un buffer che la GUI
+    svuota a frequenza limitata con take_pending(). Alla fine di ogni risposta
+    response_finished porta il testo completo, o la parte generata se cancel() l'ha interrotta.
+    Se la richiesta è stata annullata prima che il messaggio entrasse nella history,
+    response_discarded riporta il messaggio.
+    """
+    response_finished = pyqtSignal(str)
+    response_discarded = pyqtSignal(str)
+    error = pyqtSignal(str)
     
-    def __init__(self, chatbot, message, stream):
+    def __init__(self, chatbot):
         super().__init__()
         self.chatbot = chatbot
-        self.message = message
-        self.stream = stream
+        self._requests = queue.Queue()
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._cancel = None
+    
+    def submit(self, message, stream):
+        # Il token esiste da subito: Stop funziona anche prima che il thread prenda la richiesta
+        self._cancel = CancellationToken()
+        self._requests.put((message, stream, self._cancel))
+    
+    def cancel(self):
+        """Interrompe l'ultima risposta richiesta: il modello si ferma al token successivo"""
+        cancel = self._cancel
+        if cancel is not None:
+            cancel.cancel()
+    
+    def take_pending(self) -> str:
+        """Testo generato dall'ultima chiamata, svuotando il buffer"""
+        with self._pending_lock:
+            text = "".join(self._pending)
+            self._pending.clear()
+        return text
+    
+    def stop(self):
+        self.cancel()
+        self._requests.put(None)
+        self.wait()
         
     def run(self):
-        for token, full_response in self.chatbot.generate_response(self.message, stream=self.stream):
-            self.token_received.emit(token, full_response)
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            message, stream, cancel = request
+            history = self.chatbot.current_history
+            message_count = history.message_count()
+            full_response = ""
+            try:
+                for token, full_response in self.chatbot.generate_response(
+                    message, stream=stream, reproduce_audio=True, cancel=cancel
+                ):
+                    if token:
+                        with self._pending_lock:
+                            self._pending.append(token)
+            except Exception as e:
+                self.error.emit(f"Errore durante la generazione: {str(e)}")
+                continue
+            if history.message_count() == message_count:
+                # Annullata prima di iniziare: il Chatbot non ha salvato nemmeno la domanda
+                self.response_discarded.emit(message)
+            else:
+                self.response_finished.emit(full_response)
 
 class AudioRecordWorker(QThread):
     finished = pyqtSignal(str)
+    partial = pyqtSignal(str)
     error = pyqtSignal(str)
     
     def __init__(self, chatbot):
@@ -29,21 +93,124 @@ class AudioRecordWorker(QThread):
         
     def run(self):
         try:
-            audio_file = self.chatbot.audio_recorder.record()
-            text = self.chatbot.audio_transcriber.transcribe(audio_file)
+            # Le ipotesi parziali arrivano mentre l'utente parla
+            text = self.chatbot.listen(
+                on_partial=lambda committed, tentative: self.partial.emit(committed + tentative)
+            )
             self.finished.emit(text)
         except OSError as e:
             self.error.emit(f"Errore di registrazione audio: {str(e)}")
         except Exception as e:
             self.error.emit(f"Errore: {str(e)}")
 
+class ChatMessagesModel(QAbstractListModel):
+    """
+    Messaggi della chat corrente per la QListView, caricati a pagine.
+
+    All'apertura contiene solo l'ultima pagina; le precedenti vengono lette dalla
+    history quando la vista arriva in cima, così una chat lunga si apre in tempo costante.
+    """
+
+    PAGE_SIZE = 200
+    ROLE_LABELS = {'user': "Tu", 'assistant': "Bot", 'error': "Errore"}
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.history = None
+        # Posizione nella history del primo messaggio caricato
+        self.first = 0
+        self.messages = []
+
+    def set_history(self, history):
+        self.beginResetModel()
+        self.history = history
+        total = history.message_count() if history is not None else 0
+        self.first = max(total - self.PAGE_SIZE, 0)
+        self.messages = history.get_messages(self.first, total - self.first) if history is not None else []
+        self.endResetModel()
+
+    def clear(self):
+        self.set_history(None)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.messages)
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        message = self.messages[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            return f"{self.ROLE_LABELS.get(message['role'], message['role'])}: {message['content']}"
+        if role == Qt.ItemDataRole.UserRole:
+            return message
+        return None
+
+    def has_older(self) -> bool:
+        return self.first > 0
+
+    def fetch_older(self) -> int:
+        """Carica la pagina precedente in cima e restituisce il numero di righe aggiunte"""
+        if not self.has_older():
+            return 0
+        start = max(self.first - self.PAGE_SIZE, 0)
+        page = self.history.get_messages(start, self.first - start)
+        self.beginInsertRows(QModelIndex(), 0, len(page) - 1)
+        self.messages[:0] = page
+        self.first = start
+        self.endInsertRows()
+        return len(page)
+
+    def row_for_position(self, position: int) -> int:
+        """Riga del messaggio in quella posizione della history, caricando le pagine mancanti"""
+        while position < self.first and self.fetch_older():
+            pass
+        return position - self.first
+
+    def append_message(self, role: str, content: str):
+        row = len(self.messages)
+        self.beginInsertRows(QModelIndex(), row, row)
+        self.messages.append({'role': role, 'content': content})
+        self.endInsertRows()
+
+    def append_to_last(self, text: str):
+        if not self.messages or not text:
+            return
+        # Nuovo dizionario: le righe caricate sono gli stessi oggetti della history
+        last = self.messages[-1]
+        self.messages[-1] = {'role': last['role'], 'content': last['content'] + text}
+        index = self.index(len(self.messages) - 1)
+        self.dataChanged.emit(index, index)
+
+    def update_last(self, content: str):
+        if not self.messages:
+            return
+        self.messages[-1] = {'role': self.messages[-1]['role'], 'content': content}
+        index = self.index(len(self.messages) - 1)
+        self.dataChanged.emit(index, index)
+
+    def remove_last(self):
+        if not self.messages:
+            return
+        row = len(self.messages) - 1
+        self.beginRemoveRows(QModelIndex(), row, row)
+        self.messages.pop()
+        self.endRemoveRows()
+
 class ChatbotGUI(QMainWindow):
+    model_loaded = pyqtSignal(bool)
+    # Aggiornamenti al secondo della risposta in streaming, indipendenti dai token al secondo
+    STREAM_FPS = 30
+
     def __init__(self):
         super().__init__()
+        # Il modello e l'audio si caricano in background: la finestra compare subito
         self.chatbot = Chatbot(use_audio=False, stream=False, preload_audio=True)
         self.init_ui()
         self.current_response = ""
+        self.generating = False
+        self.init_stream_worker()
         self.update_chat_list()
+        self.show_loading_state()
         
     def init_ui(self):
         self.setWindowTitle('Chatbot Interface')
@@ -63,20 +230,32 @@ class ChatbotGUI(QMainWindow):
         chat_management_layout.addWidget(self.chat_selector)
         
         # Pulsanti per gestire le chat
-        new_chat_button = QPushButton('Nuova Chat')
-        new_chat_button.clicked.connect(self.create_new_chat)
-        chat_management_layout.addWidget(new_chat_button)
+        self.new_chat_button = QPushButton('Nuova Chat')
+        self.new_chat_button.clicked.connect(self.create_new_chat)
+        chat_management_layout.addWidget(self.new_chat_button)
         
-        delete_chat_button = QPushButton('Elimina Chat')
-        delete_chat_button.clicked.connect(self.delete_current_chat)
-        chat_management_layout.addWidget(delete_chat_button)
+        self.delete_chat_button = QPushButton('Elimina Chat')
+        self.delete_chat_button.clicked.connect(self.delete_current_chat)
+        chat_management_layout.addWidget(self.delete_chat_button)
+        
+        # Ricerca nei messaggi di tutte le chat
+        self.search_field = QLineEdit()
+        self.search_field.setPlaceholderText('Cerca nelle chat...')
+        self.search_field.returnPressed.connect(self.search_chats)
+        chat_management_layout.addWidget(self.search_field)
         
         # Aggiungi il layout di gestione chat al layout principale
         layout.addLayout(chat_management_layout)
         
-        # Area chat
-        self.chat_area = QTextEdit()
-        self.chat_area.setReadOnly(True)
+        # Area chat: vista virtualizzata, disegna solo i messaggi visibili
+        self.chat_model = ChatMessagesModel(self)
+        self.chat_area = QListView()
+        self.chat_area.setModel(self.chat_model)
+        self.chat_area.setWordWrap(True)
+        self.chat_area.setResizeMode(QListView.ResizeMode.Adjust)
+        self.chat_area.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.chat_area.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.chat_area.verticalScrollBar().valueChanged.connect(self.load_older_messages)
         layout.addWidget(self.chat_area)
         
         # Area input
@@ -108,6 +287,12 @@ class ChatbotGUI(QMainWindow):
         self.send_button.clicked.connect(self.send_message)
         button_layout.addWidget(self.send_button)
         
+        # Interrompe la risposta in corso; la parte già generata resta nella chat
+        self.stop_button = QPushButton('Stop')
+        self.stop_button.clicked.connect(self.stop_generation)
+        self.stop_button.setEnabled(False)
+        button_layout.addWidget(self.stop_button)
+        
         self.audio_checkbox = QCheckBox('Usa Audio')
         self.audio_checkbox.stateChanged.connect(self.toggle_audio)
         button_layout.addWidget(self.audio_checkbox)
@@ -121,6 +306,32 @@ class ChatbotGUI(QMainWindow):
         
         # Shortcuts
         self.input_field.installEventFilter(self)
+
+    def init_stream_worker(self):
+        self.stream_worker = StreamWorker(self.chatbot)
+        self.stream_worker.response_finished.connect(self.handle_stream_finished)
+        self.stream_worker.response_discarded.connect(self.handle_stream_discarded)
+        self.stream_worker.error.connect(self.handle_generation_error)
+        self.stream_worker.start()
+        # Il timer porta nella vista i token accumulati, al più STREAM_FPS volte al secondo
+        self.stream_timer = QTimer(self)
+        self.stream_timer.setInterval(1000 // self.STREAM_FPS)
+        self.stream_timer.timeout.connect(self.flush_stream_tokens)
+        
+    def show_loading_state(self):
+        """Disabilita l'invio finché il modello non è caricato"""
+        self.send_button.setEnabled(False)
+        self.statusBar().showMessage('Caricamento modello in corso...')
+        self.model_loaded.connect(self.handle_model_loaded)
+        # Il callback arriva dal thread di caricamento: il segnale lo riporta nel thread della GUI
+        self.chatbot.add_model_ready_callback(self.model_loaded.emit)
+
+    def handle_model_loaded(self, ok):
+        if ok:
+            self.send_button.setEnabled(True)
+            self.statusBar().showMessage('Modello pronto', 5000)
+        else:
+            self.statusBar().showMessage('Errore durante il caricamento del modello')
         
     def eventFilter(self, obj, event):
         if obj == self.input_field and event.type() == event.Type.KeyPress:
@@ -131,46 +342,96 @@ class ChatbotGUI(QMainWindow):
     
     def send_message(self):
         message = self.input_field.toPlainText().strip()
-        if not message:
+        # Una risposta alla volta: i token vanno sempre nell'ultima riga della vista
+        if not message or not self.chatbot.is_model_ready() or self.generating:
             return
             
         # Aggiungi il messaggio dell'utente alla chat
-        self.chat_area.append(f"Tu: {message}")
+        self.chat_model.append_message('user', message)
         self.input_field.clear()
     
         # Prepara l'area per la risposta del bot
-        self.chat_area.append("Bot: ")
+        self.chat_model.append_message('assistant', "")
+        self.chat_area.scrollToBottom()
         self.current_response = ""
         
         # Gestione streaming
-        self.stream_worker = StreamWorker(self.chatbot, message, self.stream_checkbox.isChecked())
-        self.stream_worker.token_received.connect(self.handle_stream_token)
-        self.stream_worker.finished.connect(self.handle_stream_finished)
-        self.stream_worker.start()
-       
+        self.set_generating(True)
+        self.stream_worker.submit(message, self.stream_checkbox.isChecked())
+        self.stream_timer.start()
+    
+    def set_generating(self, generating):
+        # Durante la generazione la risposta appartiene alla chat corrente: cambiarla,
+        # crearne una nuova o eliminarla metterebbe i token nella vista sbagliata
+        self.generating = generating
+        self.stop_button.setEnabled(generating)
+        self.chat_selector.setEnabled(not generating)
+        self.new_chat_button.setEnabled(not generating)
+        self.delete_chat_button.setEnabled(not generating)
+    
+    def stop_generation(self):
+        if not self.generating:
+            return
+        self.stop_button.setEnabled(False)
+        self.stream_worker.cancel()
+        self.chatbot.stop_speaking()
+        self.statusBar().showMessage('Risposta interrotta', 5000)
     
-    def handle_stream_token(self, token, full_response):
-        # Aggiorna l'ultima riga con la risposta completa aggiornata
-        cursor = self.chat_area.textCursor()
-        cursor.movePosition(cursor.MoveOperation.End)
-        cursor.movePosition(
-            cursor.MoveOperation.StartOfBlock, 
-            cursor.MoveMode.KeepAnchor
-        )
-        cursor.removeSelectedText()
-        cursor.insertText(f"Bot: {full_response}")
-        
-        # Aggiorna la risposta corrente
+    def flush_stream_tokens(self):
+        # Aggiunge all'ultima riga solo il testo arrivato dall'ultimo aggiornamento
+        text = self.stream_worker.take_pending()
+        if not text:
+            return
+        self.chat_model.append_to_last(text)
+        self.current_response += text
+        self.chat_area.scrollToBottom()
+    
+    def handle_stream_finished(self, full_response):
+        self.set_generating(False)
+        self.stream_timer.stop()
+        self.stream_worker.take_pending()
+        if not full_response.strip():
+            # Interrotta prima del primo token: la history non ha la risposta, e nemmeno la vista
+            self.chat_model.remove_last()
+            return
+        # Il testo completo sostituisce quello accumulato (senza streaming è l'unico aggiornamento)
+        self.chat_model.update_last(full_response)
         self.current_response = full_response
+        self.chat_area.scrollToBottom()
     
-    def handle_stream_finished(self):
-        pass
+    def handle_stream_discarded(self, message):
+        self.set_generating(False)
+        self.stream_timer.stop()
+        self.stream_worker.take_pending()
+        # Né la domanda né la risposta sono nella history: si tolgono dalla vista e la domanda
+        # torna nel campo di testo, se l'utente non ha già iniziato a scriverne un'altra
+        self.chat_model.remove_last()
+        self.chat_model.remove_last()
+        if not self.input_field.toPlainText().strip():
+            self.input_field.setPlainText(message)
+    
+    def handle_generation_error(self, error_message):
+        self.set_generating(False)
+        self.stream_timer.stop()
+        self.flush_stream_tokens()
+        self.chat_model.append_message('error', error_message)
+        self.chat_area.scrollToBottom()
     
     def handle_response(self, response):
-        self.chat_area.append(f"Bot: {response}")
+        self.chat_model.append_message('assistant', response)
         
     def clear_chat(self):
-        self.chat_area.clear()
+        self.chat_model.clear()
+    
+    def load_older_messages(self, value):
+        """Arrivati in cima alla vista carica la pagina precedente, senza spostare i messaggi visibili"""
+        if value != self.chat_area.verticalScrollBar().minimum() or not self.chat_model.has_older():
+            return
+        anchor = self.chat_area.indexAt(self.chat_area.viewport().rect().topLeft())
+        added = self.chat_model.fetch_older()
+        if anchor.isValid():
+            self.chat_area.scrollTo(self.chat_model.index(anchor.row() + added),
+                                    QAbstractItemView.ScrollHint.PositionAtTop)
         
     def toggle_audio(self, state):
         self.chatbot.use_audio = state
@@ -180,6 +441,9 @@ class ChatbotGUI(QMainWindow):
         self.chatbot.stream = state
     
     def start_recording(self):
+        # Se il bot sta parlando, l'utente che inizia a parlare lo interrompe
+        self.chatbot.stop_speaking()
+        
         # Disabilita i controlli durante la registrazione
         self.record_button.setEnabled(False)
         self.send_button.setEnabled(False)
@@ -188,13 +452,18 @@ class ChatbotGUI(QMainWindow):
         # Avvia il worker per la registrazione
         self.audio_worker = AudioRecordWorker(self.chatbot)
         self.audio_worker.finished.connect(self.handle_audio_input)
+        self.audio_worker.partial.connect(self.handle_audio_partial)
         self.audio_worker.error.connect(self.handle_audio_error)
         self.audio_worker.start()
     
+    def handle_audio_partial(self, text):
+        # Mostra la trascrizione provvisoria nel campo di input
+        self.input_field.setPlainText(text)
+
     def handle_audio_input(self, text):
         # Riabilita i controlli
         self.record_button.setEnabled(True)
-        self.send_button.setEnabled(True)
+        self.send_button.setEnabled(self.chatbot.is_model_ready())
         self.input_field.setEnabled(True)
         
         # Inserisce il testo trascritto nel campo di input
@@ -207,11 +476,12 @@ class ChatbotGUI(QMainWindow):
     def handle_audio_error(self, error_message):
         # Riabilita i controlli
         self.record_button.setEnabled(True)
-        self.send_button.setEnabled(True)
+        self.send_button.setEnabled(self.chatbot.is_model_ready())
         self.input_field.setEnabled(True)
         
         # Mostra l'errore nella chat
-        self.chat_area.append(f"Errore: {error_message}")
+        self.chat_model.append_message('error', error_message)
+        self.chat_area.scrollToBottom()
     
     def update_chat_list(self):
         """Aggiorna la lista delle chat disponibili nel dropdown"""
@@ -245,7 +515,7 @@ class ChatbotGUI(QMainWindow):
         current_chat = self.chat_selector.currentText()
         if current_chat == "default":
             self.chatbot.get_current_chat().clear()
-            self.chat_area.clear()
+            self.clear_chat()
             return
             
         reply = QMessageBox.question(self, 'Conferma', 
@@ -265,14 +535,57 @@ class ChatbotGUI(QMainWindow):
         if chat_name:
             try:
                 self.chatbot.load_chat(chat_name)
-                # Aggiorna l'area chat con la cronologia della chat caricata
-                self.chat_area.clear()
-                for message in self.chatbot.get_current_chat().get_history():
-                    role = "Tu" if message['role'] == "user" else "Bot"
-                    self.chat_area.append(f"{role}: {message['content']}")
+                # Mostra l'ultima pagina della chat caricata, le precedenti si caricano scorrendo
+                self.chat_model.set_history(self.chatbot.get_current_chat())
+                self.chat_area.scrollToBottom()
             except ValueError as e:
                 QMessageBox.warning(self, 'Errore', str(e))
 
+    def search_chats(self):
+        """Mostra i messaggi che contengono il testo cercato; doppio clic apre la chat"""
+        query = self.search_field.text().strip()
+        if not query:
+            return
+        results = self.chatbot.search_chats(query, limit=50)
+        
+        dialog = QDialog(self)
+        dialog.setWindowTitle(f'Risultati per "{query}"')
+        dialog.resize(600, 400)
+        dialog_layout = QVBoxLayout(dialog)
+        results_list = QListWidget()
+        for result in results:
+            role = "Tu" if result['role'] == "user" else "Bot"
+            item = QListWidgetItem(f"{result['chat']} #{result['position']} ({role}): {result['snippet']}")
+            item.setData(Qt.ItemDataRole.UserRole, result)
+            results_list.addItem(item)
+        if not results:
+            results_list.addItem('Nessun risultato')
+        results_list.itemDoubleClicked.connect(lambda item: self.open_search_result(item, dialog))
+        dialog_layout.addWidget(results_list)
+        dialog.exec()
+    
+    def open_search_result(self, item, dialog):
+        result = item.data(Qt.ItemDataRole.UserRole)
+        if result is None:
+            return
+        if self.generating:
+            self.statusBar().showMessage('Attendi la fine della risposta per cambiare chat', 5000)
+            return
+        dialog.accept()
+        self.chat_selector.setCurrentText(result['chat'])
+        # Porta in vista il messaggio trovato, caricando le pagine fino alla sua posizione
+        index = self.chat_model.index(self.chat_model.row_for_position(result['position']))
+        self.chat_area.setCurrentIndex(index)
+        self.chat_area.scrollTo(index, QAbstractItemView.ScrollHint.PositionAtCenter)
+    
+    def closeEvent(self, event):
+        # Con CHATBOT_METRICS=1 stampa il riepilogo delle latenze alla chiusura
+        if metrics.is_enabled():
+            print(metrics.summary())
+        self.stream_timer.stop()
+        self.stream_worker.stop()
+        super().closeEvent(event)
+
 def main():
     app = QApplication(sys.argv)
     window = ChatbotGUI()
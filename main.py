@@ -1,57 +1,283 @@
-from audio.recorder import AudioRecorder
-from audio.transcriber import AudioTranscriber
-from audio.player import AudioPlayer
+import config.paths as paths
+import metrics
+from chat.cancellation import CancellationToken
 from chat.history_manager import ChatHistoryManager
-from chat.llm_manager import LLMManager
-from config.config_Meta_Llama_3_1_8B_Instruct_Q4_K_M import config
+from chat.model_registry import ModelRegistry
+from startup import StartupLoader
 
 class Chatbot:
-    def __init__(self, use_audio=False, stream=False, preload_audio=False):
+    def __init__(self, use_audio=False, stream=False, preload_audio=False, batch_size=1, llm_options=None,
+                 default_model=None, model_ram_budget=None):
         self.use_audio = use_audio
         self.stream = stream
-        self.history_manager = ChatHistoryManager()
-        # Crea una history di default
-        try:
-            self.current_history = self.history_manager.load_history("default")
-        except ValueError:
-            self.current_history = self.history_manager.create_history("default")
-            
-        self.llm_manager = LLMManager()
+        self.batch_size = batch_size
+        # Argomenti aggiuntivi per LLMManager (es. response_cache)
+        self.llm_options = llm_options or {}
+        # Modelli in config/: ogni chat o richiesta può sceglierne uno, caricato al primo uso
+        self.models = ModelRegistry(self._create_llm_manager, model_ram_budget, default_model, listener=self,
+                                    speculative=self.llm_options.get('speculative'))
+        self.speech_pipeline = None
+        self.last_time_to_first_audio = None
+        # Modello e motori audio si caricano in background: il costruttore ritorna subito
+        self.loader = StartupLoader()
+        with self.loader.measure('history'):
+            self.history_manager = ChatHistoryManager()
+            # Crea una history di default
+            self.current_chat_name = "default"
+            try:
+                self.current_history = self.history_manager.load_history("default")
+            except ValueError:
+                self.current_history = self.history_manager.create_history("default")
         
-        if use_audio or preload_audio:   
-            self.audio_recorder = AudioRecorder()
-            self.audio_transcriber = AudioTranscriber()
-            self.audio_player = AudioPlayer()
+        self.loader.submit('llm', self._load_llm)
+        if use_audio or preload_audio:
+            self.preload_audio()
+
+    @property
+    def llm_manager(self):
+        """LLMManager del modello predefinito; attende la fine del caricamento se ancora in corso"""
+        self.loader.get('llm')
+        return self.models.get()
+
+    @property
+    def audio_recorder(self):
+        return self._get_audio('recorder')
+
+    @property
+    def audio_transcriber(self):
+        return self._get_audio('transcriber')
+
+    @property
+    def audio_player(self):
+        return self._get_audio('player')
+
+    def is_model_ready(self):
+        return self.loader.is_ready('llm')
+
+    def wait_until_ready(self, timeout=None):
+        self.loader.get('llm', timeout)
+
+    def add_model_ready_callback(self, callback):
+        """callback(ok) viene chiamato (dal thread di caricamento) quando il modello è pronto o fallisce"""
+        self.loader.futures['llm'].add_done_callback(lambda future: callback(future.exception() is None))
+
+    def get_loading_status(self):
+        return self.loader.status()
+
+    def get_startup_report(self):
+        return self.loader.report()
+
+    def preload_audio(self):
+        """Avvia in parallelo il caricamento di registrazione, trascrizione e sintesi vocale"""
+        for name in ('recorder', 'transcriber', 'player'):
+            self.loader.submit(name, getattr(self, f'_load_{name}'))
+
+    def _get_audio(self, name):
+        if not self.loader.is_submitted(name):
+            self.preload_audio()
+        return self.loader.get(name)
+
+    def _load_llm(self):
+        llm_manager = self.models.get()
+        self._use_default_model(llm_manager)
+        self._restore_chat_state(self.current_chat_name, self.models.peek(self._chat_model(self.current_chat_name)))
+        return llm_manager
+
+    def _create_llm_manager(self, name, model_config, model_path):
+        # Import qui: llama_cpp è lento da importare e serve solo al modello
+        from chat.llm_manager import LLMManager
+        llm_manager = LLMManager(model_config=model_config, model_path=model_path, name=name, **self.llm_options)
+        if self.batch_size > 1:
+            llm_manager.enable_scheduler(self.batch_size)
+        return llm_manager
+
+    def _use_default_model(self, llm_manager):
+        # Le history misurano il contesto con il tokenizer del modello
+        self.history_manager.set_tokenizer(llm_manager.get_tokenizer())
+        # I turni che escono dalla finestra di contesto vengono riassunti invece che persi
+        from chat.summarizer import HistorySummarizer
+        self.history_manager.set_summarizer(HistorySummarizer(llm_manager))
+        # Memoria a lungo termine (sezione "memory" della config): nelle chat lunghe il prompt
+        # contiene la coda recente e i messaggi vecchi recuperati per similarità
+        from chat.memory import create_embedder
+        options = dict(llm_manager.config.get("memory") or {})
+        options.setdefault('embedding_model_path', paths.embedding_model)
+        embedder = create_embedder(options, llm_manager.model_path,
+                                   llm_manager.config["inference_params"].get("n_threads"))
+        self.history_manager.set_memory(embedder, options)
+
+    def model_swapped(self, name, llm_manager):
+        """Listener del registro: tokenizer e riassunti seguono il modello predefinito"""
+        if name == self.models.default:
+            self._use_default_model(llm_manager)
+
+    def list_models(self):
+        return self.models.stats()['models']
+
+    def get_chat_model(self):
+        """Modello usato dalla chat corrente"""
+        return self._chat_model(self.current_chat_name)
+
+    def set_chat_model(self, name: str):
+        """Imposta il modello della chat corrente (None per tornare al predefinito)"""
+        if name is not None and name not in self.models.models:
+            raise ValueError(f"Modello non valido. Deve essere uno tra: {', '.join(self.models.models)}")
+        self.save_chat_state()
+        self.history_manager.set_chat_model(self.current_chat_name, name)
+
+    def swap_model(self, name: str, make_default: bool = False):
+        """Ricarica un modello in background e lo sostituisce senza interrompere le richieste in corso"""
+        return self.models.swap(name, make_default)
+
+    def _chat_model(self, chat_name):
+        model = self.history_manager.get_chat_model(chat_name)
+        # Una chat il cui modello non è più in config/ usa quello predefinito
+        return model if model in self.models.models else self.models.default
+
+    def _load_recorder(self):
+        from audio.recorder import AudioRecorder
+        return AudioRecorder()
+
+    def _load_transcriber(self):
+        from audio.transcriber import AudioTranscriber
+        transcriber = AudioTranscriber()
+        transcriber.load_model()
+        return transcriber
+
+    def _load_player(self):
+        from audio.player import AudioPlayer
+        return AudioPlayer()
+
+    def listen(self, on_partial=None):
+        """
+        Registra una frase e la trascrive mentre l'utente parla.
+        on_partial(confermato, provvisorio) riceve le ipotesi parziali durante la registrazione.
+        """
+        from audio.streaming_transcriber import StreamingTranscriber
+        recorder = self.audio_recorder
+        streaming = StreamingTranscriber(self.audio_transcriber, on_partial, sample_rate=recorder.RATE)
+        streaming.start()
+        try:
+            recorder.record(on_frame=streaming.on_frame)
+        finally:
+            text = streaming.finish()
+        return text
 
     def get_user_input(self):
         if self.use_audio:
-            audio_file = self.audio_recorder.record()
-            return self.audio_transcriber.transcribe(audio_file)
+            text = self.listen(
+                on_partial=lambda committed, tentative: print(f"\rTu: {committed}{tentative}", end="", flush=True)
+            )
+            print()
+            return text
         return input("\nTu: ")
 
-    def generate_response(self, user_input, stream=False, reproduce_audio=False):
-        self.current_history.append("user", user_input)
-        
-        for token, full_response in self.llm_manager.generate_response(
-            self.current_history.get_tokenized_context(config["inference_params"]["pre_prompt"], 2048),
-            stream=stream
-        ):
-            yield token, full_response
+    def generate_response(self, user_input, stream=False, reproduce_audio=False, history=None, session_id="default",
+                          model=None, cancel=None):
+        """
+        Genera la risposta e la salva nella history. cancel (CancellationToken) interrompe la
+        generazione: la parte già generata viene salvata come risposta, come dopo un errore.
+        """
+        # Senza history esplicita si usa la chat corrente (CLI e GUI); l'API passa quella della sessione
+        history = history or self.current_history
+        # Il modello indicato nella richiesta, altrimenti quello della chat. Il lease lo tiene
+        # aperto fino alla fine della risposta anche se nel frattempo viene sostituito
+        with self.models.lease(model or self._chat_model(history.name)) as llm_manager:
+            return (yield from self._generate_response(user_input, stream, reproduce_audio, history,
+                                                       session_id, llm_manager, cancel))
+
+    def _generate_response(self, user_input, stream, reproduce_audio, history, session_id, llm_manager, cancel):
+        # Annullata prima di iniziare (es. client già disconnesso): la domanda non entra nella history
+        if cancel is not None and cancel.is_cancelled():
+            return ""
+        if history.tokenizer is not llm_manager.get_tokenizer():
+            history.set_tokenizer(llm_manager.get_tokenizer())
+        history.append("user", user_input)
         
+        # Con l'audio attivo la risposta viene pronunciata frase per frase mentre viene generata,
+        # quindi il modello lavora sempre in streaming anche se il chiamante non lo richiede
+        speech = None
         if reproduce_audio and self.use_audio:
-            self.audio_player.play(full_response)
+            from audio.speech_pipeline import SpeechPipeline
+            speech = self.speech_pipeline = SpeechPipeline(self.audio_player)
+        
+        full_response = ""
+        interrupted = True
+        try:
+            for token, full_response in llm_manager.generate_response(
+                history.get_tokenized_context(
+                    llm_manager.get_pre_prompt(),
+                    llm_manager.get_context_budget()
+                ),
+                stream=stream or speech is not None,
+                session_id=session_id,
+                cancel=cancel
+            ):
+                if speech is not None:
+                    speech.feed(token)
+                if stream:
+                    yield token, full_response
+            interrupted = cancel is not None and cancel.is_cancelled()
+        finally:
+            # Risposta interrotta (annullata, client disconnesso, errore): si salva la parte
+            # già generata, cioè quella vista dall'utente, senza lasciare un turno vuoto
+            if not interrupted or full_response.strip():
+                history.append("assistant", full_response)
+            if interrupted and speech is not None:
+                speech.cancel()
+        if not stream:
+            yield "", full_response
             
-        self.current_history.append("assistant", full_response)
+        # Turno completato: l'eventuale riassunto dei turni vecchi parte in background
+        history.maybe_summarize()
+        if speech is not None and not interrupted:
+            speech.finish(wait=True)
+            self.last_time_to_first_audio = speech.time_to_first_audio
         return full_response
+
+    def stop_speaking(self):
+        """Interrompe la risposta vocale in corso (barge-in)"""
+        if self.speech_pipeline is not None:
+            self.speech_pipeline.cancel()
         
     # Nuovi metodi per gestire le chat history
     def create_new_chat(self, name: str):
         """Crea una nuova chat history e la imposta come corrente"""
+        self.save_chat_state()
         self.current_history = self.history_manager.create_history(name)
+        self.current_chat_name = name
         
     def load_chat(self, name: str):
         """Carica una chat history esistente"""
+        if name != self.current_chat_name:
+            self.save_chat_state()
         self.current_history = self.history_manager.load_history(name)
+        if name != self.current_chat_name:
+            self.current_chat_name = name
+            self._restore_chat_state(name)
+
+    def save_chat_state(self):
+        """Salva lo stato del modello per la chat corrente, così riprenderla non richiede il prefill"""
+        llm_manager = self.models.peek(self._chat_model(self.current_chat_name))
+        if not self.is_model_ready() or llm_manager is None:
+            return
+        try:
+            self.history_manager.save_model_state(self.current_chat_name, llm_manager.save_state())
+        except Exception as e:
+            print(f"Errore durante il salvataggio dello stato del modello: {e}")
+
+    def _restore_chat_state(self, name: str, llm_manager=None):
+        if llm_manager is None:
+            if not self.is_model_ready():
+                # Lo stato verrà ripristinato al termine del caricamento del modello
+                return
+            llm_manager = self.models.peek(self._chat_model(name))
+            if llm_manager is None:
+                # Modello non ancora caricato: il prompt verrà valutato da zero
+                return
+        snapshot = self.history_manager.load_model_state(name)
+        if snapshot is not None:
+            llm_manager.load_state(snapshot)
         
     def delete_chat(self, name: str):
         """Elimina una chat history"""
@@ -61,12 +287,18 @@ class Chatbot:
         """Restituisce la lista delle chat disponibili"""
         return self.history_manager.list_histories()
         
+    def search_chats(self, query: str, limit: int = 20, chat: str = None):
+        """Cerca un testo nei messaggi di tutte le chat (o di una sola)"""
+        return self.history_manager.search(query, limit, chat)
+        
     def get_current_chat(self):
         """Restituisce la chat history corrente"""
         return self.current_history
 
     def toggle_audio(self):
         self.use_audio = not self.use_audio
+        if self.use_audio:
+            self.preload_audio()
         
     def toggle_stream(self):
         self.stream = not self.stream
@@ -84,6 +316,9 @@ class Chatbot:
         print("- '/load nome' per caricare una chat")
         print("- '/list' per vedere le chat disponibili")
         print("- '/delete nome' per eliminare una chat")
+        print("- '/search testo' per cercare nei messaggi di tutte le chat")
+        print("- '/model [nome]' per vedere i modelli o scegliere quello della chat corrente")
+        print("- Ctrl+C durante una risposta per interromperla")
         
         while True:
             user_input = self.get_user_input()
@@ -113,7 +348,34 @@ class Chatbot:
                     chats = self.list_chats()
                     print("\nChat disponibili:")
                     for chat in chats:
-                        print(f"- {chat['name']} (creata: {chat['created_at']})")
+                        print(f"- {chat['name']} ({chat['message_count']} messaggi, "
+                              f"modificata: {chat['last_modified'][:16].replace('T', ' ')})")
+                    continue
+                    
+                elif command == '/search' and len(parts) > 1:
+                    results = self.search_chats(parts[1])
+                    if not results:
+                        print("Nessun risultato")
+                    for result in results:
+                        role = "Tu" if result['role'] == "user" else "Bot"
+                        print(f"- {result['chat']} #{result['position']} ({role}): {result['snippet']}")
+                    continue
+                    
+                elif command == '/model':
+                    if len(parts) > 1:
+                        try:
+                            self.set_chat_model(parts[1])
+                            print(f"Modello della chat: {parts[1]}")
+                        except ValueError as e:
+                            print(f"Errore: {e}")
+                        continue
+                    current = self.get_chat_model()
+                    print("\nModelli disponibili:")
+                    for model in self.list_models():
+                        flags = [label for label, active in (("chat corrente", model['name'] == current),
+                                                             ("predefinito", model['default']),
+                                                             ("caricato", model['loaded'])) if active]
+                        print(f"- {model['name']}" + (f" ({', '.join(flags)})" if flags else ""))
                     continue
                     
                 elif command == '/delete' and len(parts) > 1:
@@ -124,15 +386,31 @@ class Chatbot:
                     continue
             
             if "exit" in user_input.lower():
+                self.save_chat_state()
+                if metrics.is_enabled():
+                    print(metrics.summary())
                 break
             
             # Gestione normale del messaggio
-            for token, full_response in self.generate_response(user_input, stream=self.stream):
-                if self.stream:
-                    print(token, end="", flush=True)
+            if not self.is_model_ready():
+                print("Modello in caricamento, attendere...")
+            cancel = CancellationToken()
+            responses = self.generate_response(user_input, stream=self.stream, reproduce_audio=True, cancel=cancel)
+            try:
+                for token, full_response in responses:
+                    if self.stream:
+                        print(token, end="", flush=True)
+            except KeyboardInterrupt:
+                # Ctrl+C interrompe la risposta, non il chatbot: la parte generata resta nella chat
+                cancel.cancel()
+                responses.close()
+                print("\n(risposta interrotta)")
+                continue
                 
             if not self.stream:
                 print(f"\nAssistant: {full_response}")
+            if self.use_audio and self.last_time_to_first_audio is not None:
+                print(f"\n(primo audio dopo {self.last_time_to_first_audio:.2f} s)")
 
 if __name__ == "__main__":
     # Esempio di utilizzo:
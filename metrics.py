@@ -0,0 +1,182 @@
+import os
+import threading
+import time
+
+# Limiti superiori dei bucket, come negli istogrammi Prometheus
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 200, 500)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+PREFIX = 'chatbot_'
+
+class Histogram:
+    """Istogramma a bucket fissi: memoria costante, quantili stimati per interpolazione"""
+
+    def __init__(self, name: str, description: str, buckets: tuple, unit: str = 's'):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        self.unit = unit
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            self.counts[index] += 1
+            self.total += value
+            self.count += 1
+            if value > self.max:
+                self.max = value
+
+    def quantile(self, q: float) -> float:
+        with self._lock:
+            counts, count, maximum = list(self.counts), self.count, self.max
+        if count == 0:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else maximum
+                return min(lower + (upper - lower) * (rank - cumulative) / bucket_count, maximum)
+            cumulative += bucket_count
+        return maximum
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.total = 0.0
+            self.count = 0
+            self.max = 0.0
+
+class _Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+class MetricsRegistry:
+    """
+    Istogrammi di latenza per fase di un turno (contesto, modello, history, STT, TTS).
+
+    Da disattivato timer() restituisce un context manager vuoto condiviso e observe()
+    ritorna subito: i punti di misura non allocano né prendono lock.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.histograms = {}
+
+    def register(self, name: str, description: str, buckets: tuple = LATENCY_BUCKETS, unit: str = 's'):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, description, buckets, unit)
+        return self.histograms[name]
+
+    def observe(self, name: str, value: float):
+        if self.enabled:
+            self.histograms[name].observe(value)
+
+    def timer(self, name: str):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self.histograms[name])
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+    def render_prometheus(self) -> str:
+        """Tutti gli istogrammi nel formato testuale di Prometheus"""
+        lines = []
+        for histogram in self.histograms.values():
+            name = PREFIX + histogram.name
+            lines.append(f"# HELP {name} {histogram.description}")
+            lines.append(f"# TYPE {name} histogram")
+            with histogram._lock:
+                counts, total, count = list(histogram.counts), histogram.total, histogram.count
+            cumulative = 0
+            for bucket, bucket_count in zip(histogram.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{le="{bucket:g}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{le="+Inf"}} {count}')
+            lines.append(f"{name}_sum {total:.6f}")
+            lines.append(f"{name}_count {count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Riepilogo leggibile delle fasi misurate almeno una volta"""
+        lines = ["Metriche (campioni, media, p50, p95, max):"]
+        for histogram in self.histograms.values():
+            if histogram.count == 0:
+                continue
+            values = (histogram.total / histogram.count, histogram.quantile(0.5),
+                      histogram.quantile(0.95), histogram.max)
+            lines.append(f"  {histogram.name:<32} {histogram.count:>6}  "
+                         + "  ".join(self._format(value, histogram.unit) for value in values))
+        if len(lines) == 1:
+            lines.append("  nessun campione")
+        return "\n".join(lines)
+
+    def _format(self, value: float, unit: str) -> str:
+        if unit == 's':
+            return f"{value * 1e3:9.1f} ms"
+        if not unit:
+            return f"{value:9.2f}   "
+        return f"{value:9.1f} {unit}"
+
+registry = MetricsRegistry(enabled=os.environ.get('CHATBOT_METRICS', '0') not in ('', '0'))
+
+registry.register('context_build_seconds', "Tempo di get_tokenized_context")
+registry.register('history_save_seconds', "Tempo di scrittura della history su disco")
+registry.register('memory_search_seconds', "Tempo di ricerca nella memoria a lungo termine, embedding della domanda compreso")
+registry.register('llm_time_to_first_token_seconds', "Tempo dalla richiesta al primo token del modello")
+registry.register('llm_generation_seconds', "Durata totale della generazione")
+registry.register('llm_tokens_per_second', "Velocità di decodifica", RATE_BUCKETS, unit='tok/s')
+registry.register('llm_prompt_tokens', "Token del prompt", TOKEN_BUCKETS, unit='tok')
+registry.register('llm_completion_tokens', "Token generati", TOKEN_BUCKETS, unit='tok')
+registry.register('llm_draft_acceptance_ratio', "Frazione dei token di bozza accettati per generazione",
+                  RATIO_BUCKETS, unit='')
+registry.register('stt_transcribe_seconds', "Tempo di AudioTranscriber.transcribe")
+registry.register('stt_partial_seconds', "Tempo di una decodifica parziale in streaming")
+registry.register('tts_play_seconds', "Tempo di sintesi e riproduzione di un testo")
+
+def enable(enabled: bool = True):
+    registry.enabled = enabled
+
+def is_enabled() -> bool:
+    return registry.enabled
+
+def observe(name: str, value: float):
+    registry.observe(name, value)
+
+def timer(name: str):
+    return registry.timer(name)
+
+def render_prometheus() -> str:
+    return registry.render_prometheus()
+
+def summary() -> str:
+    return registry.summary()
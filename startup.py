@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+class StartupLoader:
+    """
+    Carica in parallelo, in thread di background, i sottosistemi lenti (LLM, Whisper, TTS).
+
+    Ogni sottosistema è esposto come future: chi ne ha bisogno aspetta solo quello,
+    mentre GUI e API possono partire subito e mostrare lo stato di caricamento.
+    Registra anche la durata di ogni fase per il report di avvio.
+    """
+
+    def __init__(self, max_workers: int = 4):
+        self.started_at = time.perf_counter()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='startup')
+        self.futures = {}
+        self.timings = {}
+        self.ready_at = {}
+        self._lock = threading.Lock()
+        self._report_printed = False
+
+    def submit(self, name: str, loader) -> Future:
+        """Avvia il caricamento se non è già in corso e ne restituisce il future"""
+        with self._lock:
+            if name in self.futures:
+                return self.futures[name]
+            future = self.executor.submit(self._timed, name, loader)
+            self.futures[name] = future
+            self._report_printed = False
+        future.add_done_callback(self._on_done)
+        return future
+
+    def get(self, name: str, timeout: float = None):
+        """Attende e restituisce il sottosistema caricato (rilancia l'eventuale errore di caricamento)"""
+        return self.futures[name].result(timeout)
+
+    def is_submitted(self, name: str) -> bool:
+        return name in self.futures
+
+    def is_ready(self, name: str) -> bool:
+        future = self.futures.get(name)
+        return future is not None and future.done() and future.exception() is None
+
+    def status(self) -> dict:
+        """Stato di ogni sottosistema: loading, ready o error"""
+        statuses = {}
+        for name, future in list(self.futures.items()):
+            if not future.done():
+                statuses[name] = 'loading'
+            elif future.exception() is not None:
+                statuses[name] = 'error'
+            else:
+                statuses[name] = 'ready'
+        return statuses
+
+    @contextmanager
+    def measure(self, name: str):
+        """Misura una fase eseguita in modo sincrono"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = time.perf_counter() - start
+            self.ready_at[name] = time.perf_counter() - self.started_at
+
+    def report(self) -> str:
+        lines = ["Report di avvio:"]
+        statuses = self.status()
+        for name, seconds in sorted(self.timings.items(), key=lambda item: self.ready_at[item[0]]):
+            status = statuses.get(name, 'ready')
+            lines.append(f"  {name:<12} {seconds:7.2f} s  (pronto a {self.ready_at[name]:6.2f} s, {status})")
+        for name, status in statuses.items():
+            if name not in self.timings:
+                lines.append(f"  {name:<12}       -    ({status})")
+        total = max(self.ready_at.values(), default=0.0)
+        serial = sum(self.timings.values())
+        lines.append(f"  totale {total:.2f} s (in sequenza sarebbero stati {serial:.2f} s)")
+        return "\n".join(lines)
+
+    def _timed(self, name: str, loader):
+        start = time.perf_counter()
+        try:
+            return loader()
+        finally:
+            self.timings[name] = time.perf_counter() - start
+            self.ready_at[name] = time.perf_counter() - self.started_at
+
+    def _on_done(self, future: Future):
+        error = future.exception()
+        name = next((n for n, f in self.futures.items() if f is future), '?')
+        if error is not None:
+            print(f"Errore durante il caricamento di {name}: {error}")
+        with self._lock:
+            if self._report_printed or not all(f.done() for f in self.futures.values()):
+                return
+            self._report_printed = True
+        print(self.report())